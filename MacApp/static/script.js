@@ -5,6 +5,8 @@ const API_BASE_URL = window.location.hostname === 'localhost' || window.location
 
 let mediaRecorder;
 let audioChunks = [];
+let liveSession = null; // 实时转录会话（/ws/transcribe）
+let liveResultPromise = null; // 松开按键后等待的实时转录最终结果
 let isRecording = false;
 let currentTranscript = ''; // 当前转写文本
 let currentEventData = null; // 当前时间数据（可能是数组）
@@ -292,6 +294,9 @@ async function startRecording() {
         
         mediaRecorder = new MediaRecorder(stream);
         audioChunks = [];
+        // 同时尝试实时转录（服务端没有本地模型时自动回退到上传整段录音）
+        liveSession = openLiveTranscription(stream);
+        liveResultPromise = null;
 
         mediaRecorder.ondataavailable = (event) => {
             audioChunks.push(event.data);
@@ -299,8 +304,11 @@ async function startRecording() {
 
         mediaRecorder.onstop = async () => {
             const audioBlob = new Blob(audioChunks, { type: 'audio/webm' });
-            await processAudio(audioBlob);
+            const liveResult = liveResultPromise ? await liveResultPromise : null;
+            liveSession = null;
+            liveResultPromise = null;
             stream.getTracks().forEach(track => track.stop());
+            await processAudio(audioBlob, liveResult);
         };
 
         mediaRecorder.start();
@@ -361,6 +369,10 @@ async function startRecording() {
 // 停止录音
 function stopRecording() {
     if (mediaRecorder && mediaRecorder.state !== 'inactive') {
+        // 先通知实时转录结束（服务端只需解码最后一小段音频）
+        if (liveSession) {
+            liveResultPromise = finishLiveTranscription(liveSession);
+        }
         mediaRecorder.stop();
         isRecording = false;
         recordBtn.classList.remove('recording');
@@ -370,18 +382,24 @@ function stopRecording() {
 }
 
 // 处理音频（自动模式）
-async function processAudio(audioBlob) {
+async function processAudio(audioBlob, liveResult = null) {
     // 在处理开始时记录时间（不包括录音时间）
     operationStartTime = Date.now();
     operationTranscribeMs = 0;
     operationAnalyzeMs = 0;
     
     try {
-        // 1. 转录
-        showStatus('📝 正在转录...');
-        const transcribeStart = performance.now();
-        const transcribeResult = await transcribeAudio(audioBlob);
-        operationTranscribeMs = performance.now() - transcribeStart;
+        // 1. 转录（已有实时转录结果时不再上传录音）
+        let transcribeResult;
+        if (liveResult && liveResult.text) {
+            transcribeResult = { transcript: liveResult.text, model: 'Faster-Whisper（实时）', method: 'live' };
+            operationTranscribeMs = liveResult.finalize_ms || 0;
+        } else {
+            showStatus('📝 正在转录...');
+            const transcribeStart = performance.now();
+            transcribeResult = await transcribeAudio(audioBlob);
+            operationTranscribeMs = performance.now() - transcribeStart;
+        }
         
         // 处理返回结果（可能是对象或字符串）
         let transcript, model;
@@ -544,6 +562,97 @@ async function analyzeTranscriptManual(transcript) {
     }
 }
 
+// 实时转录：录音期间把 16kHz 单声道 PCM 发送到 /ws/transcribe，显示临时结果
+function openLiveTranscription(stream) {
+    if (!window.WebSocket || !window.AudioContext) return null;
+    const baseUrl = API_BASE_URL || window.location.origin;
+    let socket;
+    try {
+        socket = new WebSocket(baseUrl.replace(/^http/, 'ws') + '/ws/transcribe?language=zh-CN');
+    } catch (error) {
+        console.warn('实时转录不可用:', error);
+        return null;
+    }
+    const session = { socket, ready: false, context: null, source: null, processor: null, onFinal: null };
+
+    socket.onmessage = (event) => {
+        const message = JSON.parse(event.data);
+        if (message.type === 'ready') {
+            session.ready = true;
+            startLiveAudio(session, stream, message.sample_rate || 16000);
+        } else if (message.type === 'partial') {
+            if (isRecording && message.text) showStatus('🎤 ' + message.text);
+        } else if (message.type === 'final') {
+            if (session.onFinal) session.onFinal(message);
+        } else if (message.type === 'error') {
+            // 服务端繁忙时只跳过这次临时结果，继续发送音频
+            if (message.stage === 'partial') return;
+            console.warn('实时转录不可用:', message.error);
+            session.ready = false;
+            // 最终解码被拒绝：立即回退到上传整段录音
+            if (session.onFinal) session.onFinal(null);
+        }
+    };
+    socket.onclose = () => {
+        session.ready = false;
+        if (session.onFinal) session.onFinal(null);
+    };
+    return session;
+}
+
+function startLiveAudio(session, stream, targetRate) {
+    const context = new AudioContext();
+    const source = context.createMediaStreamSource(stream);
+    const processor = context.createScriptProcessor(4096, 1, 1);
+    const ratio = context.sampleRate / targetRate;
+
+    processor.onaudioprocess = (event) => {
+        if (!session.ready || session.socket.readyState !== WebSocket.OPEN) return;
+        // 降采样到 16kHz（取每个区间的平均值）并转换为 16 位 PCM
+        const input = event.inputBuffer.getChannelData(0);
+        const pcm = new Int16Array(Math.floor(input.length / ratio));
+        for (let i = 0; i < pcm.length; i++) {
+            const start = Math.floor(i * ratio);
+            const end = Math.max(start + 1, Math.floor((i + 1) * ratio));
+            let sum = 0;
+            for (let j = start; j < end; j++) sum += input[j];
+            const sample = Math.max(-1, Math.min(1, sum / (end - start)));
+            pcm[i] = sample < 0 ? sample * 0x8000 : sample * 0x7FFF;
+        }
+        session.socket.send(pcm.buffer);
+    };
+    source.connect(processor);
+    processor.connect(context.destination);
+    Object.assign(session, { context, source, processor });
+}
+
+// 结束实时转录并等待最终结果（不可用或超时时返回 null，回退到上传整段录音）
+function finishLiveTranscription(session, timeoutMs = 3000) {
+    return new Promise((resolve) => {
+        let finished = false;
+        const finish = (result) => {
+            if (finished) return;
+            finished = true;
+            clearTimeout(timer);
+            if (session.processor) {
+                session.processor.disconnect();
+                session.source.disconnect();
+                session.context.close();
+            }
+            session.socket.close();
+            resolve(result);
+        };
+        const timer = setTimeout(() => finish(null), timeoutMs);
+        if (!session.ready) {
+            finish(null);
+            return;
+        }
+        session.ready = false; // 停止发送音频
+        session.onFinal = finish;
+        session.socket.send(JSON.stringify({ type: 'stop' }));
+    });
+}
+
 // 转录音频
 async function transcribeAudio(audioBlob) {
     const formData = new FormData();
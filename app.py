@@ -3,16 +3,16 @@
 TimeFlow MVP - 语音时间记录应用
 FastAPI 后端服务
 """
-from fastapi import FastAPI, File, UploadFile, Form, Request, HTTPException
+from fastapi import FastAPI, File, UploadFile, Form, Request, HTTPException, Query, WebSocket, WebSocketDisconnect
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from openai import OpenAI
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
 import os
+import sys
 import json
-import requests
 from datetime import datetime, timedelta
 from typing import Optional, List
 import logging
@@ -20,8 +20,23 @@ import httpx
 import tempfile
 import subprocess
 import re
-from collections import Counter
-import re
+import uuid
+import time
+import asyncio
+import threading
+import queue
+import hashlib
+import string
+import copy
+import sqlite3
+import bisect
+import base64
+import io
+import math
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from collections import Counter, deque, OrderedDict
 
 
 def normalize_transcript_text(text: str) -> str:
@@ -83,9 +98,15 @@ def format_note_entry(event: dict) -> str:
     return f"{header}\n{activity}".strip()
 
 
+# 备忘录名称 -> 备忘录ID（第一次按名称查到后缓存，之后直接按ID追加）
+notes_id_cache = {}
+notes_id_cache_lock = threading.Lock()
+
+
 def append_to_notes_via_applescript(note_name: str, text_to_append: str) -> dict:
     """
     追加文本到 Apple Notes 的指定备忘录（按“名称”匹配）。
+    - 已缓存备忘录ID时直接按ID追加；ID 失效（备忘录被删除）时重新按名称查询
     - 若找不到同名备忘录，则在第一个账户的第一个文件夹创建
     - Notes 的 body 是 HTML，这里会把换行转成 <br>
     """
@@ -95,44 +116,27 @@ def append_to_notes_via_applescript(note_name: str, text_to_append: str) -> dict
         if not text_to_append:
             return {"success": True, "message": "无需写入备忘录（内容为空）"}
 
-        note_name_escaped = escape_apple_script(note_name)
         html_body = escape_html(text_to_append)
-        html_body_escaped = escape_apple_script(html_body)
-
-        commands = [
-            'tell application "Notes"',
-            'set targetNote to missing value',
-            'set targetFolder to missing value',
-            'set targetAccount to missing value',
-            'if (count of accounts) = 0 then error "未找到 Notes 账户"',
-            'set targetAccount to item 1 of accounts',
-            'if (count of folders of targetAccount) = 0 then error "未找到 Notes 文件夹"',
-            'set targetFolder to item 1 of folders of targetAccount',
-            'repeat with acc in accounts',
-            'repeat with fol in folders of acc',
-            'repeat with n in notes of fol',
-            f'if name of n is "{note_name_escaped}" then set targetNote to n',
-            'if targetNote is not missing value then exit repeat',
-            'end repeat',
-            'if targetNote is not missing value then exit repeat',
-            'end repeat',
-            'if targetNote is not missing value then exit repeat',
-            'end repeat',
-            'if targetNote is missing value then',
-            f'set targetNote to make new note at targetFolder with properties {{name:"{note_name_escaped}", body:""}}',
-            'end if',
-            'set oldBody to body of targetNote',
-            f'set newBody to oldBody & "<br><br>{html_body_escaped}"',
-            'set body of targetNote to newBody',
-            'return "success"',
-            'end tell',
-        ]
-
-        escaped_commands = [c.replace("'", "'\\''") for c in commands]
-        cmd = "osascript " + " ".join([f"-e '{c}'" for c in escaped_commands])
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=30)
+        with notes_id_cache_lock:
+            note_id = notes_id_cache.get(note_name)
+        if note_id:
+            result = run_applescript(NOTES_APPEND_BY_ID_SCRIPT, [note_id, html_body], timeout=30)
+            if result.returncode == 0:
+                return {"success": True, "message": "已追加到备忘录"}
+            error_msg = (result.stderr or result.stdout or "").strip()
+            if not is_missing_object_error(error_msg):
+                return {"success": False, "error": error_msg or "Notes AppleScript 执行失败"}
+            # 缓存的ID已失效，重新按名称查询
+            logger.info(f"备忘录 '{note_name}' 的缓存ID已失效，重新查询")
+            with notes_id_cache_lock:
+                notes_id_cache.pop(note_name, None)
+
+        result = run_applescript(NOTES_APPEND_SCRIPT, [note_name, html_body], timeout=30)
         if result.returncode != 0:
             return {"success": False, "error": (result.stderr or result.stdout or "Notes AppleScript 执行失败").strip()}
+        if result.stdout.strip():
+            with notes_id_cache_lock:
+                notes_id_cache[note_name] = result.stdout.strip()
         return {"success": True, "message": "已追加到备忘录"}
     except subprocess.TimeoutExpired:
         return {"success": False, "error": "写入备忘录超时"}
@@ -146,11 +150,18 @@ logger = logging.getLogger(__name__)
 # Faster Whisper (可选，如果安装了)
 try:
     from faster_whisper import WhisperModel
+    from faster_whisper import decode_audio as faster_whisper_decode_audio
     FASTER_WHISPER_AVAILABLE = True
 except ImportError:
     FASTER_WHISPER_AVAILABLE = False
     logger.warning("Faster Whisper 未安装，本地转录功能不可用。安装: pip install faster-whisper")
 
+# NumPy（可选，实时转录的音频缓冲使用）
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # 加载环境变量
 load_dotenv()
 
@@ -170,30 +181,94 @@ api_key = os.getenv("SUPER_MIND_API_KEY") or os.getenv("AI_BUILDER_TOKEN")
 if not api_key:
     raise ValueError("请设置 SUPER_MIND_API_KEY 或 AI_BUILDER_TOKEN 环境变量")
 
+# HTTP 连接池配置（所有 LLM 调用共享 keep-alive 连接，避免阻塞事件循环）
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))  # 每个客户端最大并发连接数
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "10"))  # 保持的空闲连接数
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))  # 空闲连接保留秒数
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))  # LLM 请求超时（秒）
+
+
+def create_async_http_client(timeout: float = LLM_TIMEOUT) -> httpx.AsyncClient:
+    """创建带连接池和 keep-alive 的异步 HTTP 客户端"""
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(timeout, connect=10.0),
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+
 # 初始化 OpenAI 客户端（用于 AI Builder API）
-# 使用 httpx 客户端来避免版本兼容问题
-import httpx
-client = OpenAI(
+# 使用共享的 httpx.AsyncClient 连接池，调用不会阻塞其他请求
+SUPERMIND_API_URL = "https://space.ai-builders.com/backend/v1"
+client = AsyncOpenAI(
     api_key=api_key,
-    base_url="https://space.ai-builders.com/backend/v1",
-    http_client=httpx.Client()
+    base_url=SUPERMIND_API_URL,
+    http_client=create_async_http_client()
 )
 
 # API 配置
 TRANSCRIPTION_API_URL = "https://space.ai-builders.com/backend/v1/audio/transcriptions"
+STT_UPLOAD_CHUNK_SIZE = int(os.getenv("STT_UPLOAD_CHUNK_SIZE", str(64 * 1024)))  # 云端 STT 流式上传分块大小（字节）
+STT_TIMEOUT = float(os.getenv("STT_TIMEOUT", "60"))  # 云端 STT 请求超时（秒）
 TIME_LOG_FILE = "data/time_log.json"
 RECENT_EVENT_FILE = "data/recent_event.json"  # 存储最近写入的事件信息（用于快速撤回）
-EVENT_HISTORY_FILE = "data/event_history.json"  # 存储所有历史事件记录（每次操作 append）
+EVENT_HISTORY_FILE = "data/event_history.json"  # 历史事件记录的导出格式（旧版存储，首次启动时迁移）
 TAGS_FILE = "data/tags.json"  # 存储标签配置（用户自定义标签）
+OPERATION_LOG_FILE = "data/event_history.jsonl"  # JSON 后端的追加写操作日志（替代 event_history.json）
+TRANSCRIPT_CACHE_FILE = "data/transcript_cache.jsonl"  # 音频指纹 -> 转录结果（可选持久化）
+
+# 存储后端配置（sqlite：WAL 模式的 SQLite 数据库；json：原有的 data/*.json 文件）
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite").lower()
+DATABASE_FILE = os.getenv("DATABASE_FILE", "data/timeflow.db")  # SQLite 数据库文件（首次启动时自动从 JSON 文件迁移）
+OPLOG_FSYNC_BATCH = int(os.getenv("OPLOG_FSYNC_BATCH", "16"))  # 操作日志累计多少次写入后 fsync
+OPLOG_FSYNC_INTERVAL = float(os.getenv("OPLOG_FSYNC_INTERVAL", "1.0"))  # 操作日志至少每隔多少秒 fsync 一次
+OPLOG_COMPACT_INTERVAL = float(os.getenv("OPLOG_COMPACT_INTERVAL", "600"))  # 后台压缩检查间隔（秒）
+OPLOG_COMPACT_MIN_UNDONE = int(os.getenv("OPLOG_COMPACT_MIN_UNDONE", "32"))  # 累计多少次撤回后才压缩
+
+# AppleScript 执行器配置（auto：macOS 使用常驻 osascript 进程池；subprocess：每次调用启动 osascript；null：不执行，仅用于测试）
+APPLESCRIPT_RUNNER = os.getenv("APPLESCRIPT_RUNNER", "auto").lower()
+APPLESCRIPT_WORKERS = int(os.getenv("APPLESCRIPT_WORKERS", "2"))  # 常驻进程数量
+APPLESCRIPT_TIMEOUT = float(os.getenv("APPLESCRIPT_TIMEOUT", "10"))  # 默认单次调用超时（秒）
+
+# 后台任务队列配置（日历 / 备忘录写入）
+JOBS_DATABASE_FILE = os.getenv("JOBS_DATABASE_FILE", "data/jobs.db")  # 任务持久化（SQLite）
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", "1"))  # 同时执行的任务数（日历写入建议串行）
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))  # 最多执行次数（含首次）
+JOB_RETRY_BASE_DELAY = float(os.getenv("JOB_RETRY_BASE_DELAY", "2"))  # 重试退避基数（秒，按 2^n 增长）
+JOB_RETRY_MAX_DELAY = float(os.getenv("JOB_RETRY_MAX_DELAY", "60"))  # 重试退避上限（秒）
+CALENDAR_BACKGROUND_DEFAULT = os.getenv("CALENDAR_BACKGROUND_DEFAULT", "true").lower() == "true"  # /api/calendar/add 默认放入后台队列
+
+# 音频指纹去重缓存配置（相同录音重复上传时直接返回转录结果）
+STT_CACHE_ENABLED = os.getenv("STT_CACHE_ENABLED", "true").lower() == "true"
+STT_CACHE_MAX_ENTRIES = int(os.getenv("STT_CACHE_MAX_ENTRIES", "1024"))
+STT_CACHE_MAX_BYTES = int(os.getenv("STT_CACHE_MAX_BYTES", str(4 * 1024 * 1024)))  # 缓存占用内存上限（字节）
+STT_CACHE_PERSIST = os.getenv("STT_CACHE_PERSIST", "false").lower() == "true"  # 是否持久化到 data/
 
 # 确保数据目录存在
 os.makedirs("data", exist_ok=True)
 
-# Faster Whisper 模型（懒加载，备用）
-whisper_model = None
+# Faster Whisper 模型（备用）
 # 根据基准测试，tiny 是最快的模型（0.3秒），推荐用于实时场景
 WHISPER_MODEL_SIZE = os.getenv("WHISPER_MODEL_SIZE", "tiny")  # tiny, base, small, medium, large
 USE_LOCAL_STT = os.getenv("USE_LOCAL_STT", "false").lower() == "true"  # 是否使用本地 STT（Faster Whisper）
+# 启动时在后台加载并预热模型（默认：使用本地 STT 时预加载，否则在第一次本地转录时加载）
+WHISPER_PRELOAD = os.getenv("WHISPER_PRELOAD", str(USE_LOCAL_STT)).lower() == "true"
+WHISPER_POOL_SIZE = int(os.getenv("WHISPER_POOL_SIZE", "1"))  # 模型实例数
+WHISPER_NUM_WORKERS = int(os.getenv("WHISPER_NUM_WORKERS", "1"))  # 每个实例可同时解码的请求数（CTranslate2 num_workers）
+WHISPER_CPU_THREADS = int(os.getenv("WHISPER_CPU_THREADS", "0"))  # 每个实例的推理线程数（0 = CTranslate2 默认）
+WHISPER_COMPUTE_TYPE = os.getenv("WHISPER_COMPUTE_TYPE", "int8")  # int8, int8_float32, float32 等
+WHISPER_BEAM_SIZE = int(os.getenv("WHISPER_BEAM_SIZE", "5"))  # 1 = 贪心解码（最快）
+WHISPER_QUEUE_SIZE = int(os.getenv("WHISPER_QUEUE_SIZE", "4"))  # 解码线程全忙时最多排队的请求数，超过返回 429
+WHISPER_TIMEOUT = float(os.getenv("WHISPER_TIMEOUT", "60"))  # 单个请求的截止时间（秒，含排队）
+
+# 实时转录（/ws/transcribe）配置
+LIVE_STT_WINDOW_SECONDS = float(os.getenv("LIVE_STT_WINDOW_SECONDS", "12"))  # 未确定音频的最大长度（滑动窗口）
+LIVE_STT_PARTIAL_INTERVAL = float(os.getenv("LIVE_STT_PARTIAL_INTERVAL", "1.0"))  # 每新增多少秒语音返回一次临时结果
+LIVE_STT_VAD_THRESHOLD = float(os.getenv("LIVE_STT_VAD_THRESHOLD", "0.01"))  # 语音帧的最小 RMS 能量
+LIVE_STT_SILENCE_SECONDS = float(os.getenv("LIVE_STT_SILENCE_SECONDS", "0.5"))  # 多长的静音视为停顿
 
 # Ollama 配置
 OLLAMA_API_URL = os.getenv("OLLAMA_API_URL", "http://localhost:11434")
@@ -207,104 +282,568 @@ DOUBAO_API_KEY = os.getenv("DOUBAO_API_KEY")  # 必须从环境变量读取，
 DOUBAO_MODEL = os.getenv("DOUBAO_MODEL", "doubao-seed-1-6-251015")
 USE_DOUBAO = os.getenv("USE_DOUBAO", "true").lower() == "true"  # 默认使用豆包模型
 
+# 流式调用 LLM：边接收边解析 JSON 数组，每个时间块对象结束时立即验证和后处理
+LLM_STREAMING = os.getenv("LLM_STREAMING", "true").lower() == "true"
+
+# LLM 竞速（对冲请求）配置：主 provider 超过 p95 延迟仍未返回时，启动下一个 provider
+LLM_RACE_MODE = os.getenv("LLM_RACE_MODE", "false").lower() == "true"
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "3.0"))  # 样本不足时的默认对冲延迟（秒）
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "0.5"))
+LLM_HEDGE_MAX_DELAY = float(os.getenv("LLM_HEDGE_MAX_DELAY", "10.0"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "5"))  # 计算 p95 所需的最少样本数
+LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", "100"))  # 每个 provider 保留的耗时样本数
+
+# Provider 熔断器配置：错误率超过阈值时熔断，冷却后进入半开状态试探
+CIRCUIT_FAILURE_RATE = float(os.getenv("CIRCUIT_FAILURE_RATE", "0.5"))  # 触发熔断的错误率
+CIRCUIT_WINDOW_SECONDS = float(os.getenv("CIRCUIT_WINDOW_SECONDS", "60"))  # 错误率统计窗口（秒）
+CIRCUIT_MIN_REQUESTS = int(os.getenv("CIRCUIT_MIN_REQUESTS", "3"))  # 窗口内最少请求数（不足时不熔断）
+CIRCUIT_COOLDOWN_SECONDS = float(os.getenv("CIRCUIT_COOLDOWN_SECONDS", "30"))  # 熔断后冷却时间（秒）
+
+# 分析结果缓存配置（相同转录文本在同一时间段内直接返回缓存结果）
+ANALYZE_CACHE_ENABLED = os.getenv("ANALYZE_CACHE_ENABLED", "true").lower() == "true"
+ANALYZE_CACHE_MAX_ENTRIES = int(os.getenv("ANALYZE_CACHE_MAX_ENTRIES", "256"))
+ANALYZE_CACHE_TTL = float(os.getenv("ANALYZE_CACHE_TTL", "600"))  # 缓存有效期（秒）
+ANALYZE_CACHE_TIME_BUCKET = int(os.getenv("ANALYZE_CACHE_TIME_BUCKET", "300"))  # 时间分桶（秒），相对时间依赖当前时间
+
+# Prompt 布局：inline（时间直接写在 Prompt 各处）或 prefix_cache
+# prefix_cache：System Prompt 中的时间替换为占位符，实际时间放在 User Prompt 末尾，
+# 使 System Prompt（说明 + 标签规则）在请求之间保持不变，命中 provider 的前缀缓存
+PROMPT_LAYOUT = os.getenv("PROMPT_LAYOUT", "inline").lower()
+
+# 快速路径：简单的句子用规则解析，置信度达到阈值时不调用 LLM
+FAST_PATH_ENABLED = os.getenv("FAST_PATH_ENABLED", "true").lower() == "true"
+FAST_PATH_MIN_CONFIDENCE = float(os.getenv("FAST_PATH_MIN_CONFIDENCE", "0.8"))  # 低于该置信度时回退到 LLM
+
 # 如果使用豆包模型但未提供 API key，给出警告（不强制，因为可能使用其他模型）
 if USE_DOUBAO and not DOUBAO_API_KEY:
     logger.warning("⚠️  DOUBAO_API_KEY 未设置，豆包模型将不可用")
 
+# 豆包 / Ollama 共享连接池（每个 provider 独立连接池，互不抢占连接）
+doubao_http_client = create_async_http_client()
+ollama_http_client = create_async_http_client()
+supermind_http_client = create_async_http_client()  # Supermind 流式调用（openai==1.3.0 不支持 stream_options）
+stt_http_client = create_async_http_client(timeout=STT_TIMEOUT)
 
-def get_whisper_model():
-    """懒加载 Whisper 模型"""
-    global whisper_model
-    if whisper_model is None and FASTER_WHISPER_AVAILABLE:
-        try:
-            logger.info(f"加载 Faster Whisper 模型: {WHISPER_MODEL_SIZE}")
-            whisper_model = WhisperModel(WHISPER_MODEL_SIZE, device="cpu", compute_type="int8")
-            logger.info("✅ Faster Whisper 模型加载成功")
-        except Exception as e:
-            logger.error(f"❌ Faster Whisper 模型加载失败: {e}")
-            whisper_model = None
-    return whisper_model
 
+@app.on_event("shutdown")
+async def close_http_clients():
+    """关闭共享的 HTTP 连接池"""
+    await doubao_http_client.aclose()
+    await ollama_http_client.aclose()
+    await supermind_http_client.aclose()
+    await stt_http_client.aclose()
+    await client.close()
 
-# Prompt 模板缓存
-_system_prompt_template = None
-_user_prompt_template = None
 
+class ProviderUnavailableError(Exception):
+    """Provider 处于熔断状态，调用被跳过"""
 
-def load_prompts_from_file():
-    """从 prompts.md 文件加载 prompt 模板"""
-    global _system_prompt_template, _user_prompt_template
-    
-    if _system_prompt_template is not None and _user_prompt_template is not None:
-        return _system_prompt_template, _user_prompt_template
-    
-    prompt_file = "prompts.md"
-    if not os.path.exists(prompt_file):
-        logger.warning(f"Prompt 文件 {prompt_file} 不存在，使用默认 prompt")
-        return None, None
-    
+
+class CircuitBreaker:
+    """
+    单个 provider 的熔断器
+    - closed：正常调用，统计窗口内错误率
+    - open：错误率超过阈值后熔断，冷却期内直接跳过
+    - half_open：冷却结束后放行一个试探请求，成功则恢复，失败则重新熔断
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = "closed"
+        self.outcomes = deque()  # (时间戳, 是否成功)
+        self.opened_at = None
+        self.half_open_in_flight = False
+        self.last_error = None
+        self.total_requests = 0
+        self.total_failures = 0
+        self._lock = threading.Lock()
+
+    def _trim(self, now: float):
+        while self.outcomes and now - self.outcomes[0][0] > CIRCUIT_WINDOW_SECONDS:
+            self.outcomes.popleft()
+
+    def _open(self, now: float):
+        self.state = "open"
+        self.opened_at = now
+        self.half_open_in_flight = False
+        logger.warning(f"⚠️  熔断器打开: {self.name}（{CIRCUIT_COOLDOWN_SECONDS:.0f} 秒后试探恢复）")
+
+    def allow_request(self) -> bool:
+        """是否允许调用（open 状态冷却结束后转为 half_open，只放行一个试探请求）"""
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < CIRCUIT_COOLDOWN_SECONDS:
+                    return False
+                self.state = "half_open"
+                logger.info(f"熔断器半开，试探调用: {self.name}")
+            if self.state == "half_open":
+                if self.half_open_in_flight:
+                    return False
+                self.half_open_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            now = time.monotonic()
+            self.total_requests += 1
+            if self.state == "half_open":
+                logger.info(f"✅ 熔断器恢复: {self.name}")
+                self.state = "closed"
+                self.outcomes.clear()
+                self.half_open_in_flight = False
+            self.outcomes.append((now, True))
+            self._trim(now)
+
+    def record_failure(self, error: str = None):
+        with self._lock:
+            now = time.monotonic()
+            self.total_requests += 1
+            self.total_failures += 1
+            self.last_error = (error or "")[:200]
+            if self.state == "half_open":
+                self._open(now)
+                return
+            self.outcomes.append((now, False))
+            self._trim(now)
+            failures = sum(1 for _, ok in self.outcomes if not ok)
+            if (self.state == "closed" and len(self.outcomes) >= CIRCUIT_MIN_REQUESTS
+                    and failures / len(self.outcomes) >= CIRCUIT_FAILURE_RATE):
+                self._open(now)
+
+    def release(self):
+        """调用被取消（既不算成功也不算失败），释放半开试探名额"""
+        with self._lock:
+            self.half_open_in_flight = False
+
+    def snapshot(self) -> dict:
+        """熔断器当前状态（用于健康检查接口）"""
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            failures = sum(1 for _, ok in self.outcomes if not ok)
+            retry_in = None
+            if self.state == "open":
+                retry_in = round(max(0.0, CIRCUIT_COOLDOWN_SECONDS - (now - self.opened_at)), 1)
+            return {
+                "state": self.state,
+                "window_requests": len(self.outcomes),
+                "window_failures": failures,
+                "failure_rate": round(failures / len(self.outcomes), 3) if self.outcomes else 0.0,
+                "retry_in_seconds": retry_in,
+                "total_requests": self.total_requests,
+                "total_failures": self.total_failures,
+                "last_error": self.last_error,
+            }
+
+
+provider_breakers = {
+    name: CircuitBreaker(name)
+    for name in ("doubao", "supermind", "ollama", "cloud_stt", "faster_whisper")
+}
+
+
+class LRUCache:
+    """
+    线程安全的 LRU 缓存
+    - max_entries：最大条目数
+    - ttl_seconds：条目有效期（None 表示不过期）
+    - max_bytes + sizeof：按估算大小限制总内存
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: Optional[float] = None,
+                 max_bytes: Optional[int] = None, sizeof=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self._entries = OrderedDict()  # key -> (过期时间, 大小, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, _, value = entry
+            if expires_at is not None and time.monotonic() >= expires_at:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            expires_at = time.monotonic() + self.ttl_seconds if self.ttl_seconds else None
+            self._entries[key] = (expires_at, size, value)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or (
+                    self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def items(self) -> list:
+        """返回未过期的 (key, value) 列表（从旧到新）"""
+        with self._lock:
+            now = time.monotonic()
+            return [(key, value) for key, (expires_at, _, value) in self._entries.items()
+                    if expires_at is None or now < expires_at]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+# 转录文本 -> 时间块 的分析结果缓存
+analysis_cache = LRUCache(ANALYZE_CACHE_MAX_ENTRIES, ttl_seconds=ANALYZE_CACHE_TTL)
+
+# 音频指纹 -> 转录结果 的去重缓存（按估算内存大小限制）
+transcript_cache = LRUCache(
+    STT_CACHE_MAX_ENTRIES,
+    max_bytes=STT_CACHE_MAX_BYTES,
+    sizeof=lambda value: len(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+)
+_transcript_cache_file_lock = threading.Lock()
+
+
+def load_transcript_cache():
+    """从 data/ 加载持久化的转录缓存（文件过大时顺便压缩）"""
+    if not STT_CACHE_PERSIST or not os.path.exists(TRANSCRIPT_CACHE_FILE):
+        return
+    line_count = 0
     try:
-        with open(prompt_file, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        # 提取 System Prompt（在 "## System Prompt" 和 "---" 之间的代码块）
-        system_match = re.search(
-            r'## System Prompt.*?```markdown\n(.*?)```',
-            content,
-            re.DOTALL
-        )
-        if system_match:
-            _system_prompt_template = system_match.group(1).strip()
-            logger.info("✅ 已加载 System Prompt 模板")
-        else:
-            logger.warning("未找到 System Prompt，使用默认 prompt")
-        
-        # 提取 User Prompt（在 "## User Prompt" 和 "---" 之间的代码块）
-        user_match = re.search(
-            r'## User Prompt.*?```markdown\n(.*?)```',
-            content,
-            re.DOTALL
-        )
-        if user_match:
-            _user_prompt_template = user_match.group(1).strip()
-            logger.info("✅ 已加载 User Prompt 模板")
-        else:
-            logger.warning("未找到 User Prompt，使用默认 prompt")
-        
-        return _system_prompt_template, _user_prompt_template
-    
+        with open(TRANSCRIPT_CACHE_FILE, 'r', encoding='utf-8') as f:
+            for line in f:
+                line_count += 1
+                try:
+                    record = json.loads(line)
+                    transcript_cache.set(record["key"], record["result"])
+                except Exception:
+                    continue
+        # 追加写入会累积重复/已淘汰的条目，超过上限两倍时重写
+        if line_count > STT_CACHE_MAX_ENTRIES * 2:
+            with _transcript_cache_file_lock:
+                tmp_path = TRANSCRIPT_CACHE_FILE + ".tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    for key, result in transcript_cache.items():
+                        f.write(json.dumps({"key": key, "result": result}, ensure_ascii=False) + "\n")
+                os.replace(tmp_path, TRANSCRIPT_CACHE_FILE)
+        logger.info(f"已加载转录缓存: {len(transcript_cache.items())} 条")
     except Exception as e:
-        logger.error(f"加载 Prompt 文件失败: {e}")
-        return None, None
+        logger.warning(f"加载转录缓存失败: {e}")
 
 
-def get_system_prompt(current_time_str: str) -> str:
-    """获取格式化后的 System Prompt（动态加载标签信息）"""
-    template, _ = load_prompts_from_file()
-    
-    # 加载标签配置，生成标签分类规则
-    tags_config = load_tags_config()
-    tags = tags_config.get("tags", [])
-    
-    # 构建标签分类规则文本（只使用描述）
-    tag_rules = []
-    tag_list = []
-    for tag in tags:
-        tag_name = tag.get("name", "")
-        tag_desc = tag.get("description", "")
-        if tag_name:
-            tag_list.append(tag_name)
-            if tag_desc:
-                tag_rules.append(f"- **{tag_name}**：{tag_desc}")
+def persist_transcript_result(key: str, result: dict):
+    """追加一条转录缓存记录到 data/"""
+    if not STT_CACHE_PERSIST:
+        return
+    try:
+        with _transcript_cache_file_lock:
+            with open(TRANSCRIPT_CACHE_FILE, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({"key": key, "result": result}, ensure_ascii=False) + "\n")
+    except Exception as e:
+        logger.warning(f"保存转录缓存失败: {e}")
+
+
+load_transcript_cache()
+
+
+# 本地转录的音频在内存中解码为 16kHz 单声道 float32 数组后直接交给模型，不写临时文件：
+# - 16kHz 16-bit PCM WAV（网页端和快捷指令录音的常见格式）直接转换采样
+# - 其他格式（m4a/mp3/opus/webm）用 faster-whisper 自带的 PyAV 解码器从 BytesIO 读取（按真实格式识别，
+#   可以 seek，iOS 录音 moov 在文件末尾的 m4a 也能解码）；没有 PyAV 时通过管道调用 ffmpeg
+
+WHISPER_SAMPLE_RATE = 16000  # Faster Whisper 输入采样率
+
+
+def _decode_wav_pcm(content: bytes):
+    """16kHz 16-bit PCM WAV 直接转换为 float32（其他格式返回 None）"""
+    if content[:4] != b"RIFF" or content[8:12] != b"WAVE":
+        return None
+    try:
+        with wave.open(io.BytesIO(content)) as wav:
+            if wav.getsampwidth() != 2 or wav.getframerate() != WHISPER_SAMPLE_RATE:
+                return None
+            channels = wav.getnchannels()
+            frames = wav.readframes(wav.getnframes())
+    except (wave.Error, EOFError):
+        return None
+    audio = np.frombuffer(frames[:len(frames) // (2 * channels) * 2 * channels], dtype="<i2")
+    audio = audio.astype(np.float32) / 32768.0
+    if channels > 1:
+        audio = audio.reshape(-1, channels).mean(axis=1)
+    return audio
+
+
+def _decode_with_ffmpeg(content: bytes):
+    """通过 stdin / stdout 管道调用 ffmpeg 解码"""
+    command = ["ffmpeg", "-nostdin", "-loglevel", "error", "-i", "pipe:0",
+               "-f", "f32le", "-ac", "1", "-ar", str(WHISPER_SAMPLE_RATE), "pipe:1"]
+    try:
+        result = subprocess.run(command, input=content, capture_output=True, timeout=WHISPER_TIMEOUT)
+    except FileNotFoundError:
+        raise Exception("无法解码该音频格式：需要安装 faster-whisper（PyAV）或 ffmpeg")
+    if result.returncode != 0:
+        raise Exception(f"ffmpeg 解码失败: {result.stderr.decode('utf-8', 'replace').strip()[:200]}")
+    return np.frombuffer(result.stdout, dtype=np.float32)
+
+
+def decode_audio_bytes(content: bytes):
+    """把上传的音频解码为 16kHz 单声道 float32 数组（全程在内存中）"""
+    if not content:
+        raise ValueError("音频为空")
+    audio = _decode_wav_pcm(content)
+    if audio is not None:
+        return audio
+    if FASTER_WHISPER_AVAILABLE:
+        return faster_whisper_decode_audio(io.BytesIO(content), sampling_rate=WHISPER_SAMPLE_RATE)
+    return _decode_with_ffmpeg(content)
+
+
+class WhisperBusyError(Exception):
+    """本地转录排队已满（返回 429）"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"本地转录繁忙，请 {retry_after} 秒后重试")
+        self.retry_after = retry_after
+
+
+class WhisperModelManager:
+    """
+    Faster Whisper 模型池
+    - load()：加载 pool_size 个实例并用一段静音预热（线程安全，只加载一次；失败后下次调用重试）
+    - transcribe()：取一个空闲实例解码，每个实例最多同时处理 num_workers 个请求，没有空闲实例时等待
+    - submit()：在专用线程池中调用 transcribe()（供 async 接口使用，推理期间不占用事件循环），
+      排队超过 queue_size 个请求时抛出 WhisperBusyError，超过 timeout 秒抛出 TimeoutError
+    """
+
+    WARMUP_SECONDS = 1.0
+
+    def __init__(self, model_size: str, pool_size: int = 1, num_workers: int = 1, factory=None,
+                 cpu_threads: int = 0, compute_type: str = "int8", beam_size: int = 5,
+                 queue_size: int = 4, timeout: float = 60.0):
+        self.model_size = model_size
+        self.pool_size = max(1, pool_size)
+        self.num_workers = max(1, num_workers)
+        self.cpu_threads = max(0, cpu_threads)
+        self.compute_type = compute_type
+        self.beam_size = max(1, beam_size)
+        self.queue_size = max(0, queue_size)
+        self.timeout = timeout
+        self.workers = self.pool_size * self.num_workers  # 同时解码的请求数上限
+        self._factory = factory  # 测试时替换模型
+        self._load_lock = threading.Lock()
+        self._slots = queue.Queue()
+        self._busy = 0
+        self._pending = 0  # 已提交到线程池、尚未结束的请求（解码中 + 排队中）
+        self._rejected = 0
+        self._timeouts = 0
+        self._avg_seconds = None  # 单次解码耗时（指数移动平均），用于估算 Retry-After
+        self._busy_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="whisper")
+        self._status = "not_loaded"
+        self._error = None
+        self._load_seconds = None
+        self._warmup_seconds = None
+        self._loaded_at = None
+
+    @property
+    def ready(self) -> bool:
+        return self._status == "ready"
+
+    def _create_model(self):
+        if self._factory is not None:
+            return self._factory()
+        return WhisperModel(self.model_size, device="cpu", compute_type=self.compute_type,
+                            cpu_threads=self.cpu_threads, num_workers=self.num_workers)
+
+    def load(self) -> bool:
+        """加载并预热全部实例，返回是否可用"""
+        if self.ready:
+            return True
+        with self._load_lock:
+            if self.ready:
+                return True
+            if self._factory is None and not FASTER_WHISPER_AVAILABLE:
+                self._status = "unavailable"
+                return False
+            self._status = "loading"
+            logger.info(f"加载 Faster Whisper 模型: {self.model_size}（{self.pool_size} 个实例）")
+            started = time.monotonic()
+            try:
+                models = [self._create_model() for _ in range(self.pool_size)]
+                loaded = time.monotonic()
+                if np is not None:
+                    # 第一次解码会初始化推理内核和缓存，预热后第一个请求不再承担这部分耗时
+                    silence = np.zeros(int(WHISPER_SAMPLE_RATE * self.WARMUP_SECONDS), dtype=np.float32)
+                    for model in models:
+                        segments, _ = model.transcribe(silence, beam_size=1)
+                        list(segments)
+            except Exception as e:
+                self._status = "failed"
+                self._error = str(e)
+                logger.error(f"❌ Faster Whisper 模型加载失败: {e}")
+                return False
+            self._load_seconds = round(loaded - started, 3)
+            self._warmup_seconds = round(time.monotonic() - loaded, 3)
+            self._loaded_at = datetime.now().isoformat()
+            self._error = None
+            for _ in range(self.num_workers):
+                for model in models:
+                    self._slots.put(model)
+            self._status = "ready"
+            logger.info(f"✅ Faster Whisper 模型加载成功（加载 {self._load_seconds}s，预热 {self._warmup_seconds}s）")
+            return True
+
+    def transcribe(self, audio, **kwargs) -> tuple:
+        """解码音频（文件路径或 16kHz float32 数组），返回 (片段列表, info)"""
+        if not self.load():
+            raise Exception(f"Faster Whisper 模型未加载: {self._error or '未安装'}")
+        kwargs.setdefault("beam_size", self.beam_size)
+        model = self._slots.get()
+        with self._busy_lock:
+            self._busy += 1
+        try:
+            segments, info = model.transcribe(audio, **kwargs)
+            return list(segments), info
+        finally:
+            with self._busy_lock:
+                self._busy -= 1
+            self._slots.put(model)
+
+    def _run(self, audio, kwargs: dict) -> tuple:
+        started = time.monotonic()
+        result = self.transcribe(audio, **kwargs)
+        elapsed = time.monotonic() - started
+        with self._busy_lock:
+            self._avg_seconds = elapsed if self._avg_seconds is None else 0.8 * self._avg_seconds + 0.2 * elapsed
+        return result
+
+    def _finished(self, _future):
+        with self._busy_lock:
+            self._pending -= 1
+
+    def retry_after(self) -> int:
+        """估算排队清空需要的秒数"""
+        with self._busy_lock:
+            avg, pending = self._avg_seconds or 1.0, self._pending
+        return max(1, math.ceil(avg * pending / self.workers))
+
+    async def submit(self, audio, **kwargs) -> tuple:
+        """在专用线程池中解码，返回 (片段列表, info)"""
+        with self._busy_lock:
+            if self._pending >= self.workers + self.queue_size:
+                self._rejected += 1
+                full = True
             else:
-                tag_rules.append(f"- **{tag_name}**")
-    
-    tag_rules_text = "\n".join(tag_rules)
-    tag_list_text = "、".join(tag_list) if tag_list else "工作、生活、娱乐、运动"
-    
-    if template is None:
-        # Fallback to default hardcoded prompt（使用动态标签）
-        return f"""你是一个时间提取助手。从用户提供的文本中提取时间相关的信息，并返回 JSON 格式的数据。你需要根据用户的描述，帮助用户记录时间，提取出时间块（duration），包括开始时间和结束时间。在两个时间点中间，可能需要一定的适当推理得出这块时间在做什么。
+                self._pending += 1
+                full = False
+        if full:
+            raise WhisperBusyError(self.retry_after())
+        future = self._executor.submit(self._run, audio, kwargs)
+        # 排队中的请求超时或被取消时直接从队列移除；已经开始的解码无法中断，结束后才释放名额
+        future.add_done_callback(self._finished)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            with self._busy_lock:
+                self._timeouts += 1
+            raise TimeoutError(f"本地转录超时（超过 {self.timeout:g} 秒）")
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def status(self) -> dict:
+        with self._busy_lock:
+            busy, pending = self._busy, self._pending
+            rejected, timeouts, avg = self._rejected, self._timeouts, self._avg_seconds
+        return {
+            "status": self._status,
+            "ready": self.ready,
+            "model_size": self.model_size,
+            "pool_size": self.pool_size,
+            "num_workers": self.num_workers,
+            "cpu_threads": self.cpu_threads,
+            "compute_type": self.compute_type,
+            "beam_size": self.beam_size,
+            "busy": busy,
+            "queued": max(0, pending - busy),
+            "queue_size": self.queue_size,
+            "timeout_seconds": self.timeout,
+            "rejected": rejected,
+            "timeouts": timeouts,
+            "avg_decode_seconds": round(avg, 3) if avg is not None else None,
+            "load_seconds": self._load_seconds,
+            "warmup_seconds": self._warmup_seconds,
+            "loaded_at": self._loaded_at,
+            "error": self._error,
+        }
+
+
+whisper_models = WhisperModelManager(
+    WHISPER_MODEL_SIZE, pool_size=WHISPER_POOL_SIZE, num_workers=WHISPER_NUM_WORKERS,
+    cpu_threads=WHISPER_CPU_THREADS, compute_type=WHISPER_COMPUTE_TYPE, beam_size=WHISPER_BEAM_SIZE,
+    queue_size=WHISPER_QUEUE_SIZE, timeout=WHISPER_TIMEOUT,
+)
+
+
+@app.on_event("startup")
+async def preload_whisper_model():
+    """WHISPER_PRELOAD=true 时在后台线程加载并预热模型（不阻塞启动，状态见 /api/health/whisper）"""
+    if WHISPER_PRELOAD and FASTER_WHISPER_AVAILABLE:
+        threading.Thread(target=whisper_models.load, name="whisper-preload", daemon=True).start()
+
+
+@app.on_event("shutdown")
+async def stop_whisper_workers():
+    """取消排队中的本地转录请求"""
+    whisper_models.shutdown()
+
+
+# ==================== Prompt 渲染 ====================
+# prompts.md 中的模板解析一次，编译为 (文本, 变量) 片段：
+# - 标签相关的变量（{tag_rules} / {tag_list}）按标签版本预先填入并缓存
+# - 每次请求只填入时间相关的变量和转录文本
+# - prompts.md 修改后自动重新加载，不需要重启服务
+
+PROMPTS_FILE = "prompts.md"
+
+# prompts.md 不存在或缺少对应代码块时使用的默认模板（变量与 prompts.md 相同）
+DEFAULT_SYSTEM_PROMPT_TEMPLATE = """你是一个时间提取助手。从用户提供的文本中提取时间相关的信息，并返回 JSON 格式的数据。你需要根据用户的描述，帮助用户记录时间，提取出时间块（duration），包括开始时间和结束时间。在两个时间点中间，可能需要一定的适当推理得出这块时间在做什么。
 
 **重要提示**：
 1. 一条文本可能包含多个时间块，必须全部提取，不要遗漏任何时间段
@@ -317,10 +856,10 @@ def get_system_prompt(current_time_str: str) -> str:
 3. **end_time** (结束时间) - 必需，格式：YYYY-MM-DDTHH:MM:SS（ISO 8601，24小时制），如果文本中没有明确时间，根据当前时间和相对时间推断
 4. **location** (地点) - 可选，如果文本中提到地点则提取
 5. **description** (详细描述) - 可选，可以包含原始文本或额外信息
-6. **tag** (标签分类) - 必需，根据活动内容自动分类为以下标签之一：**{tag_list_text}**
+6. **tag** (标签分类) - 必需，根据活动内容自动分类为以下标签之一：**{tag_list}**
 
 **标签分类规则**：
-{tag_rules_text}
+{tag_rules}
 
 **标签判断方法**：
 - 根据 activity 和 description 的内容，结合标签描述进行判断
@@ -367,26 +906,8 @@ def get_system_prompt(current_time_str: str) -> str:
 5. **地点提取**：如果文本提到地点（如"在公司"、"在家"、"咖啡厅"），提取到 location 字段
 
 6. **避免过度分割**：只提取有意义的时间块，不要将"到达"、"开始"等瞬间动作单独提取。但如果文本明确提到多个时间段，必须全部提取"""
-    
-    # 如果模板中包含 {tag_rules} 或 {tag_list}，替换它们
-    if template:
-        template = template.replace("{tag_rules}", tag_rules_text)
-        template = template.replace("{tag_list}", tag_list_text)
-    
-    return template.format(current_time_str=current_time_str)
-
 
-def get_user_prompt(transcript: str, current_time_str: str, current_time_iso: str, 
-                     current_dt: datetime, past_30min_str: str) -> str:
-    """获取格式化后的 User Prompt"""
-    _, template = load_prompts_from_file()
-    
-    # 预先计算日期字符串（避免在模板中使用 Python 代码）
-    current_date_str = current_dt.strftime('%Y-%m-%d')
-    
-    if template is None:
-        # 使用默认 prompt（向后兼容）
-        return f"""从以下文本中提取时间信息，只返回 JSON 数组，不要有任何其他文字：
+DEFAULT_USER_PROMPT_TEMPLATE = """从以下文本中提取时间信息，只返回 JSON 数组，不要有任何其他文字：
 
 文本：{transcript}
 
@@ -407,8 +928,8 @@ def get_user_prompt(transcript: str, current_time_str: str, current_time_iso: st
   - 时间点：8点，9点，9点半
   - 时间段1（8点-9点）：通勤/去咖啡厅，地点：咖啡厅
   - 时间段2（9点-9点半）：学习，地点：咖啡厅
-  - 结果：[{{"activity": "通勤/去咖啡厅", "start_time": "{current_date_str}T08:00:00", "end_time": "{current_date_str}T09:00:00", "location": "咖啡厅"}},
-         {{"activity": "学习", "start_time": "{current_date_str}T09:00:00", "end_time": "{current_date_str}T09:30:00", "location": "咖啡厅"}}]
+  - 结果：[{{"activity": "通勤/去咖啡厅", "start_time": "{current_date}T08:00:00", "end_time": "{current_date}T09:00:00", "location": "咖啡厅"}},
+         {{"activity": "学习", "start_time": "{current_date}T09:00:00", "end_time": "{current_date}T09:30:00", "location": "咖啡厅"}}]
 
 - 示例2：文本"刚刚半小时我在吃饭"
   - 时间点：半小时前（{past_30min_str}），现在（{current_time_iso}）
@@ -420,21 +941,240 @@ def get_user_prompt(transcript: str, current_time_str: str, current_time_iso: st
 2. **相对时间计算**：相对时间的结束时间必须是当前时间（{current_time_iso}），不是未来时间
 
 只返回 JSON 数组，格式：[{{"activity": "...", "start_time": "...", "end_time": "...", "location": "..."}}]"""
-    
-    # 替换模板变量
-    # 注意：模板中使用 {transcript} 而不是 {request.transcript}
-    # 如果模板中有 {current_dt.strftime('%Y-%m-%d')}，需要先替换为计算好的日期字符串
-    if template and '{current_dt.strftime' in template:
-        # 替换模板中的 Python 代码为实际值
-        template = template.replace('{current_dt.strftime(\'%Y-%m-%d\')}', current_date_str)
-    
-    return template.format(
+
+# 旧模板中直接写 Python 表达式的变量，编译时映射到预先计算的变量
+PROMPT_FIELD_ALIASES = {
+    "current_dt.strftime('%Y-%m-%d')": "current_date",
+}
+
+# prefix_cache 布局下时间变量在模板中的占位符（实际值见 User Prompt 末尾的时间信息）
+PROMPT_TIME_PLACEHOLDERS = {
+    "current_time_str": "<当前时间>",
+    "current_time_iso": "<当前时间ISO>",
+    "current_date": "<当前日期>",
+    "current_dt": "<当前时间>",
+    "past_30min_str": "<30分钟前>",
+}
+
+
+def build_prompt_time_section(values: dict) -> str:
+    """prefix_cache 布局：追加在 User Prompt 末尾的时间信息"""
+    lines = ["", "", "---", "**时间信息**（上文中的占位符按以下数值理解）："]
+    for field in ("current_time_str", "current_time_iso", "current_date", "past_30min_str"):
+        if field in values:
+            lines.append(f"- {PROMPT_TIME_PLACEHOLDERS[field]} = {values[field]}")
+    return "\n".join(lines)
+
+
+class CompiledPromptTemplate:
+    """
+    编译后的模板：由 string.Formatter 解析为 [(文本, 变量名, 格式), ...]
+    渲染时只拼接片段，不再重新解析整个模板
+    """
+
+    _formatter = string.Formatter()
+
+    def __init__(self, parts: list):
+        self.parts = parts
+        self.fields = {field for _, field, _, _ in parts if field is not None}
+
+    @classmethod
+    def compile(cls, source: str) -> "CompiledPromptTemplate":
+        parts = []
+        for literal, field, spec, conversion in cls._formatter.parse(source):
+            if field is not None:
+                field = PROMPT_FIELD_ALIASES.get(field, field)
+            parts.append((literal, field, spec or "", conversion))
+        return cls(parts)
+
+    def _format_value(self, value, spec: str, conversion: Optional[str]) -> str:
+        if conversion:
+            value = self._formatter.convert_field(value, conversion)
+        return format(value, spec)
+
+    def partial(self, **values) -> "CompiledPromptTemplate":
+        """填入部分变量，返回新的模板（相邻文本合并，其余变量保留）"""
+        parts = []
+        pending = ""
+        for literal, field, spec, conversion in self.parts:
+            pending += literal
+            if field is None:
+                continue
+            if field in values:
+                pending += self._format_value(values[field], spec, conversion)
+            else:
+                parts.append((pending, field, spec, conversion))
+                pending = ""
+        if pending:
+            parts.append((pending, None, "", None))
+        return CompiledPromptTemplate(parts)
+
+    def render(self, **values) -> str:
+        """填入所有变量；模板中未知的变量原样保留"""
+        chunks = []
+        for literal, field, spec, conversion in self.parts:
+            chunks.append(literal)
+            if field is None:
+                continue
+            if field in values:
+                chunks.append(self._format_value(values[field], spec, conversion))
+            else:
+                chunks.append("{" + field + "}")
+        return "".join(chunks)
+
+
+def build_tag_prompt_fields(tags: list) -> dict:
+    """由标签配置生成 Prompt 中的 {tag_rules} / {tag_list}（只使用描述）"""
+    tag_rules = []
+    tag_list = []
+    for tag in tags:
+        tag_name = tag.get("name", "")
+        tag_desc = tag.get("description", "")
+        if tag_name:
+            tag_list.append(tag_name)
+            if tag_desc:
+                tag_rules.append(f"- **{tag_name}**：{tag_desc}")
+            else:
+                tag_rules.append(f"- **{tag_name}**")
+    return {
+        "tag_rules": "\n".join(tag_rules),
+        "tag_list": "、".join(tag_list) if tag_list else "工作、生活、娱乐、运动",
+    }
+
+
+class PromptRenderer:
+    """
+    Prompt 渲染器
+    - 按 prompts.md 的修改标记（mtime + 大小）热重载模板
+    - System Prompt 的标签部分按 (模板版本, 标签版本) 缓存
+    - prefix_cache 布局下 System Prompt 不含时间，整段缓存，时间追加在 User Prompt 末尾
+    """
+
+    def __init__(self, path: str = PROMPTS_FILE, layout: str = PROMPT_LAYOUT):
+        self.path = path
+        self.layout = layout
+        self._lock = threading.RLock()
+        self._stamp = False  # False 表示尚未加载（None 表示文件不存在）
+        self.system_source = None
+        self.user_source = None
+        self.system_template = None
+        self.user_template = None
+        self.templates_hash = ""
+        self.version = 0
+        self._system_cache = None  # (模板版本, 标签版本, 填入标签后的模板, prefix_cache 布局下的完整文本)
+
+    def _file_stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _parse_file(self) -> tuple:
+        """从 prompts.md 提取 System / User Prompt 代码块"""
+        if not os.path.exists(self.path):
+            logger.warning(f"Prompt 文件 {self.path} 不存在，使用默认 prompt")
+            return None, None
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                content = f.read()
+        except Exception as e:
+            logger.error(f"加载 Prompt 文件失败: {e}")
+            return None, None
+        
+        # 提取 System Prompt（在 "## System Prompt" 之后的 markdown 代码块）
+        system_match = re.search(r'## System Prompt.*?```markdown\n(.*?)```', content, re.DOTALL)
+        if system_match:
+            logger.info("✅ 已加载 System Prompt 模板")
+        else:
+            logger.warning("未找到 System Prompt，使用默认 prompt")
+        
+        # 提取 User Prompt（在 "## User Prompt" 之后的 markdown 代码块）
+        user_match = re.search(r'## User Prompt.*?```markdown\n(.*?)```', content, re.DOTALL)
+        if user_match:
+            logger.info("✅ 已加载 User Prompt 模板")
+        else:
+            logger.warning("未找到 User Prompt，使用默认 prompt")
+        
+        return (system_match.group(1).strip() if system_match else None,
+                user_match.group(1).strip() if user_match else None)
+
+    def _ensure_loaded(self):
+        stamp = self._file_stamp()
+        if stamp == self._stamp:
+            return
+        with self._lock:
+            if stamp == self._stamp:
+                return
+            if self._stamp is not False:
+                logger.info(f"检测到 {self.path} 已修改，重新加载 Prompt 模板")
+            self.system_source, self.user_source = self._parse_file()
+            self.system_template = CompiledPromptTemplate.compile(self.system_source or DEFAULT_SYSTEM_PROMPT_TEMPLATE)
+            self.user_template = CompiledPromptTemplate.compile(self.user_source or DEFAULT_USER_PROMPT_TEMPLATE)
+            content = f"{self.layout}\n---\n{self.system_source}\n---\n{self.user_source}"
+            self.templates_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+            self._system_cache = None
+            self._stamp = stamp
+            self.version += 1
+
+    def sources(self) -> tuple:
+        """prompts.md 中的原始模板文本（缺少时为 None）"""
+        self._ensure_loaded()
+        return self.system_source, self.user_source
+
+    def get_templates_hash(self) -> str:
+        self._ensure_loaded()
+        return self.templates_hash
+
+    def _system_with_tags(self) -> tuple:
+        """填入标签部分的 System Prompt（标签或模板变化后重新生成）"""
+        self._ensure_loaded()
+        tags_version = tag_registry.version
+        cached = self._system_cache
+        if cached and cached[0] == self.version and cached[1] == tags_version:
+            return cached
+        with self._lock:
+            template = self.system_template.partial(**build_tag_prompt_fields(tag_registry.tags()))
+            self._system_cache = (self.version, tags_version, template, template.render(**PROMPT_TIME_PLACEHOLDERS))
+            return self._system_cache
+
+    def render_system(self, current_time_str: str) -> str:
+        _, _, template, static_text = self._system_with_tags()
+        if self.layout == "prefix_cache":
+            return static_text
+        return template.render(current_time_str=current_time_str)
+
+    def render_user(self, **values) -> str:
+        self._ensure_loaded()
+        if self.layout == "prefix_cache":
+            placeholders = {**values, **{k: v for k, v in PROMPT_TIME_PLACEHOLDERS.items() if k in values}}
+            return self.user_template.render(**placeholders) + build_prompt_time_section(values)
+        return self.user_template.render(**values)
+
+
+prompt_renderer = PromptRenderer()
+
+
+def load_prompts_from_file():
+    """从 prompts.md 文件加载 prompt 模板（文件修改后自动重新加载）"""
+    return prompt_renderer.sources()
+
+
+def get_system_prompt(current_time_str: str) -> str:
+    """获取格式化后的 System Prompt（标签部分按标签版本缓存，每次只填入当前时间）"""
+    return prompt_renderer.render_system(current_time_str)
+
+
+def get_user_prompt(transcript: str, current_time_str: str, current_time_iso: str, 
+                     current_dt: datetime, past_30min_str: str) -> str:
+    """获取格式化后的 User Prompt"""
+    return prompt_renderer.render_user(
         transcript=transcript,
         current_time_str=current_time_str,
         current_time_iso=current_time_iso,
         current_dt=current_dt,
         past_30min_str=past_30min_str,
-        current_date=current_date_str  # 添加预计算的日期字符串
+        current_date=current_dt.strftime('%Y-%m-%d')  # 预计算的日期字符串
     )
 
 
@@ -448,6 +1188,9 @@ class TimeAnalysisRequest(BaseModel):
     """时间分析请求"""
     transcript: str  # 转录文本
     use_ollama: Optional[bool] = False  # 是否使用 Ollama
+    race: Optional[bool] = None  # 是否使用竞速模式（None 时使用 LLM_RACE_MODE 配置）
+    use_cache: Optional[bool] = True  # 是否使用分析结果缓存（False 时强制重新调用 LLM）
+    fast_path: Optional[bool] = None  # 是否尝试规则解析（None 时使用 FAST_PATH_ENABLED 配置）
 
 
 class TimeEntry(BaseModel):
@@ -459,6 +1202,7 @@ class TimeEntry(BaseModel):
     status: Optional[str] = "completed"
     description: Optional[str] = None
     location: Optional[str] = None
+    tag: Optional[str] = None  # 标签名称（用于按标签查询）
 
 
 class CalendarEventRequest(BaseModel):
@@ -472,6 +1216,14 @@ class CalendarEventRequest(BaseModel):
     tag: Optional[str] = None  # 标签名称（用于前端显示）
     recurrence: Optional[str] = None  # 重复规则: "daily", "weekly", "monthly", "yearly"
     note_name: Optional[str] = None  # 备忘录名称（默认“时间”）
+    background: Optional[bool] = None  # 是否放入后台队列立即返回 job_id（默认 CALENDAR_BACKGROUND_DEFAULT）
+
+
+class JobRequest(BaseModel):
+    """后台任务请求"""
+    type: str  # add_event / append_note / delete_event / recolor_calendar
+    payload: dict
+    idempotency_key: Optional[str] = None
 
 
 # 工具函数
@@ -482,102 +1234,1481 @@ def escape_apple_script(text):
     return text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
 
 
-def load_tags_config() -> dict:
-    """加载标签配置"""
-    if os.path.exists(TAGS_FILE):
-        try:
-            with open(TAGS_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            logger.warning(f"加载标签配置失败: {e}，使用默认配置")
-    
-    # 返回默认配置
+# ==================== 存储层 ====================
+# 两种后端提供相同的接口：
+# - SQLiteStorage（默认）：WAL 模式，单条写入，不再整文件重写
+# - JsonStorage：原有的 data/*.json 文件格式（兼容旧部署）
+
+DEFAULT_TAGS = [
+    {"id": "work", "name": "工作", "description": "工作相关活动", "color": "#FF6B6B", "is_default": True},
+    {"id": "life", "name": "生活", "description": "日常生活活动", "color": "#95E1D3", "is_default": True},
+    {"id": "entertainment", "name": "娱乐", "description": "娱乐休闲活动", "color": "#F38181", "is_default": True},
+    {"id": "sports", "name": "运动", "description": "运动健身活动", "color": "#AA96DA", "is_default": True}
+]
+
+
+def _read_json_file(path: str, default):
+    """读取 JSON 文件（不存在时返回默认值）"""
+    if not os.path.exists(path):
+        return default
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _write_json_file(path: str, data):
+    """写入 JSON 文件（先写临时文件再替换，避免写到一半损坏）"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _recent_event_info(operation: dict) -> dict:
+    """操作记录 -> recent_event.json 格式"""
     return {
-        "tags": [
-            {"id": "work", "name": "工作", "description": "工作相关活动", "color": "#FF6B6B", "is_default": True},
-            {"id": "life", "name": "生活", "description": "日常生活活动", "color": "#95E1D3", "is_default": True},
-            {"id": "entertainment", "name": "娱乐", "description": "娱乐休闲活动", "color": "#F38181", "is_default": True},
-            {"id": "sports", "name": "运动", "description": "运动健身活动", "color": "#AA96DA", "is_default": True}
-        ]
+        "event_ids": operation.get("event_ids", []),
+        "events": operation.get("events", []),
+        "created_at": operation.get("created_at"),
+        "count": operation.get("count", 0)
     }
 
 
-def get_tag_by_name(tag_name: str) -> dict:
-    """根据标签名称获取标签信息（包括颜色）"""
-    tags_config = load_tags_config()
-    for tag in tags_config.get("tags", []):
-        if tag.get("name") == tag_name:
-            return tag
-    # 如果找不到，返回默认标签
-    return {"id": "life", "name": "生活", "color": "#95E1D3"}
+def encode_entry_cursor(key: tuple) -> str:
+    """(start_time, 序号) -> 分页游标"""
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode('utf-8')).decode('ascii')
 
 
-def classify_activity_tag(activity: str, description: str = "") -> str:
+def decode_entry_cursor(cursor: str) -> tuple:
+    """分页游标 -> (start_time, 序号)，格式错误时抛出 ValueError"""
+    try:
+        start_time, seq = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return str(start_time), int(seq)
+    except Exception:
+        raise ValueError("无效的分页游标")
+
+
+def filter_time_entries(items, tag: Optional[str], activity: Optional[str], limit: Optional[int]):
     """
-    根据活动内容自动分类标签（仅作为后备，主要依赖 LLM 分类）
-    
-    注意：现在分类主要依赖 LLM 根据 prompt 中的标签描述进行判断。
-    此函数仅作为后备方案，当 LLM 没有返回有效标签时使用。
-    
-    Args:
-        activity: 活动名称
-        description: 活动描述
-    
-    Returns:
-        标签名称（默认返回"生活"）
+    按标签 / 活动过滤已排好序的 (key, entry)，返回 (条目列表, 下一页游标)
+    """
+    activity = activity.lower() if activity else None
+    entries = []
+    last_key = None
+    for key, entry in items:
+        if tag and entry.get("tag") != tag:
+            continue
+        if activity and activity not in (entry.get("activity") or "").lower():
+            continue
+        if limit is not None and len(entries) >= limit:
+            # 还有更多结果，返回最后一条的游标
+            return entries, encode_entry_cursor(last_key)
+        entries.append(entry)
+        last_key = key
+    return entries, None
+
+
+class DayIndex:
+    """
+    按天分组的有序索引：日期 -> [(start_time, 序号), ...]
+    跨天的记录同时登记在开始日期和结束日期下。
     """
-    # 现在完全依赖 LLM 的分类，这里只返回默认值
-    # 如果需要，可以根据描述进行简单的文本匹配，但主要应该依赖 LLM
-    return "生活"  # 默认标签
-
 
-def save_recent_events(event_ids: List[str], events_data: List[dict]):
-    """保存最近写入的多个事件信息（一次操作可能写入多个事件）
-    同时保存到历史记录文件（append）和最近事件文件（覆盖）
+    def __init__(self):
+        self._days = {}
+        self._sorted_days = []
+
+    def add(self, key: tuple, entry: dict):
+        days = {(entry.get("start_time") or "")[:10], (entry.get("end_time") or "")[:10]}
+        for day in days:
+            if day not in self._days:
+                bisect.insort(self._sorted_days, day)
+                self._days[day] = []
+            bisect.insort(self._days[day], key)
+
+    def keys_between(self, date_from: Optional[str], date_to: Optional[str]) -> list:
+        """返回日期范围内（闭区间）的所有 key，按 (start_time, 序号) 排序"""
+        lo = bisect.bisect_left(self._sorted_days, date_from) if date_from else 0
+        hi = bisect.bisect_right(self._sorted_days, date_to) if date_to else len(self._sorted_days)
+        days = self._sorted_days[lo:hi]
+        if len(days) == 1:
+            return self._days[days[0]]
+        return sorted({key for day in days for key in self._days[day]})
+
+
+class OperationLog:
     """
-    events_info = {
-        "event_ids": event_ids,  # 多个事件ID
-        "events": events_data,  # 多个事件的完整数据
-        "created_at": datetime.now().isoformat(),
-        "count": len(event_ids)
-    }
-    
-    try:
-        # 1. 保存到最近事件文件（用于快速撤回）
-        with open(RECENT_EVENT_FILE, 'w', encoding='utf-8') as f:
-            json.dump(events_info, f, ensure_ascii=False, indent=2)
-        logger.info(f"已保存最近 {len(event_ids)} 个事件信息")
-        
-        # 2. 追加到历史记录文件（保留所有操作历史）
-        history_entry = {
-            "id": f"op_{datetime.now().strftime('%Y%m%d%H%M%S')}_{len(event_ids)}",
-            **events_info
+    追加写的日历操作日志（JSON Lines），同时是一个撤回 / 重做栈
+    - 写入操作追加 {"type": "op", ...}，撤回追加 {"type": "undo", "id": ...}，
+      重做追加 {"type": "redo", ...}（带重新创建后的事件ID）
+    - 部分撤回时撤回记录带上实际删除的事件 {"type": "undo", "event_ids": ..., ...}，
+      重做栈指向这条记录，重做只会重新创建这些事件
+    - 内存中只保存两个栈：有效操作和可重做操作在文件中的偏移量，
+      压栈 / 出栈都是常数时间，读取某个操作只需要 seek 到对应的行
+    - 写入新操作时清空重做栈（与常见编辑器的撤回 / 重做行为一致）
+    - fsync 批量进行：累计 OPLOG_FSYNC_BATCH 次写入或每 OPLOG_FSYNC_INTERVAL 秒一次
+    - 后台压缩线程定期重写文件，去掉已失效的记录（保留重做栈）
+    """
+
+    def __init__(self, path: str, background: bool = True):
+        self.path = path
+        self._lock = threading.RLock()
+        self._unsynced = 0
+        self._stop = threading.Event()
+        # 启动时重放一次日志，重建两个栈（之后只做增量更新）
+        self._active = []  # 有效操作的偏移量（栈顶为最近一次操作）
+        self._redo = []  # 已撤回、可重做操作的偏移量（栈顶为最近一次撤回）
+        self._records = 0  # 文件中的记录数（用于判断是否需要压缩）
+        self._replay()
+        self._file = open(path, 'ab')
+        self._size = self._file.tell()
+        self._reader = open(path, 'rb')
+        self._thread = None
+        if background:
+            self._thread = threading.Thread(target=self._background_loop, name="oplog-compactor", daemon=True)
+            self._thread.start()
+
+    def _replay(self):
+        """从头读取日志，按记录类型重放栈操作（跳过损坏的行）"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            offset = 0
+            for line in f:
+                record_offset, offset = offset, offset + len(line)
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning("操作日志中有损坏的行，已跳过")
+                    continue
+                self._records += 1
+                record_type = record.get("type")
+                if record_type == "undo":
+                    if self._active:
+                        undone_offset = self._active.pop()
+                        self._redo.append(record_offset if "event_ids" in record else undone_offset)
+                elif record_type == "redo":
+                    if self._redo:
+                        self._redo.pop()
+                    self._active.append(record_offset)
+                else:
+                    self._redo.clear()
+                    self._active.append(record_offset)
+
+    # ---- 写入 ----
+    def _append(self, record: dict) -> int:
+        """追加一行，返回该行在文件中的偏移量"""
+        with self._lock:
+            data = (json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8')
+            offset = self._size
+            self._file.write(data)
+            self._file.flush()
+            self._size += len(data)
+            self._records += 1
+            self._unsynced += 1
+            if self._unsynced >= OPLOG_FSYNC_BATCH:
+                self._fsync()
+            return offset
+
+    def _fsync(self):
+        if self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def append(self, operation: dict) -> int:
+        """压入一次新操作（清空重做栈），返回当前有效操作数"""
+        with self._lock:
+            self._active.append(self._append({"type": "op", **operation}))
+            self._redo.clear()
+            return len(self._active)
+
+    def undo(self, removed: Optional[dict] = None) -> Optional[dict]:
+        """
+        弹出最近一次操作并移到重做栈，返回该操作
+        removed 为部分撤回时实际删除的事件（重做栈保存这部分内容）
+        """
+        with self._lock:
+            if not self._active:
+                return None
+            operation = self._read(self._active[-1])
+            if removed is None:
+                self._append({"type": "undo", "id": operation.get("id")})
+                self._redo.append(self._active.pop())
+            else:
+                self._redo.append(self._append({"type": "undo", **removed, "id": operation.get("id")}))
+                self._active.pop()
+            return operation
+
+    def redo(self, operation: dict) -> int:
+        """弹出最近一次撤回的操作，以新的内容（重新创建后的事件ID）压回有效操作栈"""
+        with self._lock:
+            if self._redo:
+                self._redo.pop()
+            self._active.append(self._append({"type": "redo", **operation}))
+            return len(self._active)
+
+    # ---- 读取 ----
+    def _read(self, offset: int) -> dict:
+        """读取指定偏移量的一行"""
+        self._reader.seek(offset)
+        operation = json.loads(self._reader.readline())
+        operation.pop("type", None)
+        return operation
+
+    def latest(self) -> Optional[dict]:
+        """最近一次未撤回的操作"""
+        with self._lock:
+            return self._read(self._active[-1]) if self._active else None
+
+    def latest_undone(self) -> Optional[dict]:
+        """下一次重做将恢复的操作"""
+        with self._lock:
+            return self._read(self._redo[-1]) if self._redo else None
+
+    @property
+    def record_count(self) -> int:
+        """文件中的记录数（0 表示还没有任何操作历史）"""
+        return self._records
+
+    def list_operations(self) -> list:
+        """所有未撤回的操作（最新的在前面）"""
+        with self._lock:
+            return [self._read(offset) for offset in reversed(self._active)]
+
+    def page(self, before: Optional[int] = None, limit: int = 20) -> tuple:
+        """
+        分页读取未撤回的操作（最新的在前面）
+        before 为上一页最后一个操作在栈中的位置，返回 (操作列表, 下一页的 before)
+        """
+        with self._lock:
+            end = len(self._active) if before is None else min(before, len(self._active))
+            start = max(end - limit, 0)
+            operations = [self._read(offset) for offset in reversed(self._active[start:end])]
+            return operations, (start if start > 0 else None)
+
+    def __len__(self):
+        return len(self._active)
+
+    @property
+    def redo_count(self) -> int:
+        return len(self._redo)
+
+    def _garbage(self) -> int:
+        """可以被压缩掉的记录数（有效操作占 1 行，可重做操作占 2 行）"""
+        return self._records - len(self._active) - 2 * len(self._redo)
+
+    # ---- 压缩 ----
+    def compact(self):
+        """重写日志文件，去掉已失效的记录；可重做的操作以 op + undo 记录保留"""
+        with self._lock:
+            if not self._garbage():
+                return
+            active = [self._read(offset) for offset in self._active]
+            # 重做栈从栈顶到栈底依次写入，再从栈底到栈顶撤回，重放后顺序不变
+            redo = [self._read(offset) for offset in reversed(self._redo)]
+            records = [{"type": "op", **operation} for operation in active + redo]
+            records += [{"type": "undo", "id": operation.get("id")} for operation in reversed(redo)]
+            tmp_path = self.path + ".tmp"
+            active_offsets = []
+            redo_offsets = []
+            offset = 0
+            with open(tmp_path, 'wb') as f:
+                for index, record in enumerate(records):
+                    if index < len(active):
+                        active_offsets.append(offset)
+                    elif index < len(active) + len(redo):
+                        redo_offsets.append(offset)
+                    data = (json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8')
+                    f.write(data)
+                    offset += len(data)
+                f.flush()
+                os.fsync(f.fileno())
+            self._file.close()
+            self._reader.close()
+            os.replace(tmp_path, self.path)
+            self._file = open(self.path, 'ab')
+            self._reader = open(self.path, 'rb')
+            removed = self._garbage()
+            self._size = offset
+            self._records = len(records)
+            self._unsynced = 0
+            self._active = active_offsets
+            self._redo = list(reversed(redo_offsets))
+        logger.info(f"操作日志已压缩，清理 {removed} 条记录，剩余 {len(active_offsets)} 次操作（可重做 {len(redo_offsets)} 次）")
+
+    def _background_loop(self):
+        last_compact = time.time()
+        while not self._stop.wait(OPLOG_FSYNC_INTERVAL):
+            try:
+                with self._lock:
+                    self._fsync()
+                if (time.time() - last_compact >= OPLOG_COMPACT_INTERVAL and
+                        self._garbage() >= OPLOG_COMPACT_MIN_UNDONE):
+                    self.compact()
+                    last_compact = time.time()
+            except Exception as e:
+                logger.warning(f"操作日志后台任务失败: {e}")
+
+    def close(self):
+        self._stop.set()
+        with self._lock:
+            if not self._file.closed:
+                self._fsync()
+                self._file.close()
+                self._reader.close()
+
+
+class JsonStorage:
+    """JSON 文件存储（时间记录和标签为原有 JSON 格式；日历操作历史为追加写的 JSONL 日志）"""
+
+    name = "json"
+
+    def __init__(self):
+        self._lock = threading.RLock()  # 避免并发请求的读-改-写互相覆盖
+        self._entries = None
+        self._entries_mtime = None
+        self._day_index = None
+        migrate = not os.path.exists(OPERATION_LOG_FILE) and os.path.exists(EVENT_HISTORY_FILE)
+        self.operation_log = OperationLog(OPERATION_LOG_FILE)
+        if migrate:
+            self._migrate_event_history()
+
+    def _migrate_event_history(self):
+        """一次性把 event_history.json 转为 JSONL 操作日志（按时间顺序追加）"""
+        try:
+            operations = _read_json_file(EVENT_HISTORY_FILE, {"operations": []}).get("operations", [])
+            for operation in reversed(operations):
+                self.operation_log.append(operation)
+            logger.info(f"✅ 已迁移 {len(operations)} 次日历操作到 {OPERATION_LOG_FILE}")
+        except Exception as e:
+            logger.error(f"迁移历史记录失败: {e}")
+
+    def close(self):
+        self.operation_log.close()
+
+    # ---- 时间记录 ----
+    def _ensure_entries(self):
+        """加载时间记录并建立按天索引（文件被外部修改时重建）"""
+        mtime = os.path.getmtime(TIME_LOG_FILE) if os.path.exists(TIME_LOG_FILE) else None
+        if self._entries is not None and mtime == self._entries_mtime:
+            return
+        self._entries = _read_json_file(TIME_LOG_FILE, {"entries": []}).get("entries", [])
+        self._day_index = DayIndex()
+        for seq, entry in enumerate(self._entries):
+            self._day_index.add((entry.get("start_time") or "", seq), entry)
+        self._entries_mtime = mtime
+
+    def add_time_entry(self, entry: dict):
+        with self._lock:
+            self._ensure_entries()
+            self._entries.append(entry)
+            _write_json_file(TIME_LOG_FILE, {"entries": self._entries})
+            # 写入时维护索引，不需要重新扫描
+            self._day_index.add((entry.get("start_time") or "", len(self._entries) - 1), entry)
+            self._entries_mtime = os.path.getmtime(TIME_LOG_FILE)
+
+    def query_time_entries(self, date_from: Optional[str] = None, date_to: Optional[str] = None,
+                           tag: Optional[str] = None, activity: Optional[str] = None,
+                           descending: bool = False, limit: Optional[int] = None,
+                           cursor: Optional[str] = None):
+        """按日期范围 / 标签 / 活动查询，按开始时间排序，支持游标分页"""
+        with self._lock:
+            self._ensure_entries()
+            keys = self._day_index.keys_between(date_from, date_to)
+            if cursor:
+                # 游标之后的位置可以直接二分定位
+                cursor_key = decode_entry_cursor(cursor)
+                if descending:
+                    keys = keys[:bisect.bisect_left(keys, cursor_key)]
+                else:
+                    keys = keys[bisect.bisect_right(keys, cursor_key):]
+            ordered = reversed(keys) if descending else iter(keys)
+            entries = self._entries
+            return filter_time_entries(((key, entries[key[1]]) for key in ordered), tag, activity, limit)
+
+    def list_time_entries(self) -> list:
+        """所有时间记录（按写入顺序）"""
+        with self._lock:
+            self._ensure_entries()
+            return list(self._entries)
+
+    # ---- 日历操作历史 ----
+    def push_operation(self, operation: dict):
+        with self._lock:
+            _write_json_file(RECENT_EVENT_FILE, _recent_event_info(operation))
+            # 追加一行到日志末尾（常数时间，与历史长度无关）
+            self.operation_log.append(operation)
+
+    def has_history(self) -> bool:
+        """操作日志中是否有记录（没有时只能从旧的最近事件文件撤回）"""
+        return self.operation_log.record_count > 0
+
+    def latest_operation(self) -> Optional[dict]:
+        return self.operation_log.latest()
+
+    def _write_recent_event(self):
+        """最近事件文件指向当前栈顶的操作（没有操作时删除）"""
+        latest = self.operation_log.latest()
+        if latest:
+            _write_json_file(RECENT_EVENT_FILE, _recent_event_info(latest))
+        elif os.path.exists(RECENT_EVENT_FILE):
+            os.remove(RECENT_EVENT_FILE)
+
+    def mark_operation_undone(self, removed: Optional[dict] = None):
+        """撤回最近一次操作（追加撤回标记，操作移到重做栈；removed 为部分撤回时实际删除的事件）"""
+        with self._lock:
+            self.operation_log.undo(removed)
+            self._write_recent_event()
+
+    def latest_undone_operation(self) -> Optional[dict]:
+        return self.operation_log.latest_undone()
+
+    def mark_operation_redone(self, operation: dict):
+        """重做最近一次撤回的操作（operation 为重新创建事件后的内容）"""
+        with self._lock:
+            self.operation_log.redo(operation)
+            self._write_recent_event()
+
+    def redo_count(self) -> int:
+        return self.operation_log.redo_count
+
+    def list_operations(self) -> list:
+        return self.operation_log.list_operations()
+
+    def page_operations(self, cursor: Optional[str] = None, limit: int = 20) -> tuple:
+        """分页读取操作历史（最新的在前面），返回 (操作列表, 下一页游标)"""
+        before = decode_entry_cursor(cursor)[1] if cursor else None
+        operations, next_before = self.operation_log.page(before, limit)
+        if next_before is None:
+            return operations, None
+        return operations, encode_entry_cursor((operations[-1].get("created_at") or "", next_before))
+
+    # ---- 标签 ----
+    def load_tags(self) -> Optional[list]:
+        """返回标签列表；尚未保存过标签配置时返回 None"""
+        if not os.path.exists(TAGS_FILE):
+            return None
+        return _read_json_file(TAGS_FILE, {"tags": []}).get("tags", [])
+
+    def tags_stamp(self):
+        """标签文件的修改标记（文件被外部修改后变化）"""
+        try:
+            stat = os.stat(TAGS_FILE)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _save_tags(self, tags: list):
+        _write_json_file(TAGS_FILE, {"tags": tags})
+
+    def insert_tag(self, tag: dict):
+        with self._lock:
+            tags = self.load_tags()
+            tags = list(DEFAULT_TAGS) if tags is None else tags
+            tags.append(tag)
+            self._save_tags(tags)
+
+    def update_tag(self, tag_id: str, fields: dict):
+        with self._lock:
+            tags = self.load_tags()
+            tags = [dict(t) for t in DEFAULT_TAGS] if tags is None else tags
+            for t in tags:
+                if t.get("id") == tag_id:
+                    t.update(fields)
+            self._save_tags(tags)
+
+    def delete_tag(self, tag_id: str):
+        with self._lock:
+            tags = self.load_tags()
+            tags = list(DEFAULT_TAGS) if tags is None else tags
+            self._save_tags([t for t in tags if t.get("id") != tag_id])
+
+    def export_json(self) -> dict:
+        """时间记录和标签本身就是导出格式，操作日志导出为 event_history.json"""
+        _write_json_file(EVENT_HISTORY_FILE, {"operations": self.list_operations()})
+        return {
+            "time_log": TIME_LOG_FILE,
+            "event_history": EVENT_HISTORY_FILE,
+            "recent_event": RECENT_EVENT_FILE,
+            "tags": TAGS_FILE,
         }
-        
-        # 读取现有历史记录
-        if os.path.exists(EVENT_HISTORY_FILE):
-            with open(EVENT_HISTORY_FILE, 'r', encoding='utf-8') as f:
-                history = json.load(f)
-        else:
-            history = {"operations": []}
-        
-        # 追加新操作到开头（最新的在前面）
-        history["operations"].insert(0, history_entry)
-        
-        # 保存历史记录
-        with open(EVENT_HISTORY_FILE, 'w', encoding='utf-8') as f:
-            json.dump(history, f, ensure_ascii=False, indent=2)
-        logger.info(f"已追加到历史记录，共 {len(history['operations'])} 次操作")
-        
-    except Exception as e:
-        logger.warning(f"保存事件信息失败: {e}")
 
 
-def hex_to_rgb(hex_color: str) -> tuple:
-    """将十六进制颜色转换为 RGB 元组 (0-65535)"""
-    hex_color = hex_color.lstrip('#')
-    if len(hex_color) == 6:
-        r = int(hex_color[0:2], 16)
+class SQLiteStorage:
+    """
+    SQLite 存储（WAL 模式）
+    - time_entries：时间记录，按开始/结束日期建索引
+    - operations / operation_events：日历写入操作及其事件（撤回 / 重做栈，
+      undone_at 不为空的操作在重做栈中，redo_seq 越大越靠近栈顶）
+    - tags：标签配置
+    首次启动时自动从 data/*.json 迁移数据。
+    """
+
+    name = "sqlite"
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    CREATE TABLE IF NOT EXISTS time_entries (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        activity TEXT NOT NULL,
+        start_time TEXT,
+        end_time TEXT,
+        date TEXT,
+        end_date TEXT,
+        tag TEXT,
+        data TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_time_entries_start_time ON time_entries(start_time);
+    CREATE INDEX IF NOT EXISTS idx_time_entries_date ON time_entries(date, start_time);
+    CREATE INDEX IF NOT EXISTS idx_time_entries_end_date ON time_entries(end_date);
+    CREATE TABLE IF NOT EXISTS operations (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        id TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        undone_at TEXT,
+        redo_seq INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS idx_operations_created_at ON operations(created_at);
+    CREATE TABLE IF NOT EXISTS operation_events (
+        operation_seq INTEGER NOT NULL REFERENCES operations(seq) ON DELETE CASCADE,
+        position INTEGER NOT NULL,
+        event_id TEXT,
+        data TEXT NOT NULL,
+        PRIMARY KEY (operation_seq, position)
+    );
+    CREATE TABLE IF NOT EXISTS tags (
+        position INTEGER PRIMARY KEY AUTOINCREMENT,
+        id TEXT NOT NULL UNIQUE,
+        name TEXT NOT NULL,
+        description TEXT,
+        color TEXT,
+        is_default INTEGER NOT NULL DEFAULT 0
+    );
+    """
+
+    def __init__(self, path: str = DATABASE_FILE):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript(self.SCHEMA)
+        columns = [row["name"] for row in self._conn.execute("PRAGMA table_info(time_entries)")]
+        if "tag" not in columns:
+            self._conn.execute("ALTER TABLE time_entries ADD COLUMN tag TEXT")
+            self._conn.execute("UPDATE time_entries SET tag = json_extract(data, '$.tag')")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_time_entries_tag ON time_entries(tag, start_time)")
+        columns = [row["name"] for row in self._conn.execute("PRAGMA table_info(operations)")]
+        if "undone_at" not in columns:
+            self._conn.execute("ALTER TABLE operations ADD COLUMN undone_at TEXT")
+            self._conn.execute("ALTER TABLE operations ADD COLUMN redo_seq INTEGER")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_operations_active ON operations(undone_at, created_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_operations_redo ON operations(redo_seq)")
+        self.migrate_from_json()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _get_meta(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else None
+
+    @staticmethod
+    def _set_meta(conn, key: str, value: str):
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    # ---- 迁移 ----
+    def migrate_from_json(self):
+        """一次性从 time_log.json / event_history.json / recent_event.json / tags.json 迁移"""
+        if self._get_meta("migrated_from_json"):
+            return
+        try:
+            time_log = _read_json_file(TIME_LOG_FILE, {"entries": []})
+            history = _read_json_file(EVENT_HISTORY_FILE, None)
+            recent = _read_json_file(RECENT_EVENT_FILE, None)
+            tags_config = _read_json_file(TAGS_FILE, None)
+        except Exception as e:
+            logger.error(f"读取 JSON 数据失败，跳过迁移: {e}")
+            return
+
+        if os.path.exists(OPERATION_LOG_FILE):
+            # JSON 后端的追加写操作日志（已按时间顺序）
+            operation_log = OperationLog(OPERATION_LOG_FILE, background=False)
+            operations = list(reversed(operation_log.list_operations()))
+            operation_log.close()
+        elif history is not None:
+            # 历史记录文件中最新的在前面，按时间顺序插入
+            operations = list(reversed(history.get("operations", [])))
+        elif recent:
+            # 只有旧的最近事件文件（可能是单事件格式）
+            if "event_id" in recent and "event_ids" not in recent:
+                recent = {"event_ids": [recent.get("event_id")], "events": [recent],
+                          "created_at": recent.get("created_at")}
+            operations = [{"id": "op_migrated_recent", **recent}]
+        else:
+            operations = []
+
+        with self._transaction() as conn:
+            for entry in time_log.get("entries", []):
+                self._insert_time_entry(conn, entry)
+            for operation in operations:
+                self._insert_operation(conn, operation)
+            if tags_config is not None:
+                for tag in tags_config.get("tags", []):
+                    self._insert_tag(conn, tag)
+                self._set_meta(conn, "tags_initialized", "1")
+            self._set_meta(conn, "migrated_from_json", datetime.now().isoformat())
+
+        logger.info(
+            f"✅ 已迁移 JSON 数据到 SQLite: {len(time_log.get('entries', []))} 条时间记录，"
+            f"{len(operations)} 次日历操作，{len((tags_config or {}).get('tags', []))} 个标签"
+        )
+
+    # ---- 时间记录 ----
+    @staticmethod
+    def _insert_time_entry(conn, entry: dict):
+        start_time = entry.get("start_time") or ""
+        end_time = entry.get("end_time") or ""
+        conn.execute(
+            "INSERT INTO time_entries (activity, start_time, end_time, date, end_date, tag, data, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (entry.get("activity", ""), start_time, end_time, start_time[:10], end_time[:10],
+             entry.get("tag"), json.dumps(entry, ensure_ascii=False), datetime.now().isoformat())
+        )
+
+    def add_time_entry(self, entry: dict):
+        with self._transaction() as conn:
+            self._insert_time_entry(conn, entry)
+
+    def list_time_entries(self) -> list:
+        """所有时间记录（按写入顺序）"""
+        with self._lock:
+            rows = self._conn.execute("SELECT data FROM time_entries ORDER BY id").fetchall()
+        return [json.loads(row["data"]) for row in rows]
+
+    def query_time_entries(self, date_from: Optional[str] = None, date_to: Optional[str] = None,
+                           tag: Optional[str] = None, activity: Optional[str] = None,
+                           descending: bool = False, limit: Optional[int] = None,
+                           cursor: Optional[str] = None):
+        """按日期范围 / 标签 / 活动查询，按开始时间排序，支持游标（keyset）分页"""
+        conditions = []
+        params = []
+        if date_from or date_to:
+            date_from = date_from or ""
+            date_to = date_to or "\uffff"
+            conditions.append("((date BETWEEN ? AND ?) OR (end_date BETWEEN ? AND ?))")
+            params += [date_from, date_to, date_from, date_to]
+        if tag:
+            conditions.append("tag = ?")
+            params.append(tag)
+        if activity:
+            conditions.append("instr(lower(activity), ?) > 0")
+            params.append(activity.lower())
+        if cursor:
+            conditions.append(f"(start_time, id) {'<' if descending else '>'} (?, ?)")
+            params += list(decode_entry_cursor(cursor))
+        direction = "DESC" if descending else "ASC"
+        sql = "SELECT id, start_time, data FROM time_entries"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += f" ORDER BY start_time {direction}, id {direction}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit + 1)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        items = (((row["start_time"], row["id"]), json.loads(row["data"])) for row in rows)
+        # 标签 / 活动已在 SQL 中过滤，这里只负责截取和生成游标
+        return filter_time_entries(items, None, None, limit)
+
+    # ---- 日历操作历史 ----
+    @staticmethod
+    def _insert_operation(conn, operation: dict):
+        event_ids = operation.get("event_ids", [])
+        events = operation.get("events", [])
+        cursor = conn.execute(
+            "INSERT INTO operations (id, created_at, count) VALUES (?, ?, ?)",
+            (operation.get("id") or "", operation.get("created_at") or datetime.now().isoformat(),
+             operation.get("count", len(event_ids)))
+        )
+        seq = cursor.lastrowid
+        for position, event in enumerate(events):
+            event_id = event_ids[position] if position < len(event_ids) else None
+            conn.execute(
+                "INSERT INTO operation_events (operation_seq, position, event_id, data) VALUES (?, ?, ?, ?)",
+                (seq, position, event_id, json.dumps(event, ensure_ascii=False))
+            )
+        return seq
+
+    def _load_operation(self, row) -> dict:
+        events = self._conn.execute(
+            "SELECT event_id, data FROM operation_events WHERE operation_seq = ? ORDER BY position",
+            (row["seq"],)
+        ).fetchall()
+        return {
+            "id": row["id"],
+            "event_ids": [e["event_id"] for e in events],
+            "events": [json.loads(e["data"]) for e in events],
+            "created_at": row["created_at"],
+            "count": row["count"],
+        }
+
+    # 栈顶：未撤回的操作中最新的一个
+    LATEST_ACTIVE_SQL = "SELECT * FROM operations WHERE undone_at IS NULL ORDER BY created_at DESC, seq DESC LIMIT 1"
+    LATEST_UNDONE_SQL = "SELECT * FROM operations WHERE undone_at IS NOT NULL ORDER BY redo_seq DESC LIMIT 1"
+
+    def push_operation(self, operation: dict):
+        with self._transaction() as conn:
+            # 新操作使重做栈失效（事件随外键级联删除）
+            conn.execute("DELETE FROM operations WHERE undone_at IS NOT NULL")
+            self._insert_operation(conn, operation)
+
+    def has_history(self) -> bool:
+        return True
+
+    def latest_operation(self) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(self.LATEST_ACTIVE_SQL).fetchone()
+            return self._load_operation(row) if row else None
+
+    def _replace_operation_events(self, conn, seq: int, operation: dict):
+        """用 operation 中的事件替换某个操作的事件列表"""
+        conn.execute("DELETE FROM operation_events WHERE operation_seq = ?", (seq,))
+        event_ids = operation.get("event_ids", [])
+        for position, event in enumerate(operation.get("events", [])):
+            event_id = event_ids[position] if position < len(event_ids) else None
+            conn.execute(
+                "INSERT INTO operation_events (operation_seq, position, event_id, data) VALUES (?, ?, ?, ?)",
+                (seq, position, event_id, json.dumps(event, ensure_ascii=False))
+            )
+        conn.execute("UPDATE operations SET count = ? WHERE seq = ?", (operation.get("count", len(event_ids)), seq))
+
+    def mark_operation_undone(self, removed: Optional[dict] = None):
+        """撤回最近一次操作（操作移到重做栈；removed 为部分撤回时实际删除的事件，重做栈只保留这些事件）"""
+        with self._transaction() as conn:
+            row = conn.execute(self.LATEST_ACTIVE_SQL).fetchone()
+            if row is None:
+                return
+            if removed is not None:
+                self._replace_operation_events(conn, row["seq"], removed)
+            redo_seq = conn.execute("SELECT COALESCE(MAX(redo_seq), 0) + 1 FROM operations").fetchone()[0]
+            conn.execute(
+                "UPDATE operations SET undone_at = ?, redo_seq = ? WHERE seq = ?",
+                (datetime.now().isoformat(), redo_seq, row["seq"])
+            )
+
+    def latest_undone_operation(self) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(self.LATEST_UNDONE_SQL).fetchone()
+            return self._load_operation(row) if row else None
+
+    def mark_operation_redone(self, operation: dict):
+        """重做最近一次撤回的操作（operation 为重新创建事件后的内容）"""
+        with self._transaction() as conn:
+            row = conn.execute(self.LATEST_UNDONE_SQL).fetchone()
+            if row is None:
+                return
+            self._replace_operation_events(conn, row["seq"], operation)
+            conn.execute("UPDATE operations SET undone_at = NULL, redo_seq = NULL WHERE seq = ?", (row["seq"],))
+
+    def redo_count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM operations WHERE undone_at IS NOT NULL").fetchone()[0]
+
+    def list_operations(self) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM operations WHERE undone_at IS NULL ORDER BY created_at DESC, seq DESC"
+            ).fetchall()
+            return [self._load_operation(row) for row in rows]
+
+    def page_operations(self, cursor: Optional[str] = None, limit: int = 20) -> tuple:
+        """分页读取操作历史（最新的在前面，keyset 分页），返回 (操作列表, 下一页游标)"""
+        sql = "SELECT * FROM operations WHERE undone_at IS NULL"
+        params = []
+        if cursor:
+            sql += " AND (created_at, seq) < (?, ?)"
+            params += list(decode_entry_cursor(cursor))
+        sql += " ORDER BY created_at DESC, seq DESC LIMIT ?"
+        params.append(limit + 1)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+            operations = [self._load_operation(row) for row in rows[:limit]]
+        if len(rows) <= limit:
+            return operations, None
+        return operations, encode_entry_cursor((rows[limit - 1]["created_at"], rows[limit - 1]["seq"]))
+
+    # ---- 标签 ----
+    @staticmethod
+    def _insert_tag(conn, tag: dict):
+        conn.execute(
+            "INSERT OR REPLACE INTO tags (id, name, description, color, is_default) VALUES (?, ?, ?, ?, ?)",
+            (tag.get("id"), tag.get("name", ""), tag.get("description", ""),
+             tag.get("color", "#95E1D3"), 1 if tag.get("is_default") else 0)
+        )
+
+    def _ensure_tags_initialized(self, conn):
+        """首次修改标签时，先写入默认标签（与 JSON 后端行为一致）"""
+        row = conn.execute("SELECT value FROM meta WHERE key = 'tags_initialized'").fetchone()
+        if row is None:
+            for tag in DEFAULT_TAGS:
+                self._insert_tag(conn, tag)
+            self._set_meta(conn, "tags_initialized", "1")
+
+    def tags_stamp(self):
+        """其他连接（进程）提交修改后 data_version 会变化"""
+        with self._lock:
+            return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def load_tags(self) -> Optional[list]:
+        if not self._get_meta("tags_initialized"):
+            return None
+        with self._lock:
+            rows = self._conn.execute("SELECT * FROM tags ORDER BY position").fetchall()
+        return [{
+            "id": row["id"],
+            "name": row["name"],
+            "description": row["description"],
+            "color": row["color"],
+            "is_default": bool(row["is_default"]),
+        } for row in rows]
+
+    def insert_tag(self, tag: dict):
+        with self._transaction() as conn:
+            self._ensure_tags_initialized(conn)
+            self._insert_tag(conn, tag)
+
+    def update_tag(self, tag_id: str, fields: dict):
+        with self._transaction() as conn:
+            self._ensure_tags_initialized(conn)
+            conn.execute(
+                "UPDATE tags SET name = ?, description = ?, color = ? WHERE id = ?",
+                (fields.get("name"), fields.get("description"), fields.get("color"), tag_id)
+            )
+
+    def delete_tag(self, tag_id: str):
+        with self._transaction() as conn:
+            self._ensure_tags_initialized(conn)
+            conn.execute("DELETE FROM tags WHERE id = ?", (tag_id,))
+
+    # ---- 导出 ----
+    def export_json(self) -> dict:
+        """导出为原有的 data/*.json 格式"""
+        operations = self.list_operations()
+        _write_json_file(TIME_LOG_FILE, {"entries": self.list_time_entries()})
+        _write_json_file(EVENT_HISTORY_FILE, {"operations": operations})
+        if operations:
+            _write_json_file(RECENT_EVENT_FILE, _recent_event_info(operations[0]))
+        elif os.path.exists(RECENT_EVENT_FILE):
+            os.remove(RECENT_EVENT_FILE)
+        tags = self.load_tags()
+        _write_json_file(TAGS_FILE, {"tags": DEFAULT_TAGS if tags is None else tags})
+        return {
+            "time_log": TIME_LOG_FILE,
+            "event_history": EVENT_HISTORY_FILE,
+            "recent_event": RECENT_EVENT_FILE,
+            "tags": TAGS_FILE,
+        }
+
+
+def create_storage():
+    """根据 STORAGE_BACKEND 创建存储后端"""
+    if STORAGE_BACKEND == "json":
+        logger.info("使用 JSON 文件存储")
+        return JsonStorage()
+    logger.info(f"使用 SQLite 存储: {DATABASE_FILE}")
+    return SQLiteStorage(DATABASE_FILE)
+
+
+storage = create_storage()
+
+
+@app.on_event("shutdown")
+def close_storage():
+    """关闭存储（刷新未 fsync 的日志）"""
+    storage.close()
+
+
+class TagRegistry:
+    """
+    进程内的标签注册表
+    - 标签列表加载一次，按名称 / ID 建立字典索引，查询为 O(1)
+    - 通过注册表写入时立即失效；标签文件（或数据库）被外部修改时，
+      下一次访问发现修改标记变化后重新加载
+    - version 在每次重新加载后递增，可作为 Prompt / 分析结果缓存键的一部分
+    返回给调用方的都是副本，修改返回值不会影响注册表。
+    """
+
+    def __init__(self, store):
+        self._store = store
+        self._lock = threading.RLock()
+        self._tags = None
+        self._by_name = {}
+        self._by_id = {}
+        self._stamp = None
+        self._version = 0
+
+    def _ensure_loaded(self):
+        stamp = self._store.tags_stamp()
+        if self._tags is not None and stamp == self._stamp:
+            return
+        with self._lock:
+            if self._tags is not None and stamp == self._stamp:
+                return
+            try:
+                tags = self._store.load_tags()
+            except Exception as e:
+                logger.warning(f"加载标签配置失败: {e}，使用默认配置")
+                tags = None
+            self._tags = copy.deepcopy(DEFAULT_TAGS) if tags is None else tags
+            self._by_name = {}
+            self._by_id = {}
+            for tag in self._tags:
+                # 名称重复时保留第一个（与原来的顺序查找一致）
+                self._by_name.setdefault(tag.get("name"), tag)
+                self._by_id.setdefault(tag.get("id"), tag)
+            self._stamp = stamp
+            self._version += 1
+
+    def invalidate(self):
+        with self._lock:
+            self._tags = None
+
+    @property
+    def version(self) -> int:
+        self._ensure_loaded()
+        return self._version
+
+    def tags(self) -> list:
+        self._ensure_loaded()
+        return [dict(tag) for tag in self._tags]
+
+    def get_by_name(self, name: str) -> Optional[dict]:
+        self._ensure_loaded()
+        tag = self._by_name.get(name)
+        return dict(tag) if tag else None
+
+    def get_by_id(self, tag_id: str) -> Optional[dict]:
+        self._ensure_loaded()
+        tag = self._by_id.get(tag_id)
+        return dict(tag) if tag else None
+
+    # ---- 写入（写入存储后立即失效）----
+    def insert_tag(self, tag: dict):
+        with self._lock:
+            self._store.insert_tag(tag)
+            self.invalidate()
+
+    def update_tag(self, tag_id: str, fields: dict):
+        with self._lock:
+            self._store.update_tag(tag_id, fields)
+            self.invalidate()
+
+    def delete_tag(self, tag_id: str):
+        with self._lock:
+            self._store.delete_tag(tag_id)
+            self.invalidate()
+
+
+tag_registry = TagRegistry(storage)
+
+
+def load_tags_config() -> dict:
+    """加载标签配置（来自内存中的标签注册表）"""
+    return {"tags": tag_registry.tags()}
+
+
+def get_tag_by_name(tag_name: str) -> dict:
+    """根据标签名称获取标签信息（包括颜色）"""
+    tag = tag_registry.get_by_name(tag_name)
+    if tag:
+        return tag
+    # 如果找不到，返回默认标签
+    return {"id": "life", "name": "生活", "color": "#95E1D3"}
+
+
+def classify_activity_tag(activity: str, description: str = "") -> str:
+    """
+    根据活动内容自动分类标签（仅作为后备，主要依赖 LLM 分类）
+    
+    注意：现在分类主要依赖 LLM 根据 prompt 中的标签描述进行判断。
+    此函数仅作为后备方案，当 LLM 没有返回有效标签时使用。
+    
+    Args:
+        activity: 活动名称
+        description: 活动描述
+    
+    Returns:
+        标签名称（默认返回"生活"）
+    """
+    # 现在完全依赖 LLM 的分类，这里只返回默认值
+    # 如果需要，可以根据描述进行简单的文本匹配，但主要应该依赖 LLM
+    return "生活"  # 默认标签
+
+
+def save_recent_events(event_ids: List[str], events_data: List[dict]):
+    """保存最近写入的多个事件信息（一次操作可能写入多个事件）
+    追加到存储层的操作历史（JSON 后端同时覆盖最近事件文件）
+    """
+    events_info = {
+        "event_ids": event_ids,  # 多个事件ID
+        "events": events_data,  # 多个事件的完整数据
+        "created_at": datetime.now().isoformat(),
+        "count": len(event_ids)
+    }
+    
+    try:
+        # 追加到历史记录（保留所有操作历史，最近一次操作用于快速撤回）
+        history_entry = {
+            "id": f"op_{datetime.now().strftime('%Y%m%d%H%M%S')}_{len(event_ids)}",
+            **events_info
+        }
+        storage.push_operation(history_entry)
+        logger.info(f"已保存最近 {len(event_ids)} 个事件信息")
+        
+    except Exception as e:
+        logger.warning(f"保存事件信息失败: {e}")
+
+
+# ==================== AppleScript 执行器 ====================
+# 所有日历 / 备忘录操作都通过 run_applescript() 执行：
+# - worker：常驻的 osascript（JXA）进程池，脚本编译一次后缓存，参数通过管道传入
+# - subprocess：每次调用启动一个 osascript 进程（原有方式）
+# - null：不执行任何脚本，只记录调用（用于在 Linux 上测试）
+#
+# 脚本模板是 run 处理器的正文，参数通过 argv 读取（item 1 of argv ...），
+# 不需要把参数拼接 / 转义进脚本文本，相同模板只编译一次。
+
+
+class ScriptResult:
+    """脚本执行结果（字段与 subprocess.CompletedProcess 一致）"""
+
+    def __init__(self, returncode: int, stdout: str = "", stderr: str = ""):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+class SubprocessScriptRunner:
+    """每次调用启动一个 osascript 进程"""
+
+    name = "subprocess"
+
+    def run(self, script: str, args: List[str] = (), timeout: float = APPLESCRIPT_TIMEOUT) -> ScriptResult:
+        source = f"on run argv\n{script}\nend run"
+        result = subprocess.run(
+            ["osascript", "-e", source, *[str(a) for a in args]],
+            capture_output=True,
+            text=True,
+            timeout=timeout
+        )
+        return ScriptResult(result.returncode, result.stdout, result.stderr)
+
+    def stats(self) -> dict:
+        return {"runner": self.name}
+
+    def close(self):
+        pass
+
+
+class NullScriptRunner:
+    """
+    不执行脚本的替身（Linux / 测试环境）
+    responder(script, args) 可返回 ScriptResult 或字符串（作为 stdout），默认返回空输出。
+    """
+
+    name = "null"
+
+    def __init__(self, responder=None, max_calls: int = 1000):
+        self.responder = responder
+        self.calls = deque(maxlen=max_calls)
+
+    def run(self, script: str, args: List[str] = (), timeout: float = APPLESCRIPT_TIMEOUT) -> ScriptResult:
+        self.calls.append((script, [str(a) for a in args]))
+        if self.responder is None:
+            return ScriptResult(0, "", "")
+        result = self.responder(script, list(args))
+        return result if isinstance(result, ScriptResult) else ScriptResult(0, str(result or ""), "")
+
+    def stats(self) -> dict:
+        return {"runner": self.name, "calls": len(self.calls)}
+
+    def close(self):
+        pass
+
+
+# 常驻 worker（JXA）：逐行读取 JSON 请求 {id, source, args}，
+# 用 NSAppleScript 编译并缓存脚本，通过 Apple Event 调用 run_template(argv)，逐行输出 JSON 结果
+APPLESCRIPT_WORKER_SOURCE = r'''
+ObjC.import("Foundation");
+const stdin = $.NSFileHandle.fileHandleWithStandardInput;
+const stdout = $.NSFileHandle.fileHandleWithStandardOutput;
+const cache = {};
+let cacheSize = 0;
+let buffer = "";
+
+function fourCC(s) {
+    return (s.charCodeAt(0) << 24) | (s.charCodeAt(1) << 16) | (s.charCodeAt(2) << 8) | s.charCodeAt(3);
+}
+
+function readLine() {
+    while (true) {
+        const index = buffer.indexOf("\n");
+        if (index >= 0) {
+            const line = buffer.slice(0, index);
+            buffer = buffer.slice(index + 1);
+            return line;
+        }
+        const data = stdin.availableData;
+        if (data.length === 0) return null;
+        buffer += $.NSString.alloc.initWithDataEncoding(data, $.NSUTF8StringEncoding).js;
+    }
+}
+
+function write(obj) {
+    const line = $(JSON.stringify(obj) + "\n");
+    stdout.writeData(line.dataUsingEncoding($.NSUTF8StringEncoding));
+}
+
+function describeError(info) {
+    const message = info.objectForKey("NSAppleScriptErrorMessage");
+    const number = info.objectForKey("NSAppleScriptErrorNumber");
+    const text = message.isNil() ? "未知错误" : message.js;
+    return number.isNil() ? text : "execution error: " + text + " (" + number.js + ")";
+}
+
+function describe(desc) {
+    if (!desc || desc.isNil()) return "";
+    if (desc.descriptorType === fourCC("list")) {
+        const items = [];
+        for (let i = 1; i <= desc.numberOfItems; i++) items.push(describe(desc.descriptorAtIndex(i)));
+        return items.join(", ");
+    }
+    const value = desc.stringValue;
+    return value.isNil() ? "" : value.js;
+}
+
+function compile(source) {
+    if (cache[source]) return cache[source];
+    const script = $.NSAppleScript.alloc.initWithSource($(source));
+    const error = Ref();
+    if (!script.compileAndReturnError(error)) throw new Error(describeError(error[0]));
+    if (cacheSize >= 256) {
+        for (const key in cache) delete cache[key];
+        cacheSize = 0;
+    }
+    cache[source] = script;
+    cacheSize += 1;
+    return script;
+}
+
+function execute(request) {
+    const script = compile(request.source);
+    const event = $.NSAppleEventDescriptor.appleEventWithEventClassEventIDTargetDescriptorReturnIDTransactionID(
+        fourCC("ascr"), fourCC("psbr"), $.NSAppleEventDescriptor.nullDescriptor, -1, 0);
+    event.setParamDescriptorForKeyword($.NSAppleEventDescriptor.descriptorWithString("run_template"), fourCC("snam"));
+    const argv = $.NSAppleEventDescriptor.listDescriptor;
+    request.args.forEach((arg, i) => argv.insertDescriptorAtIndex($.NSAppleEventDescriptor.descriptorWithString(String(arg)), i + 1));
+    const params = $.NSAppleEventDescriptor.listDescriptor;
+    params.insertDescriptorAtIndex(argv, 1);
+    event.setParamDescriptorForKeyword(params, fourCC("----"));
+    const error = Ref();
+    const result = script.executeAppleEventError(event, error);
+    if (result.isNil()) return {id: request.id, code: 1, stdout: "", stderr: describeError(error[0])};
+    return {id: request.id, code: 0, stdout: describe(result), stderr: ""};
+}
+
+while (true) {
+    const line = readLine();
+    if (line === null) break;
+    if (!line.trim()) continue;
+    let request;
+    try {
+        request = JSON.parse(line);
+        write(execute(request));
+    } catch (e) {
+        write({id: request ? request.id : null, code: 1, stdout: "", stderr: String(e.message || e)});
+    }
+}
+'''
+
+
+class AppleScriptWorker:
+    """一个常驻的 osascript 进程（崩溃或超时后在下一次调用时自动重启）"""
+
+    def __init__(self, index: int, command: Optional[List[str]] = None):
+        self.index = index
+        # 可替换为其他实现相同管道协议的进程（测试用）
+        self.command = command or ["osascript", "-l", "JavaScript", "-e", APPLESCRIPT_WORKER_SOURCE]
+        self.process = None
+        self._responses = None
+        self.restarts = 0
+        self.calls = 0
+
+    def _start(self):
+        self.process = subprocess.Popen(
+            self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        self._responses = queue.Queue()
+        threading.Thread(target=self._read_stdout, args=(self.process, self._responses), daemon=True).start()
+        threading.Thread(target=self._read_stderr, args=(self.process,), daemon=True).start()
+        logger.info(f"AppleScript worker #{self.index} 已启动 (pid={self.process.pid})")
+
+    @staticmethod
+    def _read_stdout(process, responses):
+        for line in process.stdout:
+            try:
+                responses.put(json.loads(line))
+            except json.JSONDecodeError:
+                logger.warning(f"AppleScript worker 输出无法解析: {line[:200]!r}")
+        responses.put(None)  # 进程退出
+
+    def _read_stderr(self, process):
+        for line in process.stderr:
+            logger.warning(f"AppleScript worker #{self.index}: {line.decode('utf-8', 'replace').rstrip()}")
+
+    def _kill(self):
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+        self.process = None
+
+    def call(self, source: str, args: List[str], timeout: float) -> ScriptResult:
+        if self.process is None or self.process.poll() is not None:
+            if self.calls:
+                self.restarts += 1
+                logger.warning(f"AppleScript worker #{self.index} 已退出，正在重启")
+            self._start()
+
+        request_id = uuid.uuid4().hex
+        request = {"id": request_id, "source": source, "args": [str(a) for a in args]}
+        try:
+            # ensure_ascii 保证每行都是纯 ASCII，worker 按块读取时不会截断多字节字符
+            self.process.stdin.write((json.dumps(request) + "\n").encode("ascii"))
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            self._kill()
+            return ScriptResult(1, "", f"AppleScript worker 写入失败: {e}")
+
+        self.calls += 1
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                response = self._responses.get(timeout=max(remaining, 0))
+            except queue.Empty:
+                # 正在执行的 AppleScript 无法中断，只能结束进程（下次调用时重启）
+                self._kill()
+                raise subprocess.TimeoutExpired("osascript", timeout)
+            if response is None:
+                self._kill()
+                return ScriptResult(1, "", "AppleScript worker 异常退出")
+            if response.get("id") == request_id:
+                return ScriptResult(response.get("code", 1), response.get("stdout", ""), response.get("stderr", ""))
+
+    def close(self):
+        if self.process and self.process.poll() is None:
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=2)
+            except Exception:
+                self.process.kill()
+        self.process = None
+
+
+class WorkerPoolScriptRunner:
+    """常驻 osascript 进程池（第一次调用时才启动进程）"""
+
+    name = "worker"
+
+    def __init__(self, size: int = APPLESCRIPT_WORKERS, command: Optional[List[str]] = None):
+        self.workers = [AppleScriptWorker(i, command) for i in range(max(1, size))]
+        self._idle = queue.Queue()
+        for worker in self.workers:
+            self._idle.put(worker)
+
+    def run(self, script: str, args: List[str] = (), timeout: float = APPLESCRIPT_TIMEOUT) -> ScriptResult:
+        source = f"on run_template(argv)\n{script}\nend run_template"
+        start = time.monotonic()
+        try:
+            worker = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise subprocess.TimeoutExpired("osascript", timeout)
+        try:
+            return worker.call(source, args, max(timeout - (time.monotonic() - start), 0.1))
+        finally:
+            self._idle.put(worker)
+
+    def stats(self) -> dict:
+        return {
+            "runner": self.name,
+            "workers": [{
+                "index": w.index,
+                "pid": w.process.pid if w.process and w.process.poll() is None else None,
+                "calls": w.calls,
+                "restarts": w.restarts,
+            } for w in self.workers],
+        }
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+
+def create_applescript_runner():
+    """根据 APPLESCRIPT_RUNNER 创建脚本执行器（auto：macOS 使用常驻进程池，其他系统逐次调用）"""
+    runner = APPLESCRIPT_RUNNER
+    if runner == "auto":
+        runner = "worker" if sys.platform == "darwin" else "subprocess"
+    if runner == "null":
+        return NullScriptRunner()
+    if runner == "subprocess":
+        return SubprocessScriptRunner()
+    return WorkerPoolScriptRunner(APPLESCRIPT_WORKERS)
+
+
+applescript_runner = create_applescript_runner()
+
+
+def run_applescript(script: str, args: List[str] = (), timeout: float = APPLESCRIPT_TIMEOUT) -> ScriptResult:
+    """
+    执行 AppleScript 模板（参数通过 argv 传入）
+    超时抛出 subprocess.TimeoutExpired，与原来的 subprocess.run 一致
+    """
+    return applescript_runner.run(script, args, timeout)
+
+
+def is_missing_object_error(error_msg: str) -> bool:
+    """AppleScript 错误是否表示对象不存在（-1728 / -1719，如事件或备忘录已被删除）"""
+    return ("-1728" in error_msg or "-1719" in error_msg or
+            "Can't get" in error_msg or "对象不存在" in error_msg)
+
+
+@app.on_event("shutdown")
+def close_applescript_runner():
+    """关闭常驻的 AppleScript 进程"""
+    applescript_runner.close()
+
+
+# 脚本模板
+# argv: 备忘录名称, HTML 内容；按名称一次性查询（whose），找不到时在第一个账户的第一个文件夹创建，返回备忘录ID
+NOTES_APPEND_SCRIPT = '''
+set noteName to item 1 of argv
+set htmlBody to item 2 of argv
+tell application "Notes"
+    set matchedNotes to (every note whose name is noteName)
+    if (count of matchedNotes) > 0 then
+        set targetNote to item 1 of matchedNotes
+    else
+        if (count of accounts) = 0 then error "未找到 Notes 账户"
+        set targetAccount to item 1 of accounts
+        if (count of folders of targetAccount) = 0 then error "未找到 Notes 文件夹"
+        set targetFolder to item 1 of folders of targetAccount
+        set targetNote to make new note at targetFolder with properties {name:noteName, body:""}
+    end if
+    set body of targetNote to (body of targetNote) & "<br><br>" & htmlBody
+    return id of targetNote
+end tell
+'''
+
+# argv: 备忘录ID, HTML 内容（ID 失效时报 -1728）
+NOTES_APPEND_BY_ID_SCRIPT = '''
+tell application "Notes"
+    set targetNote to note id (item 1 of argv)
+    set body of targetNote to (body of targetNote) & "<br><br>" & (item 2 of argv)
+    return id of targetNote
+end tell
+'''
+
+# argv: 日历名称, 颜色 "r,g,b"（空字符串表示不设置）, 标题, 开始偏移秒数, 结束偏移秒数, 描述, 重复规则（可为空）
+CALENDAR_ADD_EVENT_SCRIPT = '''
+set calendarName to item 1 of argv
+set colorSpec to item 2 of argv
+tell application "Calendar"
+    activate
+    try
+        set targetCalendar to calendar calendarName
+    on error
+        make new calendar with properties {name:calendarName}
+        set targetCalendar to calendar calendarName
+    end try
+    if colorSpec is not "" then
+        set AppleScript's text item delimiters to ","
+        set rgbValues to text items of colorSpec
+        set AppleScript's text item delimiters to ""
+        set color of targetCalendar to {(item 1 of rgbValues) as integer, (item 2 of rgbValues) as integer, (item 3 of rgbValues) as integer}
+    end if
+    tell targetCalendar
+        make new event at end with properties {summary:(item 3 of argv), start date:(current date) + ((item 4 of argv) as integer), end date:(current date) + ((item 5 of argv) as integer), description:(item 6 of argv)}
+        set newEvent to result
+        if (item 7 of argv) is not "" then set recurrence of newEvent to (item 7 of argv)
+        return id of newEvent
+    end tell
+end tell
+'''
+
+# argv: 日历名称1, 事件ID1, 日历名称2, 事件ID2, ...
+# 每个事件输出一行 "OK<TAB>序号"、"MISSING<TAB>序号<TAB>错误信息"（-1728 / -1719）或 "ERR<TAB>序号<TAB>错误信息"
+CALENDAR_DELETE_EVENTS_SCRIPT = '''
+set output to ""
+tell application "Calendar"
+    repeat with i from 1 to (count of argv) by 2
+        set eventIndex to (i - 1) div 2
+        try
+            delete (event id (item (i + 1) of argv) of calendar (item i of argv))
+            set output to output & "OK" & tab & eventIndex & linefeed
+        on error errMsg number errNum
+            if errNum is -1728 or errNum is -1719 then
+                set output to output & "MISSING" & tab & eventIndex & tab & errMsg & linefeed
+            else
+                set output to output & "ERR" & tab & eventIndex & tab & errMsg & linefeed
+            end if
+        end try
+    end repeat
+end tell
+return output
+'''
+
+# argv: 日历名称, r, g, b
+CALENDAR_SET_COLOR_SCRIPT = '''
+tell application "Calendar"
+    activate
+    try
+        set targetCalendar to calendar (item 1 of argv)
+        set color of targetCalendar to {(item 2 of argv) as integer, (item 3 of argv) as integer, (item 4 of argv) as integer}
+    end try
+end tell
+'''
+
+
+def hex_to_rgb(hex_color: str) -> tuple:
+    """将十六进制颜色转换为 RGB 元组 (0-65535)"""
+    hex_color = hex_color.lstrip('#')
+    if len(hex_color) == 6:
+        r = int(hex_color[0:2], 16)
         g = int(hex_color[2:4], 16)
         b = int(hex_color[4:6], 16)
         # AppleScript 使用 0-65535 范围的 RGB
@@ -585,20 +2716,18 @@ def hex_to_rgb(hex_color: str) -> tuple:
     return (49152, 49152, 49152)  # 默认灰色
 
 
-def add_to_calendar_via_applescript(event_data: dict) -> dict:
-    """使用 AppleScript 添加到苹果日历，返回事件ID"""
-    activity = event_data.get('activity', '未命名活动')
+RECURRENCE_RULES = {
+    "daily": "FREQ=DAILY;INTERVAL=1",
+    "weekly": "FREQ=WEEKLY;INTERVAL=1",
+    "monthly": "FREQ=MONTHLY;INTERVAL=1",
+    "yearly": "FREQ=YEARLY;INTERVAL=1",
+}
+
+
+def calendar_event_offsets(event_data: dict) -> tuple:
+    """事件开始 / 结束时间相对当前时间的秒数（AppleScript 中用 (current date) + 秒数 表示）"""
     start_time = event_data.get('start_time')
     end_time = event_data.get('end_time')
-    description = event_data.get('description', '') or event_data.get('location', '')
-    calendar_name = event_data.get('calendar_name', 'TimeFlow')  # 默认使用 TimeFlow
-    recurrence = event_data.get('recurrence')  # 重复规则
-    tag_color = event_data.get('tag_color')  # 标签颜色（十六进制，如 #FF6B6B）
-    
-    # 转义特殊字符
-    escaped_activity = escape_apple_script(activity)
-    escaped_description = escape_apple_script(description)
-    escaped_calendar = escape_apple_script(calendar_name)
     
     # 格式化日期
     if start_time:
@@ -619,11 +2748,36 @@ def add_to_calendar_via_applescript(event_data: dict) -> dict:
     else:
         end_seconds = start_seconds + 3600
     
-    # 构建 AppleScript 命令（创建事件并返回事件ID）
+    return start_seconds, end_seconds
+
+
+def build_new_event_commands(event_data: dict) -> List[str]:
+    """构建创建单个事件的 AppleScript 命令（需在 tell targetCalendar 内执行，结果为 newEvent）"""
+    activity = event_data.get('activity', '未命名活动')
+    description = event_data.get('description', '') or event_data.get('location', '')
+    recurrence = event_data.get('recurrence')  # 重复规则
+    
+    # 转义特殊字符
+    escaped_activity = escape_apple_script(activity)
+    escaped_description = escape_apple_script(description)
+    start_seconds, end_seconds = calendar_event_offsets(event_data)
+    
+    commands = [
+        f'make new event at end with properties {{summary:"{escaped_activity}", start date:(current date) + {start_seconds}, end date:(current date) + {end_seconds}, description:"{escaped_description}"}}',
+        'set newEvent to result'
+    ]
+    
+    # 添加重复规则（如果指定）
+    if recurrence in RECURRENCE_RULES:
+        commands.append(f'set recurrence of newEvent to "{RECURRENCE_RULES[recurrence]}"')
+    
+    return commands
+
+
+def build_calendar_lookup_commands(calendar_name: str, tag_color: Optional[str]) -> List[str]:
+    """构建查找（不存在则创建）日历并设置颜色的 AppleScript 命令（结果为 targetCalendar）"""
     commands = [
-        'tell application "Calendar"',
-        'activate',
-        f'set calendarName to "{escaped_calendar}"',
+        f'set calendarName to "{escape_apple_script(calendar_name)}"',
         'try',
         f'set targetCalendar to calendar calendarName',
         'on error',
@@ -641,44 +2795,36 @@ def add_to_calendar_via_applescript(event_data: dict) -> dict:
         except Exception as e:
             logger.warning(f"设置日历颜色失败: {e}")
     
-    commands.extend([
-        'tell targetCalendar',
-        f'make new event at end with properties {{summary:"{escaped_activity}", start date:(current date) + {start_seconds}, end date:(current date) + {end_seconds}, description:"{escaped_description}"}}',
-        'set newEvent to result'
-    ])
+    return commands
+
+
+def add_to_calendar_via_applescript(event_data: dict) -> dict:
+    """使用 AppleScript 添加到苹果日历，返回事件ID"""
+    calendar_name = event_data.get('calendar_name', 'TimeFlow')  # 默认使用 TimeFlow
+    tag_color = event_data.get('tag_color')  # 标签颜色（十六进制，如 #FF6B6B）
+    description = event_data.get('description', '') or event_data.get('location', '')
+    start_seconds, end_seconds = calendar_event_offsets(event_data)
     
-    # 添加重复规则（如果指定）
-    if recurrence:
-        if recurrence == "daily":
-            commands.append('set recurrence of newEvent to "FREQ=DAILY;INTERVAL=1"')
-        elif recurrence == "weekly":
-            commands.append('set recurrence of newEvent to "FREQ=WEEKLY;INTERVAL=1"')
-        elif recurrence == "monthly":
-            commands.append('set recurrence of newEvent to "FREQ=MONTHLY;INTERVAL=1"')
-        elif recurrence == "yearly":
-            commands.append('set recurrence of newEvent to "FREQ=YEARLY;INTERVAL=1"')
-    
-    commands.extend([
-        'set eventId to id of newEvent',
-        'return eventId',
-        'end tell',
-        'end tell'
-    ])
-    
-    # 转义单引号
-    escaped_commands = [c.replace("'", "'\\''") for c in commands]
-    
-    # 使用多个 -e 参数执行 AppleScript
-    cmd = "osascript " + " ".join([f"-e '{c}'" for c in escaped_commands])
+    # 如果提供了标签颜色，设置日历颜色
+    color_spec = ""
+    if tag_color:
+        try:
+            r, g, b = hex_to_rgb(tag_color)
+            color_spec = f"{r},{g},{b}"
+            logger.info(f"设置日历颜色: {calendar_name} -> {tag_color} (RGB: {r}, {g}, {b})")
+        except Exception as e:
+            logger.warning(f"设置日历颜色失败: {e}")
     
     try:
-        result = subprocess.run(
-            cmd,
-            shell=True,
-            capture_output=True,
-            text=True,
-            timeout=10
-        )
+        result = run_applescript(CALENDAR_ADD_EVENT_SCRIPT, [
+            calendar_name,
+            color_spec,
+            event_data.get('activity', '未命名活动'),
+            start_seconds,
+            end_seconds,
+            description,
+            RECURRENCE_RULES.get(event_data.get('recurrence'), "")
+        ])
         
         if result.returncode == 0:
             event_id = result.stdout.strip()
@@ -691,398 +2837,2347 @@ def add_to_calendar_via_applescript(event_data: dict) -> dict:
         return {"success": False, "error": str(e)}
 
 
-def undo_last_events_via_applescript() -> dict:
-    """撤回最近写入的多个日历事件（一次操作的所有事件）
-    从历史记录中删除最近一次操作，并更新最近事件文件
+def build_batch_calendar_script(events_data: List[dict]) -> str:
     """
-    # 优先从历史记录读取（更可靠）
-    if os.path.exists(EVENT_HISTORY_FILE):
-        try:
-            with open(EVENT_HISTORY_FILE, 'r', encoding='utf-8') as f:
-                history = json.load(f)
-            
-            operations = history.get("operations", [])
-            if not operations:
-                return {"success": False, "error": "历史记录为空"}
-            
-            # 获取最近一次操作
-            last_operation = operations[0]
-            event_ids = last_operation.get("event_ids", [])
-            events_data = last_operation.get("events", [])
-            
-            if not event_ids:
-                return {"success": False, "error": "事件ID列表为空"}
-            
-            # 逐个删除事件，记录每个事件的删除状态
-            delete_results = []
-            for i, (event_id, event_data) in enumerate(zip(event_ids, events_data)):
-                activity = event_data.get("activity", "未命名活动")
-                try:
-                    # 构建单个事件的删除命令
-                    commands = [
-                        'tell application "Calendar"',
-                        'activate',
-                        'set calendarName to "TimeFlow"',
-                        'set targetCalendar to calendar calendarName',
-                        'tell targetCalendar',
-                        f'set eventToDelete to event id "{event_id}"',
-                        'delete eventToDelete',
-                        'return "success"',
-                        'end tell',
-                        'end tell'
-                    ]
-                    
-                    escaped_commands = [c.replace("'", "'\\''") for c in commands]
-                    cmd = "osascript " + " ".join([f"-e '{c}'" for c in escaped_commands])
-                    
-                    result = subprocess.run(
-                        cmd,
-                        shell=True,
-                        capture_output=True,
-                        text=True,
-                        timeout=10
-                    )
-                    
-                    if result.returncode == 0:
-                        delete_results.append({
-                            "event_id": event_id,
-                            "activity": activity,
-                            "success": True
-                        })
-                    else:
-                        error_msg = result.stderr.strip() or result.stdout.strip() or "未知错误"
-                        # 检查是否是事件不存在的错误（-1728）
-                        if "-1728" in error_msg or "Can't get event" in error_msg or "对象不存在" in error_msg:
-                            error_msg = "事件不存在（可能已被手动删除）"
-                        delete_results.append({
-                            "event_id": event_id,
-                            "activity": activity,
-                            "success": False,
-                            "error": error_msg
-                        })
-                except Exception as e:
-                    error_msg = str(e)
-                    # 检查是否是事件不存在的错误
-                    if "-1728" in error_msg or "Can't get event" in error_msg:
-                        error_msg = "事件不存在（可能已被手动删除）"
-                    delete_results.append({
-                        "event_id": event_id,
-                        "activity": activity,
-                        "success": False,
-                        "error": error_msg
-                    })
-            
-            # 统计成功和失败的数量
-            success_count = sum(1 for r in delete_results if r.get("success"))
-            failed_count = len(delete_results) - success_count
-            
-            # 如果至少有一个成功，更新历史记录
-            if success_count > 0:
-                # 从历史记录中删除最近一次操作
-                operations.pop(0)
-                history["operations"] = operations
-                
-                with open(EVENT_HISTORY_FILE, 'w', encoding='utf-8') as f:
-                    json.dump(history, f, ensure_ascii=False, indent=2)
-                
-                # 更新最近事件文件（如果有下一个操作）
-                if operations:
-                    next_operation = operations[0]
-                    with open(RECENT_EVENT_FILE, 'w', encoding='utf-8') as f:
-                        json.dump({
-                            "event_ids": next_operation.get("event_ids", []),
-                            "events": next_operation.get("events", []),
-                            "created_at": next_operation.get("created_at"),
-                            "count": next_operation.get("count", 0)
-                        }, f, ensure_ascii=False, indent=2)
-                else:
-                    # 没有更多操作，删除最近事件文件
-                    if os.path.exists(RECENT_EVENT_FILE):
-                        os.remove(RECENT_EVENT_FILE)
-            
-            # 即使所有事件都失败，也返回结果（而不是抛出异常）
-            # 这样前端可以显示每个事件的详细状态
-            return {
-                "success": success_count > 0,  # 至少有一个成功才算整体成功
-                "message": f"成功撤回 {success_count} 个事件，失败 {failed_count} 个",
-                "deleted_count": success_count,
-                "failed_count": failed_count,
-                "results": delete_results,  # 每个事件的删除结果
-                "deleted_events": events_data
-            }
-                
-        except Exception as e:
-            logger.error(f"从历史记录撤回失败: {e}")
-            # Fallback 到旧的逻辑
+    构建一次性创建多个事件的 AppleScript 程序
+    - 事件按日历分组，每个日历只查找 / 创建一次，颜色只设置一次
+    - 每个事件单独 try，输出一行 "OK<TAB>序号<TAB>事件ID" 或 "ERR<TAB>序号<TAB>错误信息"
+    """
+    groups = OrderedDict()
+    for index, event_data in enumerate(events_data):
+        calendar_name = event_data.get('calendar_name') or 'TimeFlow'
+        groups.setdefault(calendar_name, []).append(index)
     
-    # Fallback：使用旧的最近事件文件（向后兼容）
-    if not os.path.exists(RECENT_EVENT_FILE):
-        return {"success": False, "error": "没有找到最近写入的事件"}
+    lines = ['set output to ""', 'tell application "Calendar"', 'activate']
+    for calendar_name, indexes in groups.items():
+        # 同一日历取第一个提供了颜色的事件的标签颜色
+        tag_color = next((events_data[i].get('tag_color') for i in indexes if events_data[i].get('tag_color')), None)
+        lines.append('try')
+        lines.extend(build_calendar_lookup_commands(calendar_name, tag_color))
+        lines.append('tell targetCalendar')
+        for index in indexes:
+            lines.append('try')
+            lines.extend(build_new_event_commands(events_data[index]))
+            lines.append(f'set output to output & "OK" & tab & "{index}" & tab & (id of newEvent) & linefeed')
+            lines.append('on error errMsg')
+            lines.append(f'set output to output & "ERR" & tab & "{index}" & tab & errMsg & linefeed')
+            lines.append('end try')
+        lines.append('end tell')
+        lines.append('on error errMsg')
+        # 日历本身无法访问 / 创建时，该组所有事件都失败
+        for index in indexes:
+            lines.append(f'set output to output & "ERR" & tab & "{index}" & tab & errMsg & linefeed')
+        lines.append('end try')
+    lines.extend(['end tell', 'return output'])
+    return "\n".join(lines)
+
+
+def parse_batch_calendar_output(output: str, count: int) -> List[dict]:
+    """解析批量脚本的逐行输出，返回与输入顺序一致的每个事件结果"""
+    results = [None] * count
+    last_index = None
+    for line in output.splitlines():
+        parts = line.split("\t", 2)
+        if len(parts) == 3 and parts[0] in ("OK", "ERR") and parts[1].isdigit() and int(parts[1]) < count:
+            last_index = int(parts[1])
+            if results[last_index] and results[last_index]["success"]:
+                # 已成功创建的事件不被后续的分组级错误覆盖
+                continue
+            if parts[0] == "OK":
+                results[last_index] = {"success": True, "event_id": parts[2].strip(), "message": "事件已添加到日历"}
+            else:
+                results[last_index] = {"success": False, "error": parts[2].strip()}
+        elif last_index is not None and results[last_index] and not results[last_index]["success"]:
+            # 多行错误信息，拼接到上一条
+            results[last_index]["error"] += "\n" + line
+    return [r or {"success": False, "error": "AppleScript 未返回该事件的结果"} for r in results]
+
+
+def add_events_to_calendar_via_applescript(events_data: List[dict]) -> List[dict]:
+    """
+    使用一次 AppleScript 调用批量添加多个事件到苹果日历
     
+    Returns:
+        与 events_data 顺序一致的结果列表（格式同 add_to_calendar_via_applescript）
+    """
+    if not events_data:
+        return []
+    
+    script = build_batch_calendar_script(events_data)
     try:
-        with open(RECENT_EVENT_FILE, 'r', encoding='utf-8') as f:
-            events_info = json.load(f)
-        
-        if "event_ids" in events_info:
-            event_ids = events_info.get("event_ids", [])
-            events_data = events_info.get("events", [])
-        elif "event_id" in events_info:
-            event_ids = [events_info.get("event_id")]
-            events_data = [events_info]
+        result = run_applescript(script, timeout=max(APPLESCRIPT_TIMEOUT, 5 * len(events_data)))
+        if result.returncode != 0:
+            error = result.stderr.strip() or "未知错误"
+            return [{"success": False, "error": error} for _ in events_data]
+        return parse_batch_calendar_output(result.stdout, len(events_data))
+    except subprocess.TimeoutExpired:
+        return [{"success": False, "error": "AppleScript 执行超时"} for _ in events_data]
+    except Exception as e:
+        return [{"success": False, "error": str(e)} for _ in events_data]
+
+
+def delete_calendar_events_via_applescript(events: List[tuple]) -> List[dict]:
+    """
+    一次 AppleScript 调用删除多个日历事件
+    
+    Args:
+        events: [(事件ID, 日历名称), ...]
+    
+    Returns:
+        与输入顺序一致的结果列表，status 为 deleted / missing（事件不存在）/ failed
+    """
+    if not events:
+        return []
+    
+    args = []
+    for event_id, calendar_name in events:
+        args.extend([calendar_name or "TimeFlow", event_id])
+    
+    try:
+        result = run_applescript(
+            CALENDAR_DELETE_EVENTS_SCRIPT, args,
+            timeout=max(APPLESCRIPT_TIMEOUT, 2 * len(events))
+        )
+    except subprocess.TimeoutExpired:
+        return [{"event_id": e[0], "status": "failed", "error": "AppleScript 执行超时"} for e in events]
+    except Exception as e:
+        return [{"event_id": ev[0], "status": "failed", "error": str(e)} for ev in events]
+    
+    if result.returncode != 0:
+        error_msg = result.stderr.strip() or result.stdout.strip() or "未知错误"
+        return [{"event_id": e[0], "status": "failed", "error": error_msg} for e in events]
+    
+    results = [None] * len(events)
+    for line in result.stdout.splitlines():
+        parts = line.split("\t", 2)
+        if len(parts) < 2 or not parts[1].isdigit() or int(parts[1]) >= len(events):
+            continue
+        index = int(parts[1])
+        event_id = events[index][0]
+        if parts[0] == "OK":
+            results[index] = {"event_id": event_id, "status": "deleted"}
+        elif parts[0] == "MISSING":
+            results[index] = {"event_id": event_id, "status": "missing", "error": "事件不存在（可能已被手动删除）"}
         else:
-            return {"success": False, "error": "事件ID不存在"}
-        
+            error_msg = parts[2].strip() if len(parts) > 2 else "未知错误"
+            status = "missing" if is_missing_object_error(error_msg) else "failed"
+            if status == "missing":
+                error_msg = "事件不存在（可能已被手动删除）"
+            results[index] = {"event_id": event_id, "status": status, "error": error_msg}
+    return [r or {"event_id": events[i][0], "status": "failed", "error": "AppleScript 未返回该事件的结果"}
+            for i, r in enumerate(results)]
+
+
+def load_undo_operation() -> tuple:
+    """
+    读取最近一次可撤回的操作
+    存储层有操作历史时以历史为准（SQLite 后端总是如此）：此时最近事件文件可能是迁移前留下的旧文件
+    或导出时写入的副本，用它撤回会重复删除已撤回的操作。
+    只有 JSON 后端还没有操作日志时才使用旧的最近事件文件（向后兼容）
+    
+    Returns:
+        (操作, 撤回成功后的清理函数)；没有可撤回的操作时返回 (None, None)
+    """
+    if storage.has_history():
+        try:
+            operation = storage.latest_operation()
+        except Exception as e:
+            logger.error(f"从历史记录读取失败: {e}")
+            return None, None
+        return (operation, storage.mark_operation_undone) if operation else (None, None)
+    
+    # Fallback：使用旧的最近事件文件（可能是单事件的旧格式）
+    if os.path.exists(RECENT_EVENT_FILE):
+        with open(RECENT_EVENT_FILE, 'r', encoding='utf-8') as f:
+            events_info = json.load(f)
+        if "event_ids" in events_info:
+            operation = {"event_ids": events_info.get("event_ids", []), "events": events_info.get("events", [])}
+        elif "event_id" in events_info:
+            operation = {"event_ids": [events_info.get("event_id")], "events": [events_info]}
+        else:
+            return None, None
+        return operation, lambda removed=None: os.remove(RECENT_EVENT_FILE)
+    
+    return None, None
+
+
+def undo_last_events_via_applescript() -> dict:
+    """撤回最近写入的多个日历事件（一次操作的所有事件）
+    一次 AppleScript 调用删除该操作的所有事件，并把该操作移到重做栈
+    """
+    try:
+        operation, remove_operation = load_undo_operation()
+        if operation is None:
+            return {"success": False, "error": "没有找到最近写入的事件"}
+        
+        event_ids = operation.get("event_ids", [])
+        events_data = operation.get("events", [])
         if not event_ids:
             return {"success": False, "error": "事件ID列表为空"}
         
-        # 逐个删除事件，记录每个事件的删除状态（与主逻辑一致）
+        pairs = list(zip(event_ids, events_data))
+        results = delete_calendar_events_via_applescript([
+            (event_id, event_data.get("calendar_name") if isinstance(event_data, dict) else None)
+            for event_id, event_data in pairs
+        ])
+        
+        # 每个事件的删除状态（deleted / missing / failed）
         delete_results = []
-        for i, (event_id, event_data) in enumerate(zip(event_ids, events_data)):
-            activity = event_data.get("activity", "未命名活动") if isinstance(event_data, dict) else "未命名活动"
-            try:
-                commands = [
-                    'tell application "Calendar"',
-                    'activate',
-                    'set calendarName to "TimeFlow"',
-                    'set targetCalendar to calendar calendarName',
-                    'tell targetCalendar',
-                    f'set eventToDelete to event id "{event_id}"',
-                    'delete eventToDelete',
-                    'return "success"',
-                    'end tell',
-                    'end tell'
-                ]
-                
-                escaped_commands = [c.replace("'", "'\\''") for c in commands]
-                cmd = "osascript " + " ".join([f"-e '{c}'" for c in escaped_commands])
-                
-                result = subprocess.run(
-                    cmd,
-                    shell=True,
-                    capture_output=True,
-                    text=True,
-                    timeout=10
-                )
-                
-                if result.returncode == 0:
-                    delete_results.append({
-                        "event_id": event_id,
-                        "activity": activity,
-                        "success": True
-                    })
-                else:
-                    error_msg = result.stderr.strip() or result.stdout.strip() or "未知错误"
-                    # 检查是否是事件不存在的错误（-1728）
-                    if "-1728" in error_msg or "Can't get event" in error_msg or "对象不存在" in error_msg:
-                        error_msg = "事件不存在（可能已被手动删除）"
-                    delete_results.append({
-                        "event_id": event_id,
-                        "activity": activity,
-                        "success": False,
-                        "error": error_msg
-                    })
-            except Exception as e:
-                error_msg = str(e)
-                # 检查是否是事件不存在的错误
-                if "-1728" in error_msg or "Can't get event" in error_msg:
-                    error_msg = "事件不存在（可能已被手动删除）"
-                delete_results.append({
-                    "event_id": event_id,
-                    "activity": activity,
-                    "success": False,
-                    "error": error_msg
-                })
+        for (event_id, event_data), result in zip(pairs, results):
+            item = {
+                "event_id": event_id,
+                "activity": event_data.get("activity", "未命名活动") if isinstance(event_data, dict) else "未命名活动",
+                "success": result["status"] == "deleted",
+                "status": result["status"]
+            }
+            if result.get("error"):
+                item["error"] = result["error"]
+            delete_results.append(item)
         
-        # 统计成功和失败的数量
-        success_count = sum(1 for r in delete_results if r.get("success"))
-        failed_count = len(delete_results) - success_count
+        # 统计成功、不存在和失败的数量
+        success_count = sum(1 for r in delete_results if r["status"] == "deleted")
+        missing_count = sum(1 for r in delete_results if r["status"] == "missing")
+        failed_count = len(delete_results) - success_count - missing_count
         
-        # 如果至少有一个成功，删除最近事件文件
-        if success_count > 0:
-            os.remove(RECENT_EVENT_FILE)
+        # 至少删除了一个事件（或全部已不存在）时，把该操作移到重做栈
+        # 部分删除失败时重做栈只保存实际删除 / 已不存在的事件，重做不会重复创建仍在日历中的事件
+        if success_count > 0 or missing_count == len(delete_results):
+            if failed_count:
+                removed_pairs = [pair for pair, r in zip(pairs, delete_results) if r["status"] != "failed"]
+                remove_operation({
+                    **operation,
+                    "event_ids": [event_id for event_id, _ in removed_pairs],
+                    "events": [event_data for _, event_data in removed_pairs],
+                    "count": len(removed_pairs)
+                })
+            else:
+                remove_operation()
         
         # 即使所有事件都失败，也返回结果（而不是抛出异常）
+        # 这样前端可以显示每个事件的详细状态
         return {
             "success": success_count > 0,  # 至少有一个成功才算整体成功
             "message": f"成功撤回 {success_count} 个事件，失败 {failed_count} 个",
             "deleted_count": success_count,
+            "missing_count": missing_count,
             "failed_count": failed_count,
-            "results": delete_results,
-            "deleted_events": events_data if isinstance(events_data, list) else [events_data]
+            "results": delete_results,  # 每个事件的删除结果
+            "deleted_events": events_data
         }
-            
-    except FileNotFoundError:
-        return {"success": False, "error": "没有找到最近写入的事件"}
     except Exception as e:
+        logger.error(f"撤回事件失败: {e}")
         return {"success": False, "error": str(e)}
 
 
-# API 路由
-@app.get("/")
-async def root():
-    """返回前端页面"""
-    # 使用 MacApp 的前端文件
-    mac_app_static = os.path.join("MacApp", "static", "index.html")
-    if os.path.exists(mac_app_static):
-        return FileResponse(mac_app_static)
-    else:
-        raise FileNotFoundError("MacApp/static/index.html 不存在")
+def undo_events_via_applescript(steps: int = 1) -> dict:
+    """
+    连续撤回最近的 steps 次操作（遇到失败或没有更多操作时停止）
+    返回字段与单次撤回一致，计数为所有步骤的合计
+    """
+    undone = []
+    for _ in range(steps):
+        result = undo_last_events_via_applescript()
+        undone.append(result)
+        if not result.get("success"):
+            break
+    
+    succeeded = [r for r in undone if r.get("success")]
+    if not succeeded:
+        # 第一步就失败，直接返回该步骤的结果
+        return {**undone[0], "steps": 0}
+    
+    deleted_count = sum(r.get("deleted_count", 0) for r in undone)
+    failed_count = sum(r.get("failed_count", 0) for r in undone)
+    return {
+        "success": True,
+        "message": f"撤回 {len(succeeded)} 次操作，成功撤回 {deleted_count} 个事件，失败 {failed_count} 个",
+        "steps": len(succeeded),
+        "deleted_count": deleted_count,
+        "missing_count": sum(r.get("missing_count", 0) for r in undone),
+        "failed_count": failed_count,
+        "results": [item for r in undone for item in r.get("results", [])],
+        "deleted_events": [event for r in undone for event in r.get("deleted_events", [])],
+        "redo_count": storage.redo_count()
+    }
+
+
+def redo_last_events_via_applescript() -> dict:
+    """
+    重做最近一次撤回的操作：重新创建该操作的所有事件（一次 AppleScript 调用），
+    用新的事件ID把操作放回操作历史
+    """
+    try:
+        operation = storage.latest_undone_operation()
+        if operation is None:
+            return {"success": False, "error": "没有可以重做的操作"}
+        
+        events_data = [event for event in operation.get("events", []) if isinstance(event, dict)]
+        if not events_data:
+            return {"success": False, "error": "操作中没有事件"}
+        
+        script_events = []
+        for event_data in events_data:
+            tag = event_data.get("tag") or event_data.get("calendar_name") or "生活"
+            script_events.append({**event_data, "tag_color": get_tag_by_name(tag).get("color", "#95E1D3")})
+        results = add_events_to_calendar_via_applescript(script_events)
+        
+        event_ids = []
+        redone_events = []
+        redo_results = []
+        for event_data, result in zip(events_data, results):
+            item = {
+                "activity": event_data.get("activity", "未命名活动"),
+                "success": bool(result.get("success"))
+            }
+            if result.get("success"):
+                item["event_id"] = result.get("event_id")
+                event_ids.append(result.get("event_id"))
+                redone_events.append(event_data)
+            else:
+                item["error"] = result.get("error", "未知错误")
+            redo_results.append(item)
+        
+        # 至少重新创建了一个事件才放回操作历史（只记录创建成功的事件）
+        if event_ids:
+            storage.mark_operation_redone({
+                **operation,
+                "event_ids": event_ids,
+                "events": redone_events,
+                "count": len(event_ids),
+                "redone_at": datetime.now().isoformat()
+            })
+        
+        return {
+            "success": bool(event_ids),
+            "message": f"成功重做 {len(event_ids)} 个事件，失败 {len(events_data) - len(event_ids)} 个",
+            "operation_id": operation.get("id"),
+            "event_ids": event_ids,
+            "created_count": len(event_ids),
+            "failed_count": len(events_data) - len(event_ids),
+            "results": redo_results,
+            "redo_count": storage.redo_count()
+        }
+    except Exception as e:
+        logger.error(f"重做事件失败: {e}")
+        return {"success": False, "error": str(e)}
+
+
+# ==================== 后台任务队列 ====================
+# 日历 / 备忘录的写入（AppleScript 副作用）放到持久化的任务队列中执行：
+# - 任务保存在 SQLite（jobs 表），重启后继续执行未完成的任务
+# - JOB_CONCURRENCY 个 worker 并发执行，失败后按指数退避重试
+# - 相同 idempotency_key 只会创建一个任务
+
+
+class JobQueue:
+    """持久化的进程内任务队列"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        type TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL,
+        next_run_at REAL NOT NULL,
+        idempotency_key TEXT UNIQUE,
+        result TEXT,
+        error TEXT,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_jobs_status_next_run ON jobs(status, next_run_at);
+    """
+
+    def __init__(self, path: str, concurrency: int = 1, max_attempts: int = 3):
+        self.path = path
+        self.concurrency = max(1, concurrency)
+        self.max_attempts = max(1, max_attempts)
+        self.handlers = {}
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(self.SCHEMA)
+        # 上次退出时正在执行的任务重新排队
+        self._conn.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'")
+        self._loop = None
+        self._wakeup = None
+        self._workers = []
+
+    def register(self, job_type: str, handler):
+        """注册任务处理函数：handler(payload, job) -> dict（success 为 False 时重试，retry 为 False 时不再重试）"""
+        self.handlers[job_type] = handler
+
+    @staticmethod
+    def _to_dict(row) -> dict:
+        return {
+            "id": row["id"],
+            "type": row["type"],
+            "status": row["status"],
+            "attempts": row["attempts"],
+            "max_attempts": row["max_attempts"],
+            "payload": json.loads(row["payload"]),
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "error": row["error"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+
+    def enqueue(self, job_type: str, payload: dict, idempotency_key: Optional[str] = None,
+                max_attempts: Optional[int] = None) -> dict:
+        """创建任务（相同 idempotency_key 返回已有任务）"""
+        if job_type not in self.handlers:
+            raise ValueError(f"未知的任务类型: {job_type}")
+        now = datetime.now().isoformat()
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            if idempotency_key:
+                row = self._conn.execute("SELECT * FROM jobs WHERE idempotency_key = ?", (idempotency_key,)).fetchone()
+                if row:
+                    return self._to_dict(row)
+            self._conn.execute(
+                "INSERT INTO jobs (id, type, payload, status, max_attempts, next_run_at, idempotency_key, created_at, updated_at) "
+                "VALUES (?, ?, ?, 'queued', ?, ?, ?, ?, ?)",
+                (job_id, job_type, json.dumps(payload, ensure_ascii=False), max_attempts or self.max_attempts,
+                 time.time(), idempotency_key, now, now)
+            )
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        self._notify()
+        return self._to_dict(row)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def stats(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) AS count FROM jobs GROUP BY status").fetchall()
+        return {row["status"]: row["count"] for row in rows}
+
+    def _notify(self):
+        """唤醒等待中的 worker（可在任意线程调用）"""
+        if self._loop is not None and self._wakeup is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _claim(self) -> Optional[dict]:
+        """取出一个到期的任务并标记为 running"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' AND next_run_at <= ? ORDER BY next_run_at LIMIT 1",
+                (time.time(),)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                (datetime.now().isoformat(), row["id"])
+            )
+            return self._to_dict(self._conn.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone())
+
+    def _complete(self, job: dict, result: dict):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'succeeded', result = ?, error = NULL, updated_at = ? WHERE id = ?",
+                (json.dumps(result, ensure_ascii=False), datetime.now().isoformat(), job["id"])
+            )
+
+    def _fail(self, job: dict, error: str, result: Optional[dict] = None, retry: bool = True):
+        """失败：还有重试次数时按指数退避重新排队，否则标记为 failed"""
+        now = datetime.now().isoformat()
+        with self._lock:
+            if retry and job["attempts"] < job["max_attempts"]:
+                delay = min(JOB_RETRY_BASE_DELAY * (2 ** (job["attempts"] - 1)), JOB_RETRY_MAX_DELAY)
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'queued', next_run_at = ?, error = ?, updated_at = ? WHERE id = ?",
+                    (time.time() + delay, error, now, job["id"])
+                )
+                logger.warning(f"任务 {job['type']} ({job['id']}) 第 {job['attempts']} 次失败，{delay:.1f} 秒后重试: {error}")
+            else:
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, result = ?, updated_at = ? WHERE id = ?",
+                    (error, json.dumps(result, ensure_ascii=False) if result else None, now, job["id"])
+                )
+                logger.error(f"任务 {job['type']} ({job['id']}) 失败: {error}")
+        self._notify()
+
+    def _next_delay(self) -> float:
+        """距离下一个重试任务到期的时间（最长等待 1 秒）"""
+        with self._lock:
+            row = self._conn.execute("SELECT MIN(next_run_at) AS next_run_at FROM jobs WHERE status = 'queued'").fetchone()
+        if row["next_run_at"] is None:
+            return 1.0
+        return min(max(row["next_run_at"] - time.time(), 0), 1.0)
+
+    async def _worker(self, index: int):
+        while True:
+            # 先清除唤醒标记再取任务，避免错过取任务期间新加入的任务
+            self._wakeup.clear()
+            job = await asyncio.to_thread(self._claim)
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=await asyncio.to_thread(self._next_delay))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            handler = self.handlers.get(job["type"])
+            try:
+                result = await asyncio.to_thread(handler, job["payload"], job)
+            except Exception as e:
+                await asyncio.to_thread(self._fail, job, str(e))
+                continue
+            if result.get("success"):
+                await asyncio.to_thread(self._complete, job, result)
+            else:
+                await asyncio.to_thread(self._fail, job, result.get("error", "未知错误"), result, result.get("retry", True))
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._workers = [asyncio.create_task(self._worker(i)) for i in range(self.concurrency)]
+        logger.info(f"后台任务队列已启动（并发数: {self.concurrency}）")
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._loop = None
+
+
+def run_add_event_job(payload: dict, job: dict) -> dict:
+    """任务：添加日历事件，成功后排队写入备忘录"""
+    result = add_to_calendar_via_applescript(payload["event"])
+    if result.get("success") and payload.get("note_name"):
+        job_queue.enqueue("append_note", {
+            "note_name": payload["note_name"],
+            "text": format_note_entry(payload["event"])
+        }, idempotency_key=f"{job['id']}:note")
+    return result
+
+
+def run_append_note_job(payload: dict, job: dict) -> dict:
+    """任务：追加备忘录"""
+    return append_to_notes_via_applescript(payload.get("note_name") or "时间", payload.get("text", ""))
+
+
+def run_delete_event_job(payload: dict, job: dict) -> dict:
+    """任务：删除日历事件（事件不存在时不再重试）"""
+    result = delete_calendar_events_via_applescript([(payload["event_id"], payload.get("calendar_name"))])[0]
+    if result["status"] == "deleted":
+        return {"success": True, "event_id": payload["event_id"]}
+    return {"success": False, "error": result.get("error", "未知错误"), "retry": result["status"] != "missing"}
+
+
+def run_recolor_calendar_job(payload: dict, job: dict) -> dict:
+    """任务：修改日历颜色"""
+    r, g, b = hex_to_rgb(payload["color"])
+    result = run_applescript(CALENDAR_SET_COLOR_SCRIPT, [payload["calendar_name"], r, g, b], timeout=5)
+    if result.returncode == 0:
+        logger.info(f"已同步更新日历颜色: {payload['calendar_name']} -> {payload['color']}")
+        return {"success": True}
+    return {"success": False, "error": result.stderr.strip() or "同步日历颜色失败"}
+
+
+job_queue = JobQueue(JOBS_DATABASE_FILE, concurrency=JOB_CONCURRENCY, max_attempts=JOB_MAX_ATTEMPTS)
+job_queue.register("add_event", run_add_event_job)
+job_queue.register("append_note", run_append_note_job)
+job_queue.register("delete_event", run_delete_event_job)
+job_queue.register("recolor_calendar", run_recolor_calendar_job)
+
+
+@app.on_event("startup")
+async def start_job_queue():
+    """启动后台任务 worker"""
+    await job_queue.start()
+
+
+@app.on_event("shutdown")
+async def stop_job_queue():
+    """停止后台任务 worker（未完成的任务下次启动时继续）"""
+    await job_queue.stop()
+
+
+# API 路由
+@app.get("/")
+async def root():
+    """返回前端页面"""
+    # 使用 MacApp 的前端文件
+    mac_app_static = os.path.join("MacApp", "static", "index.html")
+    if os.path.exists(mac_app_static):
+        return FileResponse(mac_app_static)
+    else:
+        raise FileNotFoundError("MacApp/static/index.html 不存在")
+
+
+# 静态文件路由将在所有 API 路由注册后挂载（见文件末尾）
+mac_app_static_dir = os.path.join("MacApp", "static")
+if not os.path.exists(mac_app_static_dir):
+    raise FileNotFoundError("MacApp/static 目录不存在")
+
+
+@app.post("/chat")
+async def chat(request: ChatRequest):
+    """
+    Chat completion endpoint
+    """
+    try:
+        response = await client.chat.completions.create(
+            model=request.model,
+            messages=request.messages
+        )
+        return {
+            "choices": [{"message": {"content": response.choices[0].message.content}}]
+        }
+    except Exception as e:
+        logger.error(f"Chat completion error: {e}")
+        return {"error": str(e)}
+
+
+@app.get("/api/transcribe/cache")
+async def get_transcript_cache_stats():
+    """
+    获取音频指纹转录缓存统计
+    """
+    return {
+        "success": True,
+        "enabled": STT_CACHE_ENABLED,
+        "persist": STT_CACHE_PERSIST,
+        "stats": transcript_cache.stats()
+    }
+
+
+@app.get("/api/health/whisper")
+async def get_whisper_health():
+    """
+    获取本地 Faster Whisper 模型池状态
+
+    Returns:
+        status（not_loaded/loading/ready/failed/unavailable）、加载和预热耗时、实例数、正在解码的请求数
+    """
+    return {"success": True, "available": FASTER_WHISPER_AVAILABLE, "whisper": whisper_models.status()}
+
+
+@app.get("/api/health/providers")
+async def get_provider_health():
+    """
+    获取各 provider 的熔断器状态
+    
+    Returns:
+        每个 provider 的状态（closed/open/half_open）、窗口错误率和最近错误
+    """
+    return {
+        "success": True,
+        "providers": {name: breaker.snapshot() for name, breaker in provider_breakers.items()}
+    }
+
+
+def get_upload_size(upload: UploadFile) -> int:
+    """获取上传文件大小（不读取内容到内存）"""
+    f = upload.file
+    position = f.tell()
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(position)
+    return size
+
+
+def build_multipart_upload(upload: UploadFile, file_field: str, fields: dict):
+    """
+    构建流式 multipart/form-data 请求体
+
+    Returns:
+        (content_type, content_length, 异步分块生成器)
+    """
+    boundary = uuid.uuid4().hex
+    filename = (upload.filename or "audio").replace('"', "%22")
+    file_content_type = upload.content_type or "application/octet-stream"
+
+    preamble = b""
+    for name, value in fields.items():
+        preamble += (
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+            f'{value}\r\n'
+        ).encode("utf-8")
+    preamble += (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+        f'Content-Type: {file_content_type}\r\n\r\n'
+    ).encode("utf-8")
+    trailer = f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+    content_length = len(preamble) + get_upload_size(upload) + len(trailer)
+
+    async def body():
+        yield preamble
+        await upload.seek(0)
+        # 分块读取，内存占用与录音长度无关
+        while True:
+            chunk = await upload.read(STT_UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+        yield trailer
+
+    return f"multipart/form-data; boundary={boundary}", content_length, body()
+
+
+async def compute_audio_fingerprint(upload: UploadFile, language: str) -> str:
+    """计算音频指纹：原始音频字节 + 语言 的 SHA-256（分块读取）"""
+    digest = hashlib.sha256()
+    digest.update(f"{language}\n".encode("utf-8"))
+    await upload.seek(0)
+    while True:
+        chunk = await upload.read(STT_UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+    await upload.seek(0)
+    return digest.hexdigest()
+
+
+def store_transcript_result(cache_key: Optional[str], result: dict) -> dict:
+    """缓存成功的转录结果，并标记缓存状态"""
+    if cache_key is None:
+        result["cache"] = "bypass"
+        return result
+    result["cache"] = "miss"
+    cached = {k: v for k, v in result.items() if k != "cache"}
+    transcript_cache.set(cache_key, cached)
+    persist_transcript_result(cache_key, cached)
+    return result
+
+
+@app.post("/api/transcribe")
+async def transcribe_audio(
+    audio_file: UploadFile = File(...),
+    language: str = Form("zh-CN"),
+    use_local: Optional[bool] = Form(None)
+):
+    """
+    转录音频文件为文本
+    优先级：云端 API > Faster Whisper
+    
+    Args:
+        audio_file: 音频文件
+        language: 语言代码（如 zh-CN, en-US）
+        use_local: 是否使用本地 STT 模型（None时默认使用云端API）
+    
+    Returns:
+        转录文本和元数据；本地转录排队已满时返回 429（带 Retry-After）
+    """
+    # 默认使用云端 API（准确率最高）
+    use_local_stt = use_local if use_local is not None else USE_LOCAL_STT
+    
+    # 音频指纹去重：相同录音重复上传时直接返回缓存的转录结果
+    cache_key = None
+    if STT_CACHE_ENABLED:
+        cache_key = await compute_audio_fingerprint(audio_file, language)
+        cached_result = transcript_cache.get(cache_key)
+        if cached_result is not None:
+            logger.info("转录缓存命中（相同音频已转录过）")
+            return {**cached_result, "cache": "hit"}
+    
+    # 记录所有尝试的模型和错误
+    stt_errors = []
+    tried_models = []
+    
+    # 优先使用云端转录 API（准确率最高，推荐）
+    if not use_local_stt:
+        tried_models.append("云端 STT API")
+        stt_breaker = provider_breakers["cloud_stt"]
+        try:
+            if not stt_breaker.allow_request():
+                raise ProviderUnavailableError("云端 STT API 熔断中，已跳过")
+            
+            # 流式上传：按块读取上传文件并转发，不把整个录音读入内存
+            content_type, content_length, body = build_multipart_upload(
+                audio_file, "audio_file", {"language": language}
+            )
+            
+            # 调用云端转录 API
+            response = await stt_http_client.post(
+                TRANSCRIPTION_API_URL,
+                content=body,
+                headers={
+                    "Authorization": f"Bearer {api_key}",
+                    "Content-Type": content_type,
+                    "Content-Length": str(content_length),
+                }
+            )
+            
+            if response.status_code == 200:
+                result = response.json()
+                transcript = result.get("text", "")
+                logger.info(f"云端转录成功: {transcript[:50]}...")
+                stt_breaker.record_success()
+                
+                return store_transcript_result(cache_key, {
+                    "success": True,
+                    "transcript": transcript,
+                    "detected_language": result.get("detected_language"),
+                    "confidence": result.get("confidence"),
+                    "billing": result.get("billing"),
+                    "method": "cloud"
+                })
+            else:
+                raise Exception(f"云端转录 API 错误: {response.status_code} - {response.text}")
+                
+        except asyncio.CancelledError:
+            stt_breaker.release()
+            raise
+        except Exception as e:
+            error_msg = str(e)
+            logger.error(f"云端转录失败: {error_msg}")
+            if not isinstance(e, ProviderUnavailableError):
+                stt_breaker.record_failure(error_msg)
+            # 检查是否是额度限制错误
+            if "429" in error_msg or "limit" in error_msg.lower() or "quota" in error_msg.lower() or "SetLimitExceeded" in error_msg:
+                error_detail = f"云端 STT API 已达到使用限制（429错误）"
+            elif "401" in error_msg or "AuthenticationError" in error_msg:
+                error_detail = f"云端 STT API 认证失败（401错误）"
+            else:
+                error_detail = f"云端 STT API 调用失败：{error_msg[:100]}"
+            stt_errors.append(f"模型：云端 STT API - {error_detail}")
+            # 回退到本地模型
+            use_local_stt = True
+    
+    # 使用 Faster Whisper（备用本地模型）
+    if use_local_stt and FASTER_WHISPER_AVAILABLE:
+        tried_models.append(f"Faster Whisper ({WHISPER_MODEL_SIZE})")
+        whisper_breaker = provider_breakers["faster_whisper"]
+        try:
+            if not whisper_breaker.allow_request():
+                raise ProviderUnavailableError(f"Faster Whisper ({WHISPER_MODEL_SIZE}) 熔断中，已跳过")
+            if not await asyncio.to_thread(whisper_models.load):
+                raise Exception("Faster Whisper 模型未加载")
+            
+            # 在内存中解码上传的音频（云端尝试后需要重置文件指针）
+            await audio_file.seek(0)
+            content = await audio_file.read()
+            audio = await asyncio.to_thread(decode_audio_bytes, content)
+            
+            # 转录音频
+            segments, info = await whisper_models.submit(
+                audio, language=language.split('-')[0] if language else None
+            )
+            transcript = "".join([segment.text for segment in segments]).strip()
+            transcript = normalize_transcript_text(transcript)
+            whisper_breaker.record_success()
+            
+            return store_transcript_result(cache_key, {
+                "success": True,
+                "transcript": transcript,
+                "detected_language": info.language,
+                "confidence": info.language_probability,
+                "method": "local",
+                "model": f"Faster-Whisper-{WHISPER_MODEL_SIZE}"
+            })
+                
+        except asyncio.CancelledError:
+            whisper_breaker.release()
+            raise
+        except WhisperBusyError as e:
+            # 排队已满不是模型故障：不计入熔断，直接让客户端稍后重试
+            whisper_breaker.release()
+            logger.warning(f"本地转录排队已满，拒绝请求（Retry-After: {e.retry_after}s）")
+            raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+        except Exception as e:
+            error_msg = str(e)
+            logger.error(f"本地转录失败: {e}")
+            if not isinstance(e, ProviderUnavailableError):
+                whisper_breaker.record_failure(error_msg)
+            stt_errors.append(f"模型：Faster Whisper ({WHISPER_MODEL_SIZE}) - {error_msg[:100]}")
+    
+    # 如果所有方法都失败
+    if not tried_models:
+        tried_models.append("无可用模型（Faster Whisper 未安装）")
+    
+    return {
+        "success": False,
+        "error": "所有转录方法都失败",
+        "step": "语音转文本",
+        "tried_models": tried_models,
+        "errors": stt_errors,
+        "error_summary": f"语音转文本步骤失败：已尝试 {len(tried_models)} 个模型，全部失败。详情：{'；'.join(stt_errors)}"
+    }
+
+
+# ==================== 实时转录（WebSocket） ====================
+# 按住快捷键期间客户端持续发送 16kHz 单声道 PCM（s16le），服务端用 Faster Whisper 增量解码：
+# - 能量 VAD：检测到停顿时解码停顿前的音频并确定下来，之后不再重复解码
+# - 滑动窗口：一直没有停顿、未确定的音频超过 LIVE_STT_WINDOW_SECONDS 时，确定除最后一段外的结果
+# - 每新增 LIVE_STT_PARTIAL_INTERVAL 秒语音返回一次临时结果
+# 松开快捷键（stop）时只需解码最后一次停顿之后的音频（最近的临时结果已覆盖全部语音时直接使用）
+
+LIVE_STT_SAMPLE_RATE = 16000
+LIVE_STT_FRAME = LIVE_STT_SAMPLE_RATE * 30 // 1000  # VAD 帧长（30ms）
+LIVE_STT_SPEECH_PADDING = LIVE_STT_SAMPLE_RATE * 200 // 1000  # 语音结束后保留的音频（200ms）
+LIVE_STT_PROMPT_CHARS = 200  # 作为 initial_prompt 的已确定文本长度
+
+
+class LiveTranscriber:
+    """
+    一次实时转录的音频缓冲和增量解码状态
+    add_pcm / decode / finish 都在事件循环中调用，解码通过 whisper_models.submit() 在模型池线程中执行
+    （与 /api/transcribe 共用排队上限和截止时间；同一时间只有一个解码）
+    """
+
+    def __init__(self, language: Optional[str]):
+        self.language = language
+        self._lock = threading.Lock()
+        self._audio = np.zeros(0, dtype=np.float32)  # 尚未确定的音频
+        self._vad_pos = 0  # 下一个待检测的帧
+        self._speech_end = None  # 未确定音频中最后一个语音帧的结束位置
+        self._new_speech = 0  # 上次解码后新增的语音样本数
+        self._hypothesis = None  # 最近一次临时结果 (覆盖的样本数, 文本)
+        self._committed = []
+        self.audio_samples = 0
+
+    @property
+    def committed_text(self) -> str:
+        return "".join(self._committed)
+
+    def add_pcm(self, data: bytes):
+        """追加 PCM 数据并更新 VAD 状态"""
+        samples = np.frombuffer(data[:len(data) // 2 * 2], dtype="<i2").astype(np.float32) / 32768.0
+        with self._lock:
+            self.audio_samples += len(samples)
+            self._audio = np.concatenate([self._audio, samples])
+            while self._vad_pos + LIVE_STT_FRAME <= len(self._audio):
+                frame = self._audio[self._vad_pos:self._vad_pos + LIVE_STT_FRAME]
+                if float(np.sqrt(np.mean(frame * frame))) >= LIVE_STT_VAD_THRESHOLD:
+                    self._speech_end = self._vad_pos + LIVE_STT_FRAME
+                    self._new_speech += LIVE_STT_FRAME
+                self._vad_pos += LIVE_STT_FRAME
+            if self._speech_end is None and len(self._audio) > LIVE_STT_SAMPLE_RATE:
+                # 还没有说话：只保留最近 0.3 秒作为开头
+                self._trim(len(self._audio) - LIVE_STT_SAMPLE_RATE * 3 // 10)
+
+    def _trim(self, cut: int):
+        """丢弃前 cut 个样本（需持有锁）"""
+        self._audio = self._audio[cut:]
+        self._vad_pos = max(0, self._vad_pos - cut)
+        if self._speech_end is not None:
+            self._speech_end = self._speech_end - cut if self._speech_end > cut else None
+        self._hypothesis = None
+
+    def _pause_ready(self) -> bool:
+        return self._speech_end is not None and \
+            len(self._audio) - self._speech_end >= LIVE_STT_SILENCE_SECONDS * LIVE_STT_SAMPLE_RATE
+
+    def should_decode(self) -> bool:
+        with self._lock:
+            return self._pause_ready() or self._new_speech >= LIVE_STT_PARTIAL_INTERVAL * LIVE_STT_SAMPLE_RATE
+
+    async def _transcribe(self, audio) -> list:
+        segments, _ = await whisper_models.submit(
+            audio,
+            language=self.language,
+            beam_size=1,
+            initial_prompt=self.committed_text[-LIVE_STT_PROMPT_CHARS:] or None,
+            condition_on_previous_text=False,
+        )
+        return segments
+
+    def _commit(self, text: str, cut: int):
+        with self._lock:
+            self._committed.append(text)
+            self._trim(cut)
+
+    async def decode(self) -> dict:
+        """解码未确定的音频，返回 {"text": 完整文本, "committed": 已确定的文本}"""
+        with self._lock:
+            audio = self._audio
+            speech_end = self._speech_end
+            pause = self._pause_ready()
+            self._new_speech = 0
+        if speech_end is None:
+            return {"text": self.committed_text, "committed": self.committed_text}
+
+        if pause:
+            # 停顿：停顿前的音频解码后确定下来
+            segments = await self._transcribe(audio[:min(len(audio), speech_end + LIVE_STT_SPEECH_PADDING)])
+            self._commit("".join(segment.text for segment in segments), len(audio))
+            return {"text": self.committed_text, "committed": self.committed_text}
+
+        segments = await self._transcribe(audio)
+        if len(audio) > LIVE_STT_WINDOW_SECONDS * LIVE_STT_SAMPLE_RATE and len(segments) > 1:
+            # 超过窗口长度：确定除最后一段外的结果，窗口从最后一段开始
+            cut = int(segments[-1].start * LIVE_STT_SAMPLE_RATE)
+            self._commit("".join(segment.text for segment in segments[:-1]), cut)
+            segments = segments[-1:]
+            audio = audio[cut:]
+        hypothesis = "".join(segment.text for segment in segments)
+        with self._lock:
+            self._hypothesis = (len(audio), hypothesis)
+        return {"text": self.committed_text + hypothesis, "committed": self.committed_text}
+
+    async def finish(self) -> dict:
+        """结束录音：确定剩余音频，返回最终文本"""
+        with self._lock:
+            audio = self._audio
+            speech_end = self._speech_end
+            hypothesis = self._hypothesis
+        if speech_end is not None:
+            if hypothesis is not None and hypothesis[0] >= speech_end:
+                # 最近一次临时结果已经覆盖全部语音，不需要再解码
+                self._commit(hypothesis[1], len(audio))
+            else:
+                segments = await self._transcribe(audio[:min(len(audio), speech_end + LIVE_STT_SPEECH_PADDING)])
+                self._commit("".join(segment.text for segment in segments), len(audio))
+        return {
+            "text": normalize_transcript_text(self.committed_text.strip()),
+            "audio_seconds": round(self.audio_samples / LIVE_STT_SAMPLE_RATE, 2),
+        }
+
+
+@app.websocket("/ws/transcribe")
+async def live_transcribe(websocket: WebSocket):
+    """
+    实时转录：录音期间持续发送音频，松开按键后很快得到最终文本
+
+    协议：
+        连接：/ws/transcribe?language=zh-CN，服务端就绪后发送 {"type": "ready", "sample_rate": 16000}
+        客户端 -> 服务端：二进制帧为 16kHz 单声道 PCM（s16le）；
+            文本帧 {"type": "stop"} 结束本次录音，{"type": "reset"} 丢弃本次录音
+        服务端 -> 客户端：{"type": "partial", "text", "committed"}（临时结果）、
+            {"type": "final", "text", "audio_seconds", "finalize_ms"}（最终结果）、{"type": "error", "error"}
+        同一连接可以连续录多段（每次 stop 后重新开始）
+        本地转录排队已满或超时时发送 {"type": "error", "error", "stage", "retry_after"}：
+            stage 为 partial 时只是跳过这次临时结果；为 final 时本次录音被丢弃，客户端应回退到 /api/transcribe
+    """
+    await websocket.accept()
+    language = websocket.query_params.get("language", "zh-CN")
+    language = language.split('-')[0] if language else None
+    available = np is not None and await asyncio.to_thread(whisper_models.load)
+    if not available:
+        await websocket.send_json({"type": "error", "error": "本地 Faster Whisper 不可用，请使用 /api/transcribe"})
+        await websocket.close(code=1011)
+        return
+
+    transcriber = LiveTranscriber(language)
+    decoding = None
+    await websocket.send_json({"type": "ready", "sample_rate": LIVE_STT_SAMPLE_RATE, "encoding": "pcm_s16le"})
+
+    async def send_overloaded(error: Exception, stage: str):
+        retry_after = error.retry_after if isinstance(error, WhisperBusyError) else None
+        logger.warning(f"实时转录{'临时' if stage == 'partial' else '最终'}解码被拒绝: {error}")
+        await websocket.send_json({"type": "error", "error": str(error), "stage": stage, "retry_after": retry_after})
+
+    async def send_partial(current: LiveTranscriber):
+        try:
+            started = time.monotonic()
+            result = await current.decode()
+            if current is transcriber:
+                await websocket.send_json({"type": "partial", **result,
+                                           "decode_ms": round((time.monotonic() - started) * 1000)})
+        except (WhisperBusyError, TimeoutError) as e:
+            if current is transcriber:
+                await send_overloaded(e, "partial")
+        except Exception as e:
+            logger.warning(f"实时转录临时解码失败: {e}")
+
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("bytes") is not None:
+                transcriber.add_pcm(message["bytes"])
+                if (decoding is None or decoding.done()) and transcriber.should_decode():
+                    decoding = asyncio.create_task(send_partial(transcriber))
+                continue
+
+            command = json.loads(message.get("text") or "{}")
+            if command.get("type") == "stop":
+                stop_started = time.monotonic()
+                if decoding is not None:
+                    await decoding  # 同一时间只解码一次
+                try:
+                    result = await transcriber.finish()
+                except (WhisperBusyError, TimeoutError) as e:
+                    await send_overloaded(e, "final")
+                else:
+                    result["finalize_ms"] = round((time.monotonic() - stop_started) * 1000)
+                    logger.info(f"实时转录完成（{result['audio_seconds']}s 音频，结束耗时 {result['finalize_ms']}ms）: {result['text'][:50]}")
+                    await websocket.send_json({"type": "final", **result})
+            if command.get("type") in ("stop", "reset"):
+                transcriber = LiveTranscriber(language)
+                decoding = None
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        logger.error(f"实时转录失败: {e}")
+        try:
+            await websocket.send_json({"type": "error", "error": str(e)})
+            await websocket.close(code=1011)
+        except Exception:
+            pass
+
+
+class PromptUsageStats:
+    """
+    各 provider 报告的 Prompt token 用量（用于评估前缀缓存的效果）
+    OpenAI 兼容接口（豆包 / Supermind）在 usage.prompt_tokens_details.cached_tokens 中报告命中缓存的 token 数
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._providers = {}
+
+    def record(self, provider: str, usage: Optional[dict], latency: float):
+        if not usage:
+            return
+        prompt_tokens = usage.get("prompt_tokens") or 0
+        cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+        with self._lock:
+            stats = self._providers.setdefault(provider, {
+                "requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0,
+                "cache_hit_requests": 0, "cache_reported_requests": 0,
+                "hit_latency_total": 0.0, "miss_latency_total": 0.0,
+            })
+            stats["requests"] += 1
+            stats["prompt_tokens"] += prompt_tokens
+            stats["completion_tokens"] += usage.get("completion_tokens") or 0
+            if cached_tokens is None:
+                return
+            # 只有报告了 cached_tokens 的请求才计入命中统计
+            stats["cache_reported_requests"] += 1
+            stats["cached_tokens"] += cached_tokens
+            if cached_tokens > 0:
+                stats["cache_hit_requests"] += 1
+                stats["hit_latency_total"] += latency
+            else:
+                stats["miss_latency_total"] += latency
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            result = {}
+            for provider, stats in self._providers.items():
+                hits = stats["cache_hit_requests"]
+                misses = stats["cache_reported_requests"] - hits
+                result[provider] = {
+                    "requests": stats["requests"],
+                    "prompt_tokens": stats["prompt_tokens"],
+                    "completion_tokens": stats["completion_tokens"],
+                    "cached_tokens": stats["cached_tokens"],
+                    "cached_token_ratio": round(stats["cached_tokens"] / stats["prompt_tokens"], 4) if stats["prompt_tokens"] else 0.0,
+                    "cache_hit_requests": hits,
+                    "cache_reported_requests": stats["cache_reported_requests"],
+                    "avg_latency_hit": round(stats["hit_latency_total"] / hits, 3) if hits else None,
+                    "avg_latency_miss": round(stats["miss_latency_total"] / misses, 3) if misses else None,
+                }
+            return result
+
+    def clear(self):
+        with self._lock:
+            self._providers.clear()
+
+
+prompt_usage_stats = PromptUsageStats()
+
+
+def build_doubao_request(system_prompt: str, user_prompt: str, stream: bool) -> dict:
+    """豆包 chat/completions 请求参数"""
+    payload = {
+        "model": DOUBAO_MODEL,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        "stream": stream,
+        "temperature": 0.1,
+        "max_tokens": 1000
+    }
+    if stream:
+        # 最后一个数据块中返回 usage（用于前缀缓存统计）
+        payload["stream_options"] = {"include_usage": True}
+    return {
+        "url": f"{DOUBAO_API_URL}/chat/completions",
+        "headers": {
+            "Authorization": f"Bearer {DOUBAO_API_KEY}",
+            "Content-Type": "application/json"
+        },
+        "json": payload,
+    }
+
+
+async def call_doubao(system_prompt: str, user_prompt: str) -> str:
+    """调用豆包云端模型，返回原始文本响应"""
+    call_started = time.monotonic()
+    response = await doubao_http_client.post(**build_doubao_request(system_prompt, user_prompt, stream=False))
+    if response.status_code != 200:
+        raise Exception(f"豆包 API 错误: {response.status_code} - {response.text}")
+    result = response.json()
+    prompt_usage_stats.record("doubao", result.get("usage"), time.monotonic() - call_started)
+    return result.get("choices", [{}])[0].get("message", {}).get("content", "").strip()
+
+
+async def stream_chat_completions(http_client: httpx.AsyncClient, request: dict, provider: str, label: str):
+    """流式调用 OpenAI 兼容的 chat/completions 接口（SSE），逐段返回文本，结束后记录 usage"""
+    call_started = time.monotonic()
+    usage = None
+    async with http_client.stream("POST", **request) as response:
+        if response.status_code != 200:
+            body = (await response.aread()).decode("utf-8", errors="replace")
+            raise Exception(f"{label} API 错误: {response.status_code} - {body}")
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            chunk = json.loads(data)
+            usage = chunk.get("usage") or usage
+            for choice in chunk.get("choices") or []:
+                content = (choice.get("delta") or {}).get("content")
+                if content:
+                    yield content
+    prompt_usage_stats.record(provider, usage, time.monotonic() - call_started)
+
+
+async def stream_doubao(system_prompt: str, user_prompt: str):
+    """流式调用豆包（SSE），逐段返回文本"""
+    request = build_doubao_request(system_prompt, user_prompt, stream=True)
+    async for content in stream_chat_completions(doubao_http_client, request, "doubao", "豆包"):
+        yield content
+
+
+async def call_supermind(system_prompt: str, user_prompt: str) -> str:
+    """调用 Supermind 云端 API，返回原始文本响应"""
+    call_started = time.monotonic()
+    response = await client.chat.completions.create(
+        model="supermind-agent-v1",
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        temperature=0.3,
+        max_tokens=500
+    )
+    if response.usage is not None:
+        prompt_usage_stats.record("supermind", response.usage.model_dump(), time.monotonic() - call_started)
+    return response.choices[0].message.content.strip()
+
+
+async def stream_supermind(system_prompt: str, user_prompt: str):
+    """流式调用 Supermind 云端 API（SSE），逐段返回文本"""
+    request = {
+        "url": f"{SUPERMIND_API_URL}/chat/completions",
+        "headers": {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        },
+        "json": {
+            "model": "supermind-agent-v1",
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            "stream": True,
+            "stream_options": {"include_usage": True},
+            "temperature": 0.3,
+            "max_tokens": 500
+        },
+    }
+    async for content in stream_chat_completions(supermind_http_client, request, "supermind", "Supermind"):
+        yield content
+
+
+def build_ollama_request(system_prompt: str, user_prompt: str, stream: bool) -> dict:
+    """Ollama /api/chat 请求参数"""
+    return {
+        "url": f"{OLLAMA_API_URL}/api/chat",
+        "json": {
+            "model": OLLAMA_MODEL,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            "stream": stream,
+            "options": {
+                "temperature": 0.1,  # 低温度，更确定性
+                "num_predict": 1000  # 支持多个时间块
+            }
+        },
+    }
+
+
+def record_ollama_usage(result: dict, latency: float):
+    """Ollama 只报告 Prompt token 数（不报告缓存命中）"""
+    prompt_usage_stats.record("ollama", {
+        "prompt_tokens": result.get("prompt_eval_count"),
+        "completion_tokens": result.get("eval_count"),
+    }, latency)
+
+
+async def call_ollama(system_prompt: str, user_prompt: str) -> str:
+    """调用 Ollama 本地模型（Chat API，更适合结构化输出），返回原始文本响应"""
+    call_started = time.monotonic()
+    response = await ollama_http_client.post(**build_ollama_request(system_prompt, user_prompt, stream=False))
+    if response.status_code != 200:
+        raise Exception(f"Ollama API 错误: {response.status_code} - {response.text}")
+    result = response.json()
+    record_ollama_usage(result, time.monotonic() - call_started)
+    return result.get("message", {}).get("content", "").strip()
+
+
+async def stream_ollama(system_prompt: str, user_prompt: str):
+    """流式调用 Ollama（每行一个 JSON），逐段返回文本"""
+    call_started = time.monotonic()
+    async with ollama_http_client.stream("POST", **build_ollama_request(system_prompt, user_prompt, stream=True)) as response:
+        if response.status_code != 200:
+            body = (await response.aread()).decode("utf-8", errors="replace")
+            raise Exception(f"Ollama API 错误: {response.status_code} - {body}")
+        async for line in response.aiter_lines():
+            if not line.strip():
+                continue
+            chunk = json.loads(line)
+            if chunk.get("error"):
+                raise Exception(f"Ollama API 错误: {chunk['error']}")
+            content = (chunk.get("message") or {}).get("content")
+            if content:
+                yield content
+            if chunk.get("done"):
+                record_ollama_usage(chunk, time.monotonic() - call_started)
+                break
+
+
+# LLM provider 注册表（按优先级排序：Doubao > Supermind > Ollama）
+LLM_PROVIDERS = {
+    "doubao": {"label": f"豆包 ({DOUBAO_MODEL})", "model": DOUBAO_MODEL, "call": call_doubao, "stream": stream_doubao},
+    "supermind": {"label": "Supermind (supermind-agent-v1)", "model": "supermind-agent-v1", "call": call_supermind, "stream": stream_supermind},
+    "ollama": {"label": f"Ollama ({OLLAMA_MODEL})", "model": OLLAMA_MODEL, "call": call_ollama, "stream": stream_ollama},
+}
+
+# 各 provider 最近成功请求的耗时（秒），用于计算 p95 对冲延迟
+provider_latencies = {name: deque(maxlen=LLM_LATENCY_WINDOW) for name in LLM_PROVIDERS}
+
+
+def record_provider_latency(provider: str, latency: float):
+    """记录 provider 成功请求的耗时"""
+    if provider in provider_latencies:
+        provider_latencies[provider].append(latency)
+
+
+async def call_llm_provider(provider: str, system_prompt: str, user_prompt: str, on_text=None) -> str:
+    """
+    经过熔断器调用 LLM provider，并记录耗时（熔断中的 provider 直接跳过）
+
+    Args:
+        on_text: 收到一段文本时的回调（流式调用时逐段调用，非流式时用完整响应调用一次）
+    """
+    breaker = provider_breakers[provider]
+    if not breaker.allow_request():
+        raise ProviderUnavailableError(f"{LLM_PROVIDERS[provider]['label']} 熔断中，已跳过")
+    call_started = time.monotonic()
+    try:
+        if LLM_STREAMING:
+            parts = []
+            async for text in LLM_PROVIDERS[provider]["stream"](system_prompt, user_prompt):
+                parts.append(text)
+                if on_text is not None:
+                    on_text(text)
+            ai_response = "".join(parts).strip()
+        else:
+            ai_response = await LLM_PROVIDERS[provider]["call"](system_prompt, user_prompt)
+            if on_text is not None:
+                on_text(ai_response)
+    except asyncio.CancelledError:
+        breaker.release()
+        raise
+    except Exception as e:
+        breaker.record_failure(str(e))
+        raise
+    breaker.record_success()
+    record_provider_latency(provider, time.monotonic() - call_started)
+    return ai_response
+
+
+def get_hedge_delay(provider: str) -> float:
+    """根据 provider 最近耗时的 p95 计算对冲延迟（样本不足时使用默认值）"""
+    samples = sorted(provider_latencies.get(provider, []))
+    if len(samples) < LLM_HEDGE_MIN_SAMPLES:
+        delay = LLM_HEDGE_DELAY
+    else:
+        delay = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    return min(max(delay, LLM_HEDGE_MIN_DELAY), LLM_HEDGE_MAX_DELAY)
+
+
+def describe_llm_error(error_msg: str) -> str:
+    """将 LLM 调用异常转换为简短的错误说明"""
+    if "429" in error_msg or "SetLimitExceeded" in error_msg or "limit" in error_msg.lower() or "quota" in error_msg.lower():
+        return "已达到使用限制（429错误）"
+    if "401" in error_msg or "AuthenticationError" in error_msg:
+        return "认证失败（401错误）"
+    return f"调用失败：{error_msg[:100]}"
+
+
+class TimeBlockStreamParser:
+    """
+    增量解析 LLM 输出的 JSON 数组：每次 feed 一段文本，返回其中新完成的顶层对象
+    - 跳过 JSON 之前的说明文字和 markdown 代码块标记
+    - 正确处理字符串中的括号、转义字符以及嵌套的数组 / 对象
+    - 顶层是单个对象时视为只有一个元素的数组
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.items = []
+        self.closed = False  # 顶层数组 / 对象是否已经结束
+        self._pos = 0
+        self._start = None
+        self._end = None
+        self._item_depth = 1
+        self._item_start = None
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, chunk: str) -> list:
+        self.text += chunk
+        text = self.text
+        completed = []
+        i = self._pos
+        while i < len(text) and not self.closed:
+            ch = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif self._start is None:
+                if ch in "[{":
+                    # JSON 开始（之前的说明文字、```json 等被跳过）
+                    self._start = i
+                    self._item_depth = 1 if ch == "[" else 0
+                    continue
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "[{":
+                if ch == "{" and self._depth == self._item_depth:
+                    self._item_start = i
+                self._depth += 1
+            elif ch in "]}":
+                self._depth -= 1
+                if self._item_start is not None and self._depth == self._item_depth:
+                    item = self._decode(text[self._item_start:i + 1])
+                    self._item_start = None
+                    if item is not None:
+                        completed.append(item)
+                if self._depth == 0:
+                    self.closed = True
+                    self._end = i + 1
+            i += 1
+        self._pos = i
+        self.items.extend(completed)
+        return completed
+
+    @staticmethod
+    def _decode(fragment: str) -> Optional[dict]:
+        try:
+            return json.loads(fragment)
+        except json.JSONDecodeError:
+            logger.warning(f"时间块不是有效的 JSON，跳过: {fragment[:200]}")
+            return None
+
+    def finish(self) -> str:
+        """
+        结束解析，返回 JSON 部分的文本
+        没有找到 JSON，或 JSON 不完整且没有解析出任何对象时抛出 ValueError
+        """
+        if self._start is None:
+            raise ValueError("无法解析 AI 响应为 JSON")
+        if not self.closed:
+            if not self.items:
+                raise ValueError("无法解析 AI 响应为 JSON")
+            logger.warning(f"AI 返回的 JSON 不完整，使用已解析的 {len(self.items)} 个时间块")
+        return self.text[self._start:self._end].strip()
+
+
+def is_valid_time_block(time_block) -> bool:
+    """验证时间块：必须有开始/结束时间、有效活动名称，且持续时间超过 1 分钟"""
+    if not isinstance(time_block, dict):
+        return False
+    
+    start_time_str = time_block.get('start_time', '')
+    end_time_str = time_block.get('end_time', '')
+    activity = (time_block.get('activity', '') or '').strip()
+    
+    # 如果缺少开始时间或结束时间，跳过
+    if not start_time_str or not end_time_str:
+        logger.warning(f"时间块缺少开始时间或结束时间，跳过: {activity}")
+        return False
+    
+    # 如果活动名称为空或无效（如"无"、"没有"），跳过
+    if not activity or activity.lower() in ['无', '没有', 'none', 'null', '']:
+        logger.warning(f"时间块活动名称为空或无效，跳过: {activity}")
+        return False
+    
+    try:
+        start_dt = datetime.fromisoformat(start_time_str.replace('Z', '+00:00'))
+        end_dt = datetime.fromisoformat(end_time_str.replace('Z', '+00:00'))
+        
+        # 移除时区信息
+        if start_dt.tzinfo:
+            start_dt = start_dt.replace(tzinfo=None)
+        if end_dt.tzinfo:
+            end_dt = end_dt.replace(tzinfo=None)
+        
+        # 如果开始时间 >= 结束时间，或持续时间少于1分钟，跳过
+        duration_seconds = (end_dt - start_dt).total_seconds()
+        if duration_seconds <= 60:
+            logger.warning(f"时间块持续时间过短（{duration_seconds}秒），跳过: {activity} ({start_time_str} - {end_time_str})")
+            return False
+    except Exception as e:
+        logger.warning(f"时间块时间解析失败，跳过: {activity}, 错误: {e}")
+        return False
+    
+    return True
+
+
+def postprocess_time_blocks(time_data: list, transcript: str, model_name: str,
+                            current_dt: datetime, current_time_iso: str) -> list:
+    """验证并后处理时间块：过滤无效块、追加模型名称、校正标签和相对时间"""
+    # 后处理：修正相对时间的计算（处理数组中的每个时间块）
+    transcript_lower = transcript.lower()
+    relative_time_keywords = ["刚刚", "刚才", "刚刚半小时", "刚刚半小時", "半小时前", "半小時前"]
+    has_relative_time = any(keyword in transcript_lower for keyword in relative_time_keywords)
+    
+    processed_time_data = []
+    for time_block in time_data:
+        if not is_valid_time_block(time_block):
+            continue
+        
+        # 在描述字段末尾添加模型名称
+        current_description = time_block.get('description', '') or ''
+        current_description = current_description.strip().rstrip('-').strip()
+        if current_description:
+            time_block['description'] = f"{current_description} [模型: {model_name}]"
+        else:
+            time_block['description'] = f"[模型: {model_name}]"
+        
+        # 处理标签（tag）字段
+        # 如果 AI 没有返回 tag，或 tag 为空/无效，根据关键词自动分类
+        current_tag = time_block.get('tag', '').strip()
+        
+        if not current_tag or current_tag == '未分类' or tag_registry.get_by_name(current_tag) is None:
+            # 自动分类
+            tag = classify_activity_tag(
+                time_block.get('activity', ''),
+                current_description
+            )
+            time_block['tag'] = tag
+            logger.info(f"自动分类标签: {time_block.get('activity')} -> {tag}")
+        else:
+            # AI 返回了有效的 tag，使用它
+            logger.info(f"使用AI返回的标签: {time_block.get('activity')} -> {current_tag}")
+        
+        # 修正相对时间
+        if has_relative_time:
+            logger.info(f"检测到相对时间关键词，进行后处理修正")
+            # 检查结束时间是否接近当前时间（允许5分钟误差）
+            if time_block.get('end_time'):
+                try:
+                    end_time_str = time_block['end_time']
+                    # 处理时区信息
+                    if 'Z' in end_time_str:
+                        end_dt = datetime.fromisoformat(end_time_str.replace('Z', '+00:00'))
+                    elif '+' in end_time_str or end_time_str.count('-') > 2:
+                        end_dt = datetime.fromisoformat(end_time_str)
+                    else:
+                        end_dt = datetime.fromisoformat(end_time_str)
+                    
+                    # 移除时区信息
+                    if end_dt.tzinfo:
+                        end_dt = end_dt.replace(tzinfo=None)
+                    
+                    now_dt = datetime.now()
+                    time_diff = abs((end_dt - now_dt).total_seconds())
+                    
+                    logger.info(f"结束时间: {end_dt}, 当前时间: {now_dt}, 时间差: {time_diff}秒")
+                    
+                    # 如果结束时间与当前时间相差超过5分钟，修正为当前时间
+                    if time_diff > 300:  # 5分钟 = 300秒
+                        logger.info(f"修正结束时间：{time_block['end_time']} -> {current_time_iso}")
+                        time_block['end_time'] = current_time_iso
+                    else:
+                        # 即使时间差小于5分钟，也要确保结束时间是当前时间（相对时间的特性）
+                        logger.info(f"结束时间接近当前时间，但仍需确保是当前时间")
+                        time_block['end_time'] = current_time_iso
+                    
+                    # 如果开始时间也需要修正（"刚刚半小时"）
+                    if "半小时" in transcript_lower or "半小時" in transcript_lower:
+                        start_dt = current_dt - timedelta(minutes=30)
+                        corrected_start = start_dt.strftime('%Y-%m-%dT%H:%M:%S')
+                        # 检查开始时间是否需要修正
+                        if time_block.get('start_time'):
+                            try:
+                                start_time_str = time_block['start_time']
+                                if 'Z' in start_time_str:
+                                    start_dt_parsed = datetime.fromisoformat(start_time_str.replace('Z', '+00:00'))
+                                elif '+' in start_time_str or start_time_str.count('-') > 2:
+                                    start_dt_parsed = datetime.fromisoformat(start_time_str)
+                                else:
+                                    start_dt_parsed = datetime.fromisoformat(start_time_str)
+                                
+                                if start_dt_parsed.tzinfo:
+                                    start_dt_parsed = start_dt_parsed.replace(tzinfo=None)
+                                
+                                start_diff = abs((start_dt_parsed - start_dt).total_seconds())
+                                if start_diff > 300:  # 如果开始时间与期望值相差超过5分钟
+                                    logger.info(f"修正开始时间：{time_block.get('start_time')} -> {corrected_start}")
+                                    time_block['start_time'] = corrected_start
+                            except Exception as e:
+                                logger.warning(f"检查开始时间时出错: {e}")
+                        else:
+                            time_block['start_time'] = corrected_start
+                            logger.info(f"设置开始时间：{corrected_start}")
+                    else:
+                        logger.info(f"结束时间接近当前时间，无需修正")
+                except Exception as e:
+                    logger.warning(f"修正相对时间时出错: {e}")
+                    import traceback
+                    traceback.print_exc()
+        
+        processed_time_data.append(time_block)
+    
+    return processed_time_data
+
+
+class TimeBlockCollector:
+    """
+    收集一次 LLM 调用的时间块：流式文本逐段交给 TimeBlockStreamParser，
+    每个对象结束时立即验证和后处理（不等待完整响应），并记录首个有效时间块的耗时
+    """
+
+    def __init__(self, transcript: str, model_name: str, current_dt: datetime, current_time_iso: str,
+                 on_block=None):
+        self.transcript = transcript
+        self.model_name = model_name
+        self.current_dt = current_dt
+        self.current_time_iso = current_time_iso
+        self.on_block = on_block  # 每个有效时间块的回调
+        self.parser = TimeBlockStreamParser()
+        self.raw_blocks = []  # LLM 返回的全部对象（含未通过验证的）
+        self.blocks = []  # 验证和后处理后的时间块
+        self.first_block_ms = None
+        self._started = time.monotonic()
+
+    def feed(self, text: str):
+        for item in self.parser.feed(text):
+            self.raw_blocks.append(item)
+            processed = postprocess_time_blocks([item], self.transcript, self.model_name,
+                                                self.current_dt, self.current_time_iso)
+            if not processed:
+                continue
+            if self.first_block_ms is None:
+                self.first_block_ms = round((time.monotonic() - self._started) * 1000)
+                logger.info(f"首个时间块耗时: {self.first_block_ms}ms ({self.model_name})")
+            self.blocks.extend(processed)
+            if self.on_block is not None:
+                self.on_block(processed[0])
+
+    def finish(self) -> str:
+        """响应结束，返回 JSON 文本（无法解析时抛出 ValueError）"""
+        ai_response = self.parser.finish()
+        logger.info(f"AI 返回了 {len(self.raw_blocks)} 个时间块，{len(self.blocks)} 个通过验证")
+        return ai_response
+
+
+# ==================== 规则解析（快速路径） ====================
+# 简单的句子（"刚刚半小时在学习"、"9点到10点开会"、"9am-10am meeting"）用确定性的规则解析，
+# 不调用 LLM；置信度低于 FAST_PATH_MIN_CONFIDENCE 时回退到 LLM。
+# 支持：中文 / 阿拉伯数字的时刻（9点半、十点一刻、9:30、9am）、时间段（到 / 至 / - / to）、
+# 早上 / 下午 / 晚上等时段、今天 / 昨天 / 明天、相对时间（刚刚半小时、过去两个小时、30 minutes ago）。
+
+FAST_PATH_MODEL = "rule-parser"
+
+CN_DIGITS = {"零": 0, "〇": 0, "一": 1, "二": 2, "两": 2, "俩": 2, "三": 3, "四": 4,
+             "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+EN_NUMBERS = {"a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6,
+              "seven": 7, "eight": 8, "nine": 9, "ten": 10, "fifteen": 15, "twenty": 20,
+              "thirty": 30, "forty": 40, "forty-five": 45, "fifty": 50}
+
+_NUM = r"[0-9]{1,2}|[零〇一二两俩三四五六七八九十]{1,3}"
+_CN_PERIOD = r"凌晨|清晨|早上|早晨|上午|中午|下午|傍晚|晚上|夜里|半夜|今早|今晚|昨晚|明早|明晚"
+_CN_DAY = r"今天|今日|昨天|昨日|前天|明天|明日"
+_EN_PERIOD = r"this morning|this afternoon|this evening|tonight|last night|in the morning|in the afternoon|in the evening"
+
+# 中文时刻：[日期][时段]9点[半|一刻|三刻|15分]，或 9:30
+CN_CLOCK_RE = re.compile(
+    rf"(?P<day>{_CN_DAY})?(?P<period>{_CN_PERIOD})?"
+    rf"(?:(?P<hour>{_NUM})(?:点|點|时|時)(?:(?P<half>半)|(?P<quarter>一刻|三刻)|(?P<minute>{_NUM})分?)?钟?"
+    rf"|(?P<hh>[0-9]{{1,2}})[:：](?P<mm>[0-9]{{2}})(?!\s*(?:am|pm|a\.m\.|p\.m\.)))"
+)
+# 英文时刻：9am、9:30 pm、10 o'clock、noon（单独的数字只在时间段中识别）
+EN_CLOCK = r"(?:noon|midnight|\d{1,2}(?::\d{2})?\s*(?:am|pm|a\.m\.|p\.m\.|o'clock)?)"
+EN_CLOCK_RE = re.compile(
+    r"(?<![\d:])(?:(?P<word>noon|midnight)|(?P<hour>\d{1,2})(?::(?P<minute>\d{2}))?\s*(?P<ampm>am|pm|a\.m\.|p\.m\.|o'clock)?)(?![\d:])",
+    re.IGNORECASE
+)
+EN_RANGE_RE = re.compile(
+    rf"(?:from\s+)?(?P<start>{EN_CLOCK})\s*(?:to|until|till|-|–|~)\s*(?P<end>{EN_CLOCK})",
+    re.IGNORECASE
+)
+EN_SINGLE_CLOCK_RE = re.compile(
+    r"(?:at\s+|from\s+|since\s+)?(?<![\d:])(?:noon|midnight|\d{1,2}:\d{2}\s*(?:am|pm|a\.m\.|p\.m\.)?|\d{1,2}\s*(?:am|pm|a\.m\.|p\.m\.|o'clock))(?![\d:])",
+    re.IGNORECASE
+)
+CN_RANGE_SEPARATOR_RE = re.compile(r"^\s*(?:到|至|~|-|—|–|－|～)\s*$")
+
+# 时长：半小时、一个半小时、两个小时、1.5小时、三十分钟、一刻钟 / 30 minutes、an hour and a half
+CN_DURATION_RE = re.compile(
+    rf"(?:(?P<hours>{_NUM}|[0-9]+\.[0-9]+)个?(?P<half>半)?(?:小时|小時|钟头|鐘頭)"
+    rf"|(?P<half_only>半)个?(?:小时|小時|钟头|鐘頭)"
+    rf"|(?P<quarter>一刻钟)"
+    rf"|(?P<minutes>{_NUM})分钟)"
+)
+EN_DURATION_RE = re.compile(
+    r"(?:(?P<half>half an? hour)"
+    r"|(?P<hours>\d+(?:\.\d+)?|an?|one|two|three|four|five|six)\s*(?:hours?|hrs?)(?P<and_half>\s+and\s+a\s+half)?"
+    r"|(?P<minutes>\d+|fifteen|twenty|thirty|forty-five|forty|fifty|ten|five)\s*(?:minutes?|mins?))",
+    re.IGNORECASE
+)
+
+PAST_MARKER_RE = re.compile(r"刚刚|刚才|剛剛|剛才|过去|過去|最近|之前|以前|前|just|last|past|ago|earlier", re.IGNORECASE)
+FUTURE_MARKER_RE = re.compile(r"待会儿?|一会儿?|等会儿?|等一下|接下来|接下來|之后|以后|next|later", re.IGNORECASE)
+UNTIL_NOW_RE = re.compile(r"到现在|到現在|至今|直到现在|until now|till now|so far", re.IGNORECASE)
+EN_DAY_RE = re.compile(r"\b(today|yesterday|tomorrow)\b", re.IGNORECASE)
+EN_PERIOD_RE = re.compile(rf"\b(?:{_EN_PERIOD})\b", re.IGNORECASE)
+FAST_PATH_DAY_PERIOD_RE = re.compile(rf"{_CN_DAY}|{_CN_PERIOD}")
+
+# 多个事件之间的分隔（逗号、句号、然后、接着 / then）
+CLAUSE_SPLIT_RE = re.compile(r"[，,。；;！!？?\n]|然后|接着|随后|and then|then", re.IGNORECASE)
+
+FAST_PATH_LOCATION_RE = re.compile(
+    r"在(?P<location>[一-鿿A-Za-z]{0,8}?(?:咖啡厅|咖啡馆|图书馆|办公室|公司|学校|健身房|练歌房|食堂|餐厅|公园|教室|实验室|宿舍|家里|家))"
+)
+CN_FILLER_PREFIX_RE = re.compile(r"^(?:我们|我|他|她|都|一直|正在|在|就|是|有|了|呢|要|会|想|的时候|开始|从|去)+")
+CN_FILLER_SUFFIX_RE = re.compile(r"(?:了|呢|吧|啊|呀|的|来着|左右|开始|结束)+$")
+EN_FILLER_RE = re.compile(
+    r"\b(?:i|i'm|i've|we|we're|was|were|am|been|have|had|just|spent|spend|for|from|at|since|the|then|and|"
+    r"until|till|to|doing|did|a|an|in|on|of|about|around|today|yesterday|tomorrow|so far|now|ago)\b",
+    re.IGNORECASE
+)
+
+# 标签关键词（标签名称出现在活动中时直接使用该标签）
+FAST_PATH_TAG_KEYWORDS = {
+    "工作": ["开会", "会议", "工作", "上班", "加班", "写代码", "代码", "编程", "写报告", "报告", "邮件", "面试", "汇报",
+             "meeting", "work", "coding", "email", "interview"],
+    "运动": ["跑步", "健身", "游泳", "瑜伽", "打球", "篮球", "足球", "羽毛球", "乒乓", "骑车", "骑行", "爬山", "散步", "锻炼", "运动",
+             "run", "running", "gym", "workout", "swim", "yoga", "exercise"],
+    "娱乐": ["游戏", "电影", "追剧", "看剧", "唱歌", "练歌", "k歌", "刷视频", "刷手机", "逛街", "音乐",
+             "game", "games", "movie", "netflix", "music", "karaoke"],
+    "生活": ["吃饭", "早饭", "午饭", "晚饭", "早餐", "午餐", "晚餐", "做饭", "睡觉", "午睡", "洗澡", "通勤", "购物", "买菜", "打扫", "家务", "休息",
+             "学习", "复习", "上课", "看书", "breakfast", "lunch", "dinner", "sleep", "nap", "commute", "shopping", "study", "studying"],
+}
+
+
+def parse_cn_number(text: str) -> Optional[int]:
+    """解析 0-99 的阿拉伯数字或中文数字（十五、二十三、两）"""
+    if text.isdigit():
+        return int(text)
+    if "十" in text:
+        tens, _, ones = text.partition("十")
+        tens_value = CN_DIGITS.get(tens) if tens else 1
+        ones_value = CN_DIGITS.get(ones) if ones else 0
+        if tens_value is None or ones_value is None:
+            return None
+        return tens_value * 10 + ones_value
+    if len(text) == 1:
+        return CN_DIGITS.get(text)
+    return None
+
+
+def _cn_day_offset(day: Optional[str], period: Optional[str]) -> Optional[int]:
+    if day in ("昨天", "昨日") or period == "昨晚":
+        return -1
+    if day == "前天":
+        return -2
+    if day in ("明天", "明日") or period in ("明早", "明晚"):
+        return 1
+    if day in ("今天", "今日") or period in ("今早", "今晚"):
+        return 0
+    return None
+
+
+def _apply_period(hour: int, period: Optional[str]) -> tuple:
+    """
+    按时段换算为 24 小时制，返回 (小时, 是否确定)
+    没有时段且小时在 1-11 之间时无法确定上午还是下午
+    """
+    if period in ("凌晨", "半夜", "清晨", "早上", "早晨", "上午", "今早", "明早", "am", "morning"):
+        return (0 if hour == 12 else hour), True
+    if period == "中午" or period == "noon":
+        return (hour + 12 if hour < 11 else hour), True
+    if period in ("下午", "傍晚", "晚上", "夜里", "今晚", "昨晚", "明晚", "pm", "afternoon", "evening"):
+        return (hour + 12 if hour < 12 else hour), True
+    return hour, not 1 <= hour <= 11
+
+
+def _en_period_and_day(text: str) -> tuple:
+    """英文句子中的时段和日期（this morning / last night / yesterday ...）"""
+    text = text.lower()
+    period = None
+    if "morning" in text:
+        period = "morning"
+    elif "afternoon" in text:
+        period = "afternoon"
+    elif "evening" in text or "night" in text:
+        period = "evening"
+    day = None
+    if "yesterday" in text or "last night" in text:
+        day = -1
+    elif "tomorrow" in text:
+        day = 1
+    elif "today" in text or "tonight" in text or "this " in text:
+        day = 0
+    return period, day
+
+
+class FastPathClock:
+    """解析出的一个时刻（小时可能尚未确定上午 / 下午）"""
+
+    def __init__(self, hour: int, minute: int, period: Optional[str], day: Optional[int], span: tuple):
+        self.hour = hour
+        self.minute = minute
+        self.period = period
+        self.day = day
+        self.span = span
+
+    def resolve(self) -> tuple:
+        return _apply_period(self.hour, self.period)
+
+
+def find_cn_clocks(text: str) -> list:
+    clocks = []
+    for match in CN_CLOCK_RE.finditer(text):
+        if match.group("hh"):
+            hour, minute = int(match.group("hh")), int(match.group("mm"))
+        else:
+            hour = parse_cn_number(match.group("hour"))
+            if match.group("half"):
+                minute = 30
+            elif match.group("quarter"):
+                minute = 15 if match.group("quarter") == "一刻" else 45
+            elif match.group("minute"):
+                minute = parse_cn_number(match.group("minute"))
+            else:
+                minute = 0
+        if hour is None or minute is None or hour > 24 or minute > 59:
+            continue
+        clocks.append(FastPathClock(hour, minute, match.group("period"),
+                                    _cn_day_offset(match.group("day"), match.group("period")), match.span()))
+    return clocks
+
+
+def _parse_en_clock(text: str, span: tuple) -> Optional[FastPathClock]:
+    match = EN_CLOCK_RE.search(text)
+    if not match:
+        return None
+    if match.group("word"):
+        return FastPathClock(12 if match.group("word").lower() == "noon" else 0, 0, "am" if match.group("word").lower() == "midnight" else "noon", None, span)
+    hour = int(match.group("hour"))
+    minute = int(match.group("minute") or 0)
+    ampm = (match.group("ampm") or "").lower().replace(".", "")
+    period = ampm if ampm in ("am", "pm") else None
+    if hour > 24 or minute > 59:
+        return None
+    return FastPathClock(hour, minute, period, None, span)
+
+
+def find_en_clocks(text: str) -> tuple:
+    """返回 (时刻列表, 是否为时间段)"""
+    clocks = []
+    is_range = False
+    match = EN_RANGE_RE.search(text)
+    if match:
+        start = _parse_en_clock(match.group("start"), match.span())
+        end = _parse_en_clock(match.group("end"), match.span())
+        if start and end:
+            clocks, is_range = [start, end], True
+    if not clocks:
+        for match in EN_SINGLE_CLOCK_RE.finditer(text):
+            clock = _parse_en_clock(match.group(), match.span())
+            if clock:
+                clocks.append(clock)
+    period, day = _en_period_and_day(text)
+    for clock in clocks:
+        clock.period = clock.period or period
+        clock.day = day
+    return clocks, is_range
+
+
+def find_duration(text: str) -> Optional[tuple]:
+    """返回 (时长, 匹配范围)"""
+    match = CN_DURATION_RE.search(text)
+    if match:
+        if match.group("hours"):
+            value = match.group("hours")
+            hours = float(value) if "." in value else parse_cn_number(value)
+            if hours is None:
+                return None
+            minutes = hours * 60 + (30 if match.group("half") else 0)
+        elif match.group("half_only"):
+            minutes = 30
+        elif match.group("quarter"):
+            minutes = 15
+        else:
+            minutes = parse_cn_number(match.group("minutes"))
+            if minutes is None:
+                return None
+        return timedelta(minutes=minutes), match.span()
+    match = EN_DURATION_RE.search(text)
+    if match:
+        if match.group("half"):
+            minutes = 30
+        elif match.group("hours"):
+            value = match.group("hours").lower()
+            hours = float(value) if value[0].isdigit() else EN_NUMBERS.get(value, 1)
+            minutes = hours * 60 + (30 if match.group("and_half") else 0)
+        else:
+            value = match.group("minutes").lower()
+            minutes = int(value) if value.isdigit() else EN_NUMBERS.get(value, 0)
+        return timedelta(minutes=minutes), match.span()
+    return None
+
+
+def _choose_candidate(options: list, now: datetime, future: bool, may_be_ambiguous: bool) -> tuple:
+    """
+    在候选的 (开始, 结束) 中选择一个，返回 (候选, 是否有歧义)
+    默认取已经开始的最近一次；带有"待会儿"等词时取最近的未来时间
+    """
+    tolerance = timedelta(minutes=5)
+    if future:
+        preferred = sorted(o for o in options if o[0] >= now - tolerance)
+    else:
+        preferred = sorted((o for o in options if o[0] <= now + tolerance), reverse=True)
+    if not preferred:
+        return min(options), False
+    ambiguous = may_be_ambiguous and len(preferred) > 1 and abs(preferred[0][0] - preferred[1][0]) < timedelta(hours=24)
+    return preferred[0], ambiguous
+
+
+def _day_offsets(day: Optional[int]) -> list:
+    return [day] if day is not None else [-1, 0, 1]
 
 
-# 静态文件路由将在所有 API 路由注册后挂载（见文件末尾）
-mac_app_static_dir = os.path.join("MacApp", "static")
-if not os.path.exists(mac_app_static_dir):
-    raise FileNotFoundError("MacApp/static 目录不存在")
+def resolve_clock_range(start: FastPathClock, end: FastPathClock, now: datetime, future: bool) -> tuple:
+    """
+    确定时间段的具体日期时间，返回 ((开始, 结束), 是否有歧义)
+    - 结束时刻没有时段时取开始之后最近的一个（晚上八点到九点、晚上十点到一点）
+    - 都没有时段时同时考虑上午和下午两种解释
+    - 结束早于开始时视为跨午夜
+    """
+    start_hour, start_known = start.resolve()
+    end_hour, end_known = end.resolve()
+    if not start_known and end_known:
+        # 8点到晚上10点：开始时刻取不晚于结束时刻的最大值
+        if start_hour + 12 <= end_hour:
+            start_hour += 12
+        start_known = True
+    if start_known and not end_known:
+        # 晚上8点到9点半：结束时刻取晚于开始时刻的最近一个
+        start_total = start_hour * 60 + start.minute
+        if end_hour * 60 + end.minute <= start_total < (end_hour + 12) * 60 + end.minute and end_hour + 12 < 24:
+            end_hour += 12
+        end_known = True
+
+    pairs = [(start_hour, end_hour)]
+    if not start_known:
+        pairs = []
+        for shift in (0, 12):
+            s, e = start_hour + shift, end_hour + shift
+            if e * 60 + end.minute <= s * 60 + start.minute:
+                e += 12
+            if s < 24:
+                pairs.append((s, e % 24))
+
+    base = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    day = start.day if start.day is not None else end.day
+    options = []
+    for offset in _day_offsets(day):
+        for s, e in pairs:
+            start_dt = base + timedelta(days=offset, hours=s, minutes=start.minute)
+            end_dt = base + timedelta(days=offset, hours=e, minutes=end.minute)
+            if end_dt <= start_dt:
+                end_dt += timedelta(days=1)
+            options.append((start_dt, end_dt))
+    return _choose_candidate(options, now, future, not start_known and day is None)
+
+
+def resolve_single_clock(clock: FastPathClock, now: datetime, future: bool) -> tuple:
+    """单个时刻（配合时长或"到现在"使用），返回 (时间, 是否有歧义)"""
+    hour, known = clock.resolve()
+    hours = [hour] if known else [hour, hour + 12]
+    base = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    options = [(base + timedelta(days=offset, hours=h, minutes=clock.minute),) * 2
+               for offset in _day_offsets(clock.day) for h in hours]
+    (start, _), ambiguous = _choose_candidate(options, now, future, not known and clock.day is None)
+    return start, ambiguous
+
+
+def classify_fast_path_tag(activity: str) -> Optional[str]:
+    """按标签名称和关键词确定标签；无法确定时返回 None"""
+    lowered = activity.lower()
+    tags = tag_registry.tags()
+    for tag in tags:
+        name = tag.get("name")
+        if name and name.lower() in lowered:
+            return name
+    for tag in tags:
+        for keyword in FAST_PATH_TAG_KEYWORDS.get(tag.get("name"), []):
+            if keyword in lowered:
+                return tag.get("name")
+    return None
 
 
-@app.post("/chat")
-async def chat(request: ChatRequest):
+def clean_fast_path_activity(text: str) -> str:
+    text = re.sub(r"\s+", " ", text).strip(" ，,。.;；:：-~")
+    if re.search(r"[一-鿿]", text):
+        text = text.replace(" ", "")
+        for _ in range(3):
+            text = CN_FILLER_SUFFIX_RE.sub("", CN_FILLER_PREFIX_RE.sub("", text))
+        return text
+    text = EN_FILLER_RE.sub(" ", text)
+    return re.sub(r"\s+", " ", text).strip(" ,.;:-")
+
+
+def parse_fast_path_clause(clause: str, now: datetime) -> tuple:
     """
-    Chat completion endpoint
+    解析一个子句，返回 (时间块, 置信度)；无法解析时返回 (None, 0)
     """
-    try:
-        response = client.chat.completions.create(
-            model=request.model,
-            messages=request.messages
-        )
-        return {
-            "choices": [{"message": {"content": response.choices[0].message.content}}]
-        }
-    except Exception as e:
-        logger.error(f"Chat completion error: {e}")
-        return {"error": str(e)}
+    removed = []
+    confidence = 0.95
+    future = bool(FUTURE_MARKER_RE.search(clause)) and not PAST_MARKER_RE.search(clause)
+
+    clocks = find_cn_clocks(clause)
+    is_range = False
+    if len(clocks) >= 2:
+        between = clause[clocks[0].span[1]:clocks[1].span[0]]
+        is_range = bool(CN_RANGE_SEPARATOR_RE.match(between))
+        if between.strip() == "" and clause[clocks[0].span[0] - 1:clocks[0].span[0]] == "从":
+            is_range = True
+    elif not clocks:
+        clocks, is_range = find_en_clocks(clause)
+    if len(clocks) > 2 or (len(clocks) == 2 and not is_range):
+        return None, 0.0  # 多个时间点，交给 LLM 推断中间的事件
+    if clocks:
+        # 时间段连同中间的"到"一起去掉
+        removed.append((clocks[0].span[0], clocks[-1].span[1]))
+
+    duration = find_duration(clause)
+    if duration:
+        span_start, span_end = duration[1]
+        # "看了两小时书"：时长在动词和宾语之间时连同前面的动态助词一起去掉
+        if span_start > 0 and clause[span_start - 1] in "了过" and re.match(r"\s*[一-鿿]", clause[span_end:]):
+            span_start -= 1
+        removed.append((span_start, span_end))
+    until_now = UNTIL_NOW_RE.search(clause)
+    if until_now:
+        removed.append(until_now.span())
+
+    if is_range:
+        (start, end), ambiguous = resolve_clock_range(clocks[0], clocks[1], now, future)
+        if duration:
+            confidence -= 0.2  # 时间段和时长同时出现，可能是更复杂的描述
+    elif len(clocks) == 1 and (duration or until_now):
+        start, ambiguous = resolve_single_clock(clocks[0], now, future)
+        end = start + duration[0] if duration else now
+    elif not clocks and duration:
+        ambiguous = False
+        if future:
+            start, end = now, now + duration[0]
+        else:
+            if not PAST_MARKER_RE.search(clause):
+                confidence -= 0.1  # "学习了两个小时"：默认刚刚结束
+            start, end = now - duration[0], now
+    else:
+        return None, 0.0
+
+    if ambiguous:
+        confidence -= 0.1
+    if end <= start or end - start > timedelta(hours=16):
+        return None, 0.0
+
+    # 去掉时间表达式后剩下的部分作为活动名称
+    remainder = clause
+    merged = []
+    for span_start, span_end in sorted(removed):
+        if merged and span_start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], span_end))
+        else:
+            merged.append((span_start, span_end))
+    for span_start, span_end in reversed(merged):
+        remainder = remainder[:span_start] + " " + remainder[span_end:]
+    for pattern in (PAST_MARKER_RE, FUTURE_MARKER_RE, UNTIL_NOW_RE, EN_DAY_RE, EN_PERIOD_RE,
+                    FAST_PATH_DAY_PERIOD_RE, re.compile("从")):
+        remainder = pattern.sub(" ", remainder)
+    location = None
+    location_match = FAST_PATH_LOCATION_RE.search(remainder)
+    if location_match:
+        location = location_match.group("location")
+        remainder = remainder[:location_match.start()] + " " + remainder[location_match.end():]
+    activity = clean_fast_path_activity(remainder)
+
+    if not activity:
+        return None, 0.0
+    if re.search(r"[0-9零〇一二两三四五六七八九十]点|[0-9]:[0-9]|小时|分钟|hour|minute", activity, re.IGNORECASE):
+        return None, 0.0  # 还有没解析的时间表达式
+    if len(activity) > 12 if re.search(r"[一-鿿]", activity) else len(activity.split()) > 5:
+        confidence -= 0.3  # 描述较长，LLM 能提取更好的活动名称和描述
+
+    tag = classify_fast_path_tag(activity)
+    if tag is None:
+        confidence -= 0.2
+        tag = "生活"
 
+    return {
+        "activity": activity,
+        "start_time": start.strftime('%Y-%m-%dT%H:%M:%S'),
+        "end_time": end.strftime('%Y-%m-%dT%H:%M:%S'),
+        "location": location,
+        "description": clause.strip(),
+        "tag": tag,
+    }, round(confidence, 2)
 
-@app.post("/api/transcribe")
-async def transcribe_audio(
-    audio_file: UploadFile = File(...),
-    language: str = Form("zh-CN"),
-    use_local: Optional[bool] = Form(None)
-):
+
+def parse_time_blocks_fast(transcript: str, now: datetime) -> tuple:
     """
-    转录音频文件为文本
-    优先级：云端 API > Faster Whisper
-    
-    Args:
-        audio_file: 音频文件
-        language: 语言代码（如 zh-CN, en-US）
-        use_local: 是否使用本地 STT 模型（None时默认使用云端API）
-    
-    Returns:
-        转录文本和元数据
+    规则解析整段文本，返回 (时间块列表, 置信度)
+    没有时间表达式的子句（如"九点到十点，开会"中的"开会"）并入相邻子句；
+    但带有日期或时段的子句（如"上午学习，下午打球两小时"中的"上午学习"）是一个时间不完整的独立事件，交给 LLM
     """
-    # 默认使用云端 API（准确率最高）
-    use_local_stt = use_local if use_local is not None else USE_LOCAL_STT
-    
-    # 记录所有尝试的模型和错误
-    stt_errors = []
-    tried_models = []
-    
-    # 优先使用云端转录 API（准确率最高，推荐）
-    if not use_local_stt:
-        tried_models.append("云端 STT API")
-        try:
-            # 重置文件指针
-            await audio_file.seek(0)
-            
-            # 准备文件上传
-            files = {
-                'audio_file': (audio_file.filename, await audio_file.read(), audio_file.content_type)
-            }
-            data = {
-                'language': language
-            }
-            
-            # 调用云端转录 API
-            response = requests.post(
-                TRANSCRIPTION_API_URL,
-                files=files,
-                data=data,
-                headers={"Authorization": f"Bearer {api_key}"},
-                timeout=60
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                transcript = result.get("text", "")
-                logger.info(f"云端转录成功: {transcript[:50]}...")
-                
-                return {
-                    "success": True,
-                    "transcript": transcript,
-                    "detected_language": result.get("detected_language"),
-                    "confidence": result.get("confidence"),
-                    "billing": result.get("billing"),
-                    "method": "cloud"
-                }
-            else:
-                raise Exception(f"云端转录 API 错误: {response.status_code} - {response.text}")
-                
-        except Exception as e:
-            error_msg = str(e)
-            logger.error(f"云端转录失败: {error_msg}")
-            # 检查是否是额度限制错误
-            if "429" in error_msg or "limit" in error_msg.lower() or "quota" in error_msg.lower() or "SetLimitExceeded" in error_msg:
-                error_detail = f"云端 STT API 已达到使用限制（429错误）"
-            elif "401" in error_msg or "AuthenticationError" in error_msg:
-                error_detail = f"云端 STT API 认证失败（401错误）"
-            else:
-                error_detail = f"云端 STT API 调用失败：{error_msg[:100]}"
-            stt_errors.append(f"模型：云端 STT API - {error_detail}")
-            # 回退到本地模型
-            use_local_stt = True
-    
-    # 使用 Faster Whisper（备用本地模型）
-    if use_local_stt and FASTER_WHISPER_AVAILABLE:
-        tried_models.append(f"Faster Whisper ({WHISPER_MODEL_SIZE})")
-        try:
-            model = get_whisper_model()
-            if model is None:
-                raise Exception("Faster Whisper 模型未加载")
-            
-            # 保存上传的文件到临时文件
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp_file:
-                content = await audio_file.read()
-                tmp_file.write(content)
-                tmp_file_path = tmp_file.name
-            
-            try:
-                # 转录音频
-                segments, info = model.transcribe(tmp_file_path, language=language.split('-')[0] if language else None)
-                transcript = "".join([segment.text for segment in segments]).strip()
-                transcript = normalize_transcript_text(transcript)
-                
-                return {
-                    "success": True,
-                    "transcript": transcript,
-                    "detected_language": info.language,
-                    "confidence": info.language_probability,
-                    "method": "local",
-                    "model": f"Faster-Whisper-{WHISPER_MODEL_SIZE}"
-                }
-            finally:
-                # 清理临时文件
-                os.unlink(tmp_file_path)
-                
-        except Exception as e:
-            error_msg = str(e)
-            logger.error(f"本地转录失败: {e}")
-            stt_errors.append(f"模型：Faster Whisper ({WHISPER_MODEL_SIZE}) - {error_msg[:100]}")
+    clauses = []
+    pending = ""
+    for part in CLAUSE_SPLIT_RE.split(transcript):
+        part = part.strip()
+        if not part:
+            continue
+        has_time = bool(find_cn_clocks(part) or find_en_clocks(part)[0] or find_duration(part))
+        if not has_time and (FAST_PATH_DAY_PERIOD_RE.search(part) or EN_DAY_RE.search(part)
+                             or EN_PERIOD_RE.search(part)):
+            return [], 0.0
+        if has_time:
+            clauses.append(pending + part)
+            pending = ""
+        elif clauses:
+            clauses[-1] += " " + part
+        else:
+            pending += part + " "
+    if not clauses:
+        return [], 0.0
+
+    blocks = []
+    confidence = 1.0
+    for clause in clauses:
+        block, clause_confidence = parse_fast_path_clause(clause, now)
+        if block is None:
+            return [], 0.0
+        blocks.append(block)
+        confidence = min(confidence, clause_confidence)
+    return blocks, confidence
+
+
+def build_analysis_result(time_data: list, ai_response: str, analysis_method: str, model_name: str) -> dict:
+    """构建 /api/analyze 的成功响应"""
+    if not time_data:
+        # 如果处理后没有有效的时间块，返回空数组
+        logger.warning("处理后没有有效的时间块（可能因为时间点无效、时间段过短、或活动名称为空）")
+        return {
+            "success": True,
+            "data": [],
+            "raw_response": ai_response,
+            "method": analysis_method,
+            "model": model_name,
+            "message": "未检测到有效的时间段（需要完整的开始时间和结束时间，且持续时间至少1分钟）"
+        }
     
-    # 如果所有方法都失败
-    if not tried_models:
-        tried_models.append("无可用模型（Faster Whisper 未安装）")
+    logger.info(f"AI 分析结果: {len(time_data)} 个时间块")
+    logger.info(f"使用方法: {analysis_method}")
     
     return {
-        "success": False,
-        "error": "所有转录方法都失败",
-        "step": "语音转文本",
-        "tried_models": tried_models,
-        "errors": stt_errors,
-        "error_summary": f"语音转文本步骤失败：已尝试 {len(tried_models)} 个模型，全部失败。详情：{'；'.join(stt_errors)}"
+        "success": True,
+        "data": time_data,  # 返回数组格式，支持多个时间块
+        "raw_response": ai_response,
+        "method": analysis_method,
+        "model": model_name
     }
 
 
+def get_tags_version() -> str:
+    """标签配置版本（标签注册表重新加载后递增，缓存自动失效）"""
+    return str(tag_registry.version)
+
+
+def get_prompt_templates_hash() -> str:
+    """Prompt 模板哈希（prompts.md 变化后缓存自动失效）"""
+    return prompt_renderer.get_templates_hash()
+
+
+def get_time_anchor(transcript: str) -> Optional[str]:
+    """
+    文本中的时间以什么为基准（与快速路径使用相同的规则），决定缓存命中时如何处理时间块
+    - "clock"：只有钟点时间（"九点到十点开会"），缓存结果直接使用
+    - "now"：时间都相对于当前时间（"刚刚"、"跑步半小时"、"学习两小时到现在"），缓存命中时平移到当前时间
+    - None：同一段文本里两种都有（"九点到现在"），无法整体平移，不缓存
+    """
+    anchors = set()
+    for part in CLAUSE_SPLIT_RE.split(transcript):
+        has_clock = bool(find_cn_clocks(part) or find_en_clocks(part)[0])
+        relative = bool(UNTIL_NOW_RE.search(part) or PAST_MARKER_RE.search(part)
+                        or (not has_clock and find_duration(part)))
+        if has_clock and relative:
+            return None
+        if has_clock:
+            anchors.add("clock")
+        elif relative:
+            anchors.add("now")
+    if len(anchors) > 1:
+        return None
+    return anchors.pop() if anchors else "clock"
+
+
+def build_analysis_cache_key(transcript: str, current_dt: datetime, providers: List[str], race: bool) -> str:
+    """缓存键：规范化文本 + 标签版本 + Prompt 模板哈希 + 时间分桶 + 使用的 provider（及是否竞速）"""
+    normalized = normalize_transcript_text(transcript).lower()
+    time_bucket = int(current_dt.timestamp() // ANALYZE_CACHE_TIME_BUCKET)
+    raw_key = json.dumps(
+        [normalized, get_tags_version(), get_prompt_templates_hash(), time_bucket, providers, race],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+
+def shift_iso_time(value: str, delta: timedelta) -> str:
+    """将 ISO 时间字符串平移 delta（保持原有格式）"""
+    dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if dt.tzinfo:
+        dt = dt.replace(tzinfo=None)
+    return (dt + delta).strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def get_cached_analysis(cache_key: str, transcript: str, current_dt: datetime) -> Optional[dict]:
+    """
+    读取缓存的分析结果
+    对于相对当前时间的文本（"刚刚"、只有时长等），把时间块平移到当前时间
+    """
+    cached = analysis_cache.get(cache_key)
+    if cached is None:
+        return None
+    result = copy.deepcopy(cached["result"])
+    delta = current_dt - cached["cached_at"]
+    if delta.total_seconds() > 0 and get_time_anchor(transcript) == "now":
+        for block in result.get("data", []):
+            for field in ("start_time", "end_time"):
+                if block.get(field):
+                    try:
+                        block[field] = shift_iso_time(block[field], delta)
+                    except Exception as e:
+                        logger.warning(f"缓存时间平移失败: {e}")
+    result["cache"] = "hit"
+    return result
+
+
+def store_analysis_result(cache_key: Optional[str], result: dict, current_dt: datetime) -> dict:
+    """缓存成功的分析结果（只缓存提取到时间块的结果），并标记缓存状态"""
+    if cache_key is None:
+        result["cache"] = "bypass"
+        return result
+    result["cache"] = "miss"
+    if result.get("success") and result.get("data"):
+        analysis_cache.set(cache_key, {"result": copy.deepcopy(result), "cached_at": current_dt})
+    return result
+
+
+async def race_llm_providers(providers: List[str], system_prompt: str, user_prompt: str,
+                             transcript: str, current_dt: datetime, current_time_iso: str) -> dict:
+    """
+    竞速模式：先启动主 provider，超过 p95 对冲延迟仍未返回时启动下一个 provider，
+    取第一个通过时间块验证的 JSON 数组，并取消其余请求。
+
+    Returns:
+        {"winner", "ai_response", "data", "first_block_ms", "providers": {name: {status, latency_ms, first_block_ms}}, "errors"}
+    """
+    loop = asyncio.get_running_loop()
+    waiting = list(providers)
+    pending = {}  # task -> provider
+    started_at = {}
+    report = {name: {"status": "not_started", "latency_ms": None, "first_block_ms": None} for name in providers}
+    errors = []
+    fallback = None  # 没有 provider 返回有效时间块时，使用第一个可解析的空结果
+    hedge_deadline = None
+
+    async def run(name: str) -> TimeBlockCollector:
+        collector = TimeBlockCollector(transcript, LLM_PROVIDERS[name]["model"], current_dt, current_time_iso)
+        await call_llm_provider(name, system_prompt, user_prompt, collector.feed)
+        return collector
+
+    def launch():
+        nonlocal hedge_deadline
+        name = waiting.pop(0)
+        started_at[name] = loop.time()
+        report[name]["status"] = "running"
+        pending[asyncio.create_task(run(name))] = name
+        hedge_deadline = loop.time() + get_hedge_delay(name) if waiting else None
+        logger.info(f"竞速模式启动: {LLM_PROVIDERS[name]['label']}")
+
+    launch()
+    try:
+        while pending:
+            timeout = max(0.0, hedge_deadline - loop.time()) if hedge_deadline is not None else None
+            done, _ = await asyncio.wait(pending.keys(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # 主 provider 超过对冲延迟仍未返回，启动下一个 provider
+                launch()
+                continue
+
+            for task in done:
+                name = pending.pop(task)
+                latency = loop.time() - started_at[name]
+                report[name]["latency_ms"] = round(latency * 1000)
+                label = LLM_PROVIDERS[name]["label"]
+                try:
+                    collector = task.result()
+                    ai_response = collector.finish()
+                except Exception as e:
+                    report[name]["status"] = "failed"
+                    errors.append(f"模型：{label} - {describe_llm_error(str(e))}")
+                    logger.warning(f"竞速模式 {label} 失败: {e}")
+                    continue
+
+                report[name]["first_block_ms"] = collector.first_block_ms
+                if collector.blocks or not collector.raw_blocks:
+                    report[name]["status"] = "won"
+                    return {"winner": name, "ai_response": ai_response, "data": collector.blocks,
+                            "first_block_ms": collector.first_block_ms, "providers": report, "errors": errors}
+
+                report[name]["status"] = "invalid"
+                errors.append(f"模型：{label} - 返回的时间块均未通过验证")
+                if fallback is None:
+                    fallback = {"winner": name, "ai_response": ai_response, "data": [], "first_block_ms": None}
+
+            # 有 provider 结束但没有产生结果，立即启动下一个
+            if waiting and len(pending) == 0:
+                launch()
+    finally:
+        for task, name in pending.items():
+            task.cancel()
+            report[name]["status"] = "cancelled"
+            report[name]["latency_ms"] = round((loop.time() - started_at[name]) * 1000)
+
+    if fallback is not None:
+        return {**fallback, "providers": report, "errors": errors}
+    return {"winner": None, "ai_response": "", "data": [], "first_block_ms": None, "providers": report, "errors": errors}
+
+
 @app.post("/api/analyze")
 async def analyze_time_entry(request: TimeAnalysisRequest):
     """
@@ -1095,6 +5190,17 @@ async def analyze_time_entry(request: TimeAnalysisRequest):
     Returns:
         结构化时间数据
     """
+    return await run_time_analysis(request)
+
+
+async def run_time_analysis(request: TimeAnalysisRequest, on_block=None) -> dict:
+    """
+    /api/analyze 的实现
+
+    Args:
+        on_block: 依次调用 provider 时，每个时间块通过验证后立即回调 on_block(block)
+            （provider 中途失败并回退时，已回调的时间块以最终结果为准；竞速模式、快速路径和缓存命中时不回调）
+    """
     try:
         logger.info(f"分析时间记录: {request.transcript}")
         
@@ -1120,6 +5226,39 @@ async def analyze_time_entry(request: TimeAnalysisRequest):
         past_30min_str = past_30min.strftime('%Y-%m-%dT%H:%M:%S')
         current_time_iso = current_dt.strftime('%Y-%m-%dT%H:%M:%S')
         
+        # 查询分析结果缓存（命中时跳过 Prompt 渲染和 LLM 调用）
+        use_fast_path = request.fast_path if request.fast_path is not None else FAST_PATH_ENABLED
+        use_race = request.race if request.race is not None else LLM_RACE_MODE
+        providers = [name for name, enabled in (
+            ("doubao", use_doubao),
+            ("supermind", use_supermind),
+            ("ollama", use_local_ai),
+        ) if enabled]
+        cache_key = None
+        # 同时有钟点和相对当前时间的文本无法在命中时整体平移，不缓存
+        if ANALYZE_CACHE_ENABLED and request.use_cache is not False and get_time_anchor(request.transcript):
+            cache_key = build_analysis_cache_key(request.transcript, current_dt, providers, use_race)
+            cached_result = get_cached_analysis(cache_key, request.transcript, current_dt)
+            # 明确关闭快速路径时不使用规则解析的缓存结果
+            if cached_result is not None and (use_fast_path or cached_result.get("path") != "fast_path"):
+                logger.info("分析结果缓存命中")
+                return cached_result
+        
+        # 快速路径：规则解析成功且置信度足够时直接返回，不渲染 Prompt、不调用 LLM
+        fast_path_confidence = None
+        if use_fast_path:
+            fast_blocks, fast_path_confidence = parse_time_blocks_fast(request.transcript, current_dt)
+            if fast_blocks and fast_path_confidence >= FAST_PATH_MIN_CONFIDENCE:
+                fast_response = json.dumps(fast_blocks, ensure_ascii=False)
+                time_data = postprocess_time_blocks(fast_blocks, request.transcript, FAST_PATH_MODEL, current_dt, current_time_iso)
+                if time_data:
+                    logger.info(f"快速路径解析成功（置信度 {fast_path_confidence}），跳过 LLM")
+                    result = build_analysis_result(time_data, fast_response, "rule", FAST_PATH_MODEL)
+                    result["path"] = "fast_path"
+                    result["confidence"] = fast_path_confidence
+                    return store_analysis_result(cache_key, result, current_dt)
+            logger.info(f"快速路径置信度不足（{fast_path_confidence}），使用 LLM")
+        
         # 从文件加载 Prompt 模板（如果存在）
         system_prompt = get_system_prompt(current_time_str)
         user_prompt = get_user_prompt(
@@ -1130,6 +5269,35 @@ async def analyze_time_entry(request: TimeAnalysisRequest):
             past_30min_str
         )
 
+        # 竞速模式：按优先级对冲请求多个 provider，取第一个有效结果
+        if use_race:
+            tried_llm_models = [LLM_PROVIDERS[name]["label"] for name in providers]
+            race = await race_llm_providers(
+                providers, system_prompt, user_prompt, request.transcript, current_dt, current_time_iso
+            )
+            llm_errors = race["errors"]
+            if race["winner"] is None:
+                raise Exception(f"时间提取步骤失败：已尝试 {len(tried_llm_models)} 个模型，全部失败。详情：{'；'.join(llm_errors)}")
+            winner = race["winner"]
+            result = build_analysis_result(race["data"], race["ai_response"], winner, LLM_PROVIDERS[winner]["model"])
+            result["race"] = {
+                "winner": winner,
+                "latencies": {name: info["latency_ms"] for name, info in race["providers"].items()},
+                "providers": race["providers"],
+            }
+            result["path"] = "llm"
+            result["first_block_ms"] = race["first_block_ms"]
+            if fast_path_confidence is not None:
+                result["fast_path_confidence"] = fast_path_confidence
+            return store_analysis_result(cache_key, result, current_dt)
+
+        # 每次调用 provider 时新建收集器，流式响应中的时间块在对象结束时立即验证和后处理
+        def new_collector(provider: str) -> TimeBlockCollector:
+            return TimeBlockCollector(request.transcript, LLM_PROVIDERS[provider]["model"], current_dt, current_time_iso,
+                                      on_block=on_block)
+
+        collector = None
+
         # 记录使用的分析方法（优先级：Doubao > Supermind > Ollama）
         if use_doubao:
             analysis_method = "doubao"
@@ -1149,34 +5317,11 @@ async def analyze_time_entry(request: TimeAnalysisRequest):
             tried_llm_models.append(f"豆包 ({DOUBAO_MODEL})")
             try:
                 logger.info(f"使用豆包模型: {DOUBAO_MODEL}")
-                
-                response = requests.post(
-                    f"{DOUBAO_API_URL}/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {DOUBAO_API_KEY}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "model": DOUBAO_MODEL,
-                        "messages": [
-                            {"role": "system", "content": system_prompt},
-                            {"role": "user", "content": user_prompt}
-                        ],
-                        "stream": False,
-                        "temperature": 0.1,
-                        "max_tokens": 1000
-                    },
-                    timeout=60
-                )
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    ai_response = result.get("choices", [{}])[0].get("message", {}).get("content", "").strip()
-                    logger.info(f"豆包响应: {ai_response[:100]}...")
-                else:
-                    raise Exception(f"豆包 API 错误: {response.status_code} - {response.text}")
+                collector = new_collector("doubao")
+                ai_response = await call_llm_provider("doubao", system_prompt, user_prompt, collector.feed)
+                logger.info(f"豆包响应: {ai_response[:100]}...")
                     
-            except requests.exceptions.ConnectionError:
+            except httpx.ConnectError:
                 error_msg = "连接失败"
                 logger.warning("豆包 API 连接失败，回退到 Supermind")
                 llm_errors.append(f"模型：豆包 ({DOUBAO_MODEL}) - 连接失败")
@@ -1203,16 +5348,8 @@ async def analyze_time_entry(request: TimeAnalysisRequest):
             tried_llm_models.append("Supermind (supermind-agent-v1)")
             try:
                 logger.info("使用 Supermind 云端 API")
-                response = client.chat.completions.create(
-                    model="supermind-agent-v1",
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt}
-                    ],
-                    temperature=0.3,
-                    max_tokens=500
-                )
-                ai_response = response.choices[0].message.content.strip()
+                collector = new_collector("supermind")
+                ai_response = await call_llm_provider("supermind", system_prompt, user_prompt, collector.feed)
                 logger.info(f"Supermind 响应: {ai_response[:100]}...")
             except Exception as e:
                 error_msg = str(e)
@@ -1234,32 +5371,11 @@ async def analyze_time_entry(request: TimeAnalysisRequest):
             tried_llm_models.append(f"Ollama ({OLLAMA_MODEL})")
             try:
                 logger.info(f"使用 Ollama 模型: {OLLAMA_MODEL}")
-                
-                response = requests.post(
-                    f"{OLLAMA_API_URL}/api/chat",
-                    json={
-                        "model": OLLAMA_MODEL,
-                        "messages": [
-                            {"role": "system", "content": system_prompt},
-                            {"role": "user", "content": user_prompt}
-                        ],
-                        "stream": False,
-                        "options": {
-                            "temperature": 0.1,  # 低温度，更确定性
-                            "num_predict": 1000  # 支持多个时间块
-                        }
-                    },
-                    timeout=60
-                )
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    ai_response = result.get("message", {}).get("content", "").strip()
-                    logger.info(f"Ollama 响应: {ai_response[:100]}...")
-                else:
-                    raise Exception(f"Ollama API 错误: {response.status_code} - {response.text}")
+                collector = new_collector("ollama")
+                ai_response = await call_llm_provider("ollama", system_prompt, user_prompt, collector.feed)
+                logger.info(f"Ollama 响应: {ai_response[:100]}...")
                     
-            except requests.exceptions.ConnectionError:
+            except httpx.ConnectError:
                 error_msg = "服务器未运行"
                 logger.warning("Ollama 服务器未运行，回退到 Supermind")
                 llm_errors.append(f"模型：Ollama ({OLLAMA_MODEL}) - 服务器未运行")
@@ -1272,282 +5388,44 @@ async def analyze_time_entry(request: TimeAnalysisRequest):
                 llm_errors.append(f"模型：Ollama ({OLLAMA_MODEL}) - {error_msg[:100]}")
                 use_local_ai = False
                 analysis_method = "supermind"
-                model_name = "supermind-agent-v1"
-        
-        # 如果所有方法都失败，使用 Supermind 作为最后回退
-        if not use_doubao and not use_supermind and not use_local_ai:
-            if "Supermind (supermind-agent-v1)" not in tried_llm_models:
-                tried_llm_models.append("Supermind (supermind-agent-v1)")
-            logger.info("所有方法都失败，使用 Supermind 作为最后回退")
-            try:
-                response = client.chat.completions.create(
-                    model="supermind-agent-v1",
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt}
-                    ],
-                    temperature=0.3,
-                    max_tokens=500
-                )
-                ai_response = response.choices[0].message.content.strip()
-                analysis_method = "supermind"
-                model_name = "supermind-agent-v1"
-            except Exception as e:
-                error_msg = str(e)
-                logger.error(f"Supermind 也失败: {error_msg}")
-                # 检查是否是额度限制错误
-                if "429" in error_msg or "limit" in error_msg.lower() or "quota" in error_msg.lower():
-                    error_detail = f"已达到使用限制（429错误）"
-                elif "401" in error_msg or "AuthenticationError" in error_msg:
-                    error_detail = f"认证失败（401错误）"
-                else:
-                    error_detail = f"调用失败：{error_msg[:100]}"
-                llm_errors.append(f"模型：Supermind (supermind-agent-v1) - {error_detail}")
-                
-                # 构建详细的错误信息
-                if not tried_llm_models:
-                    tried_llm_models.append("无可用模型")
-                
-                error_summary = f"时间提取步骤失败：已尝试 {len(tried_llm_models)} 个模型，全部失败。详情：{'；'.join(llm_errors)}"
-                raise Exception(error_summary)
-        
-        # 尝试提取 JSON（AI 可能返回带 markdown 代码块的 JSON）
-        if "```json" in ai_response:
-            ai_response = ai_response.split("```json")[1].split("```")[0].strip()
-        elif "```" in ai_response:
-            ai_response = ai_response.split("```")[1].split("```")[0].strip()
-        
-        # 解析 JSON（支持数组格式）
-        try:
-            time_data = json.loads(ai_response)
-            # 如果返回的是数组，处理多个时间块
-            if isinstance(time_data, list):
-                if len(time_data) == 0:
-                    # AI 返回了空数组，这是正常的（表示没有检测到时间信息），继续处理
-                    logger.info("AI 返回了空数组（表示没有检测到时间信息）")
-                    time_data = []  # 保持空数组，让后续验证逻辑处理
-                else:
-                    # 支持多个时间块，返回数组格式
-                    logger.info(f"AI 返回了 {len(time_data)} 个时间块")
-                    logger.info(f"所有时间块: {json.dumps(time_data, ensure_ascii=False, indent=2)}")
-                    # 保持数组格式，前端会处理多个事件
-            elif isinstance(time_data, dict):
-                # 如果是单个对象，转换为数组格式（统一格式）
-                time_data = [time_data]
-            else:
-                raise ValueError(f"AI 返回了意外的数据类型: {type(time_data)}")
-            
-            # 后处理：修正相对时间的计算（处理数组中的每个时间块）
-            transcript_lower = request.transcript.lower()
-            relative_time_keywords = ["刚刚", "刚才", "刚刚半小时", "刚刚半小時", "半小时前", "半小時前"]
-            has_relative_time = any(keyword in transcript_lower for keyword in relative_time_keywords)
-            
-            # 确保 time_data 是数组格式
-            if not isinstance(time_data, list):
-                time_data = [time_data] if isinstance(time_data, dict) else []
-            
-            # 处理每个时间块，验证并过滤无效的时间块
-            processed_time_data = []
-            for time_block in time_data:
-                if not isinstance(time_block, dict):
-                    continue
-                
-                # 验证时间块的有效性
-                start_time_str = time_block.get('start_time', '')
-                end_time_str = time_block.get('end_time', '')
-                activity = time_block.get('activity', '').strip()
-                
-                # 如果缺少开始时间或结束时间，跳过
-                if not start_time_str or not end_time_str:
-                    logger.warning(f"时间块缺少开始时间或结束时间，跳过: {activity}")
-                    continue
-                
-                # 如果活动名称为空或无效（如"无"、"没有"），跳过
-                if not activity or activity.lower() in ['无', '没有', 'none', 'null', '']:
-                    logger.warning(f"时间块活动名称为空或无效，跳过: {activity}")
-                    continue
-                
-                try:
-                    # 解析时间
-                    if 'Z' in start_time_str:
-                        start_dt = datetime.fromisoformat(start_time_str.replace('Z', '+00:00'))
-                    else:
-                        start_dt = datetime.fromisoformat(start_time_str)
-                    
-                    if 'Z' in end_time_str:
-                        end_dt = datetime.fromisoformat(end_time_str.replace('Z', '+00:00'))
-                    else:
-                        end_dt = datetime.fromisoformat(end_time_str)
-                    
-                    # 移除时区信息
-                    if start_dt.tzinfo:
-                        start_dt = start_dt.replace(tzinfo=None)
-                    if end_dt.tzinfo:
-                        end_dt = end_dt.replace(tzinfo=None)
-                    
-                    # 验证时间段有效性
-                    duration_seconds = (end_dt - start_dt).total_seconds()
-                    
-                    # 如果开始时间 >= 结束时间，或持续时间少于1分钟，跳过
-                    if duration_seconds <= 60:  # 少于1分钟视为无效
-                        logger.warning(f"时间块持续时间过短（{duration_seconds}秒），跳过: {activity} ({start_time_str} - {end_time_str})")
-                        continue
-                    
-                    # 时间块有效，继续处理
-                except Exception as e:
-                    logger.warning(f"时间块时间解析失败，跳过: {activity}, 错误: {e}")
-                    continue
-                    
-                # 在描述字段末尾添加模型名称
-                current_description = time_block.get('description', '') or ''
-                current_description = current_description.strip().rstrip('-').strip()
-                if current_description:
-                    time_block['description'] = f"{current_description} [模型: {model_name}]"
-                else:
-                    time_block['description'] = f"[模型: {model_name}]"
-                
-                # 处理标签（tag）字段
-                # 如果 AI 没有返回 tag，或 tag 为空/无效，根据关键词自动分类
-                tags_config = load_tags_config()
-                valid_tag_names = [tag.get("name") for tag in tags_config.get("tags", [])]
-                
-                current_tag = time_block.get('tag', '').strip()
-                
-                if not current_tag or current_tag == '未分类' or current_tag not in valid_tag_names:
-                    # 自动分类
-                    tag = classify_activity_tag(
-                        time_block.get('activity', ''),
-                        current_description
-                    )
-                    time_block['tag'] = tag
-                    logger.info(f"自动分类标签: {time_block.get('activity')} -> {tag}")
+                model_name = "supermind-agent-v1"
+        
+        # 如果所有方法都失败，使用 Supermind 作为最后回退
+        if not use_doubao and not use_supermind and not use_local_ai:
+            if "Supermind (supermind-agent-v1)" not in tried_llm_models:
+                tried_llm_models.append("Supermind (supermind-agent-v1)")
+            logger.info("所有方法都失败，使用 Supermind 作为最后回退")
+            try:
+                collector = new_collector("supermind")
+                ai_response = await call_llm_provider("supermind", system_prompt, user_prompt, collector.feed)
+                analysis_method = "supermind"
+                model_name = "supermind-agent-v1"
+            except Exception as e:
+                error_msg = str(e)
+                logger.error(f"Supermind 也失败: {error_msg}")
+                # 检查是否是额度限制错误
+                if "429" in error_msg or "limit" in error_msg.lower() or "quota" in error_msg.lower():
+                    error_detail = f"已达到使用限制（429错误）"
+                elif "401" in error_msg or "AuthenticationError" in error_msg:
+                    error_detail = f"认证失败（401错误）"
                 else:
-                    # AI 返回了有效的 tag，使用它
-                    logger.info(f"使用AI返回的标签: {time_block.get('activity')} -> {current_tag}")
+                    error_detail = f"调用失败：{error_msg[:100]}"
+                llm_errors.append(f"模型：Supermind (supermind-agent-v1) - {error_detail}")
                 
-                # 修正相对时间
-                if has_relative_time:
-                    logger.info(f"检测到相对时间关键词，进行后处理修正")
-                    # 检查结束时间是否接近当前时间（允许5分钟误差）
-                    if time_block.get('end_time'):
-                        try:
-                            end_time_str = time_block['end_time']
-                            # 处理时区信息
-                            if 'Z' in end_time_str:
-                                end_dt = datetime.fromisoformat(end_time_str.replace('Z', '+00:00'))
-                            elif '+' in end_time_str or end_time_str.count('-') > 2:
-                                end_dt = datetime.fromisoformat(end_time_str)
-                            else:
-                                end_dt = datetime.fromisoformat(end_time_str)
-                            
-                            # 移除时区信息
-                            if end_dt.tzinfo:
-                                end_dt = end_dt.replace(tzinfo=None)
-                            
-                            now_dt = datetime.now()
-                            time_diff = abs((end_dt - now_dt).total_seconds())
-                            
-                            logger.info(f"结束时间: {end_dt}, 当前时间: {now_dt}, 时间差: {time_diff}秒")
-                            
-                            # 如果结束时间与当前时间相差超过5分钟，修正为当前时间
-                            if time_diff > 300:  # 5分钟 = 300秒
-                                logger.info(f"修正结束时间：{time_block['end_time']} -> {current_time_iso}")
-                                time_block['end_time'] = current_time_iso
-                            else:
-                                # 即使时间差小于5分钟，也要确保结束时间是当前时间（相对时间的特性）
-                                logger.info(f"结束时间接近当前时间，但仍需确保是当前时间")
-                                time_block['end_time'] = current_time_iso
-                            
-                            # 如果开始时间也需要修正（"刚刚半小时"）
-                            if "半小时" in transcript_lower or "半小時" in transcript_lower:
-                                start_dt = current_dt - timedelta(minutes=30)
-                                corrected_start = start_dt.strftime('%Y-%m-%dT%H:%M:%S')
-                                # 检查开始时间是否需要修正
-                                if time_block.get('start_time'):
-                                    try:
-                                        start_time_str = time_block['start_time']
-                                        if 'Z' in start_time_str:
-                                            start_dt_parsed = datetime.fromisoformat(start_time_str.replace('Z', '+00:00'))
-                                        elif '+' in start_time_str or start_time_str.count('-') > 2:
-                                            start_dt_parsed = datetime.fromisoformat(start_time_str)
-                                        else:
-                                            start_dt_parsed = datetime.fromisoformat(start_time_str)
-                                        
-                                        if start_dt_parsed.tzinfo:
-                                            start_dt_parsed = start_dt_parsed.replace(tzinfo=None)
-                                        
-                                        start_diff = abs((start_dt_parsed - start_dt).total_seconds())
-                                        if start_diff > 300:  # 如果开始时间与期望值相差超过5分钟
-                                            logger.info(f"修正开始时间：{time_block.get('start_time')} -> {corrected_start}")
-                                            time_block['start_time'] = corrected_start
-                                    except Exception as e:
-                                        logger.warning(f"检查开始时间时出错: {e}")
-                                else:
-                                    time_block['start_time'] = corrected_start
-                                    logger.info(f"设置开始时间：{corrected_start}")
-                            else:
-                                logger.info(f"结束时间接近当前时间，无需修正")
-                        except Exception as e:
-                            logger.warning(f"修正相对时间时出错: {e}")
-                            import traceback
-                            traceback.print_exc()
+                # 构建详细的错误信息
+                if not tried_llm_models:
+                    tried_llm_models.append("无可用模型")
                 
-                processed_time_data.append(time_block)
-            
-            # 如果处理后没有有效的时间块，返回空数组
-            if not processed_time_data:
-                logger.warning("处理后没有有效的时间块（可能因为时间点无效、时间段过短、或活动名称为空）")
-                return {
-                    "success": True,
-                    "data": [],
-                    "raw_response": ai_response,
-                    "method": analysis_method,
-                    "model": model_name,
-                    "message": "未检测到有效的时间段（需要完整的开始时间和结束时间，且持续时间至少1分钟）"
-                }
-            
-            time_data = processed_time_data
-        except json.JSONDecodeError:
-            logger.warning(f"AI 返回的不是有效 JSON，尝试修复: {ai_response}")
-            # 尝试提取 JSON（支持数组和对象）
-            import re
-            # 先尝试提取数组
-            array_match = re.search(r'\[.*?\]', ai_response, re.DOTALL)
-            if array_match:
-                try:
-                    time_data = json.loads(array_match.group())
-                    if not isinstance(time_data, list):
-                        time_data = [time_data]
-                except:
-                    pass
-            # 如果数组提取失败，尝试提取对象
-            if not isinstance(time_data, list):
-                json_match = re.search(r'\{.*?\}', ai_response, re.DOTALL)
-                if json_match:
-                    try:
-                        time_data = json.loads(json_match.group())
-                        time_data = [time_data] if isinstance(time_data, dict) else []
-                    except:
-                        raise ValueError("无法解析 AI 响应为 JSON")
-                else:
-                    raise ValueError("无法解析 AI 响应为 JSON")
-        
-        # 确保 time_data 是数组格式
-        if isinstance(time_data, dict):
-            time_data = [time_data]
-        elif not isinstance(time_data, list):
-            time_data = []
-        
-        logger.info(f"AI 分析结果: {len(time_data)} 个时间块")
-        logger.info(f"使用方法: {analysis_method}")
+                error_summary = f"时间提取步骤失败：已尝试 {len(tried_llm_models)} 个模型，全部失败。详情：{'；'.join(llm_errors)}"
+                raise Exception(error_summary)
         
-        return {
-            "success": True,
-            "data": time_data,  # 返回数组格式，支持多个时间块
-            "raw_response": ai_response,
-            "method": analysis_method,
-            "model": model_name
-        }
+        ai_response = collector.finish()
+        result = build_analysis_result(collector.blocks, ai_response, analysis_method, model_name)
+        result["path"] = "llm"
+        result["first_block_ms"] = collector.first_block_ms
+        if fast_path_confidence is not None:
+            result["fast_path_confidence"] = fast_path_confidence
+        return store_analysis_result(cache_key, result, current_dt)
         
     except Exception as e:
         error_msg = str(e)
@@ -1569,6 +5447,149 @@ async def analyze_time_entry(request: TimeAnalysisRequest):
         }
 
 
+@app.get("/api/analyze/cache")
+async def get_analysis_cache_stats():
+    """
+    获取分析结果缓存统计（命中率、淘汰次数等）
+    """
+    return {
+        "success": True,
+        "enabled": ANALYZE_CACHE_ENABLED,
+        "time_bucket_seconds": ANALYZE_CACHE_TIME_BUCKET,
+        "stats": analysis_cache.stats()
+    }
+
+
+@app.delete("/api/analyze/cache")
+async def clear_analysis_cache():
+    """
+    清空分析结果缓存
+    """
+    analysis_cache.clear()
+    return {"success": True, "message": "分析结果缓存已清空"}
+
+
+@app.get("/api/analyze/prompt-cache")
+async def get_prompt_cache_stats():
+    """
+    获取各 provider 报告的 Prompt token 用量和前缀缓存命中情况
+    （PROMPT_LAYOUT=prefix_cache 时 System Prompt 在请求之间保持不变）
+    """
+    return {
+        "success": True,
+        "layout": prompt_renderer.layout,
+        "providers": prompt_usage_stats.snapshot()
+    }
+
+
+@app.delete("/api/analyze/prompt-cache")
+async def clear_prompt_cache_stats():
+    """
+    清空 Prompt token 用量统计（切换布局前后对比时使用）
+    """
+    prompt_usage_stats.clear()
+    return {"success": True, "message": "Prompt 用量统计已清空"}
+
+
+async def receive_mobile_audio(request: Request, *candidates: Optional[UploadFile]) -> UploadFile:
+    """
+    从移动端请求中取出音频文件（找不到时抛出 HTTPException）
+
+    兼容多种字段名（包括 iOS Shortcuts 可能出现的中文字段名），以及直接发送 audio/* 的情况。
+    """
+    content_type = request.headers.get("content-type", "")
+    logger.info(f"Content-Type: {content_type}")
+
+    # 1) FastAPI 参数注入（最稳定）
+    for candidate in candidates:
+        if candidate is not None:
+            logger.info(f"找到音频文件字段: {candidate.filename}")
+            return candidate
+
+    # 2) iOS 可能会直接以 audio/* 发送原始 body
+    if content_type.startswith("audio/"):
+        # 流式写入临时文件（超过 1MB 自动落盘），避免长录音占满内存
+        spooled = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        body_size = 0
+        async for chunk in request.stream():
+            spooled.write(chunk)
+            body_size += len(chunk)
+        if not body_size:
+            spooled.close()
+            raise HTTPException(status_code=400, detail="请求体为空，未收到音频数据")
+        spooled.seek(0)
+
+        audio_ext = ".wav"
+        if "mpeg" in content_type or "mp3" in content_type:
+            audio_ext = ".mp3"
+        elif "mp4" in content_type or "m4a" in content_type:
+            audio_ext = ".m4a"
+
+        logger.info(f"从 raw body 读取音频成功，大小: {body_size} bytes")
+        return UploadFile(
+            file=spooled,
+            size=body_size,
+            filename=f"recording{audio_ext}",
+            headers={"content-type": content_type},
+        )
+
+    # 3) 手动解析 multipart（兼容中文字段名）
+    try:
+        form = await request.form()
+    except Exception as e:
+        # 典型：Missing boundary in multipart
+        raise HTTPException(
+            status_code=400,
+            detail=(
+                f"无法解析表单数据: {e}. "
+                "请在 iOS 快捷指令的“获取 URL 内容”里选择“请求体=文件”，"
+                "并且不要手动设置 Content-Type（让系统自动带 boundary）。"
+            ),
+        )
+    keys = list(form.keys())
+    logger.info(f"表单字段: {keys}")
+
+    possible_field_names = [
+        "audio_file",
+        "录制的音频",
+        "音频",
+        "file",
+        "audio",
+        "recording",
+    ]
+    for field_name in possible_field_names:
+        if field_name in form and isinstance(form[field_name], UploadFile):
+            logger.info(f"找到音频文件字段(表单): {field_name}")
+            return form[field_name]
+
+    # 兜底：取第一个 UploadFile
+    for k in keys:
+        v = form.get(k)
+        if isinstance(v, UploadFile):
+            logger.info(f"使用第一个文件字段(表单): {k}")
+            return v
+
+    raise HTTPException(
+        status_code=400,
+        detail=(
+            "未找到音频文件。请确保 iOS 快捷指令的“获取 URL 内容”使用 POST，"
+            "请求体选择“文件”，并选中“录制的音频/文件”。"
+        ),
+    )
+
+
+def build_step_error(result: dict, default_step: str, default_summary: str) -> dict:
+    """转写 / 分析失败时返回给移动端的详细错误信息"""
+    return {
+        "success": False,
+        "step": result.get("step", default_step),
+        "error": result.get("error", "未知错误"),
+        "error_summary": result.get("error_summary", result.get("error", default_summary)),
+        "tried_models": result.get("tried_models", []),
+        "errors": result.get("errors", [])
+    }
+
+
 @app.post("/api/mobile/process")
 async def mobile_process(
     request: Request,
@@ -1579,112 +5600,17 @@ async def mobile_process(
 ):
     """
     移动端聚合接口：接收音频 -> 转写 -> 分析 -> 返回结构化 events
-    供 iOS 快捷指令使用。
-
-    兼容多种字段名（包括 iOS Shortcuts 可能出现的中文字段名），以及直接发送 audio/* 的情况。
+    供 iOS 快捷指令使用（需要边转写边显示结果时使用 /api/mobile/process/stream）。
     """
     try:
         logger.info("收到移动端处理请求 /api/mobile/process")
-        content_type = request.headers.get("content-type", "")
-        logger.info(f"Content-Type: {content_type}")
-
-        audio_file_obj: Optional[UploadFile] = None
-
-        # 1) FastAPI 参数注入（最稳定）
-        for candidate, name in (
-            (audio_file, "audio_file"),
-            (file, "file"),
-            (audio, "audio"),
-            (recording, "recording"),
-        ):
-            if candidate is not None:
-                audio_file_obj = candidate
-                logger.info(f"找到音频文件字段: {name}")
-                break
-
-        # 2) iOS 可能会直接以 audio/* 发送原始 body
-        if audio_file_obj is None and content_type.startswith("audio/"):
-            body = await request.body()
-            if not body:
-                raise HTTPException(status_code=400, detail="请求体为空，未收到音频数据")
-
-            audio_ext = ".wav"
-            if "mpeg" in content_type or "mp3" in content_type:
-                audio_ext = ".mp3"
-            elif "mp4" in content_type or "m4a" in content_type:
-                audio_ext = ".m4a"
-
-            from io import BytesIO
-
-            audio_file_obj = UploadFile(
-                file=BytesIO(body),
-                filename=f"recording{audio_ext}",
-                headers={"content-type": content_type},
-            )
-            logger.info(f"从 raw body 读取音频成功，大小: {len(body)} bytes")
-
-        # 3) 手动解析 multipart（兼容中文字段名）
-        if audio_file_obj is None:
-            try:
-                form = await request.form()
-                keys = list(form.keys())
-                logger.info(f"表单字段: {keys}")
-
-                possible_field_names = [
-                    "audio_file",
-                    "录制的音频",
-                    "音频",
-                    "file",
-                    "audio",
-                    "recording",
-                ]
-                for field_name in possible_field_names:
-                    if field_name in form and isinstance(form[field_name], UploadFile):
-                        audio_file_obj = form[field_name]
-                        logger.info(f"找到音频文件字段(表单): {field_name}")
-                        break
-
-                if audio_file_obj is None:
-                    # 兜底：取第一个 UploadFile
-                    for k in keys:
-                        v = form.get(k)
-                        if isinstance(v, UploadFile):
-                            audio_file_obj = v
-                            logger.info(f"使用第一个文件字段(表单): {k}")
-                            break
-            except Exception as e:
-                # 典型：Missing boundary in multipart
-                raise HTTPException(
-                    status_code=400,
-                    detail=(
-                        f"无法解析表单数据: {e}. "
-                        "请在 iOS 快捷指令的“获取 URL 内容”里选择“请求体=文件”，"
-                        "并且不要手动设置 Content-Type（让系统自动带 boundary）。"
-                    ),
-                )
-
-        if audio_file_obj is None:
-            raise HTTPException(
-                status_code=400,
-                detail=(
-                    "未找到音频文件。请确保 iOS 快捷指令的“获取 URL 内容”使用 POST，"
-                    "请求体选择“文件”，并选中“录制的音频/文件”。"
-                ),
-            )
+        audio_file_obj = await receive_mobile_audio(request, audio_file, file, audio, recording)
 
         # 1) 转写
         transcript_result = await transcribe_audio(audio_file=audio_file_obj, language="zh-CN", use_local=None)
         if not transcript_result.get("success"):
             # 返回详细的错误信息
-            error_info = {
-                "success": False,
-                "step": transcript_result.get("step", "语音转文本"),
-                "error": transcript_result.get("error", "未知错误"),
-                "error_summary": transcript_result.get("error_summary", transcript_result.get("error", "转写失败")),
-                "tried_models": transcript_result.get("tried_models", []),
-                "errors": transcript_result.get("errors", [])
-            }
-            return error_info
+            return build_step_error(transcript_result, "语音转文本", "转写失败")
 
         transcript = transcript_result.get("transcript", "")
         transcript = normalize_transcript_text(transcript)
@@ -1693,23 +5619,15 @@ async def mobile_process(
         analysis_request = TimeAnalysisRequest(transcript=transcript)
         analysis_result = await analyze_time_entry(analysis_request)
         if not analysis_result.get("success"):
-            # 返回详细的错误信息
-            error_info = {
-                "success": False,
-                "step": analysis_result.get("step", "时间提取"),
-                "error": analysis_result.get("error", "未知错误"),
-                "error_summary": analysis_result.get("error_summary", analysis_result.get("error", "分析失败")),
-                "tried_models": analysis_result.get("tried_models", []),
-                "errors": analysis_result.get("errors", []),
-                "transcript": transcript  # 即使分析失败，也返回转录文本
-            }
-            return error_info
+            # 返回详细的错误信息（即使分析失败，也返回转录文本）
+            return {**build_step_error(analysis_result, "时间提取", "分析失败"), "transcript": transcript}
 
         return {
             "success": True,
             "transcript": transcript,
             "events": analysis_result.get("data", []),
             "stt_method": transcript_result.get("method", "unknown"),  # 记录使用的 STT 方法
+            "stt_cache": transcript_result.get("cache", "bypass"),  # 转录缓存命中情况（hit/miss）
             "llm_method": analysis_result.get("method", "unknown"),  # 记录使用的 LLM 方法
             "llm_model": analysis_result.get("model", "unknown")  # 记录使用的 LLM 模型
         }
@@ -1724,16 +5642,159 @@ async def mobile_process(
         return {"success": False, "error": str(e)}
 
 
+def format_stream_event(event: str, data: dict, ndjson: bool) -> str:
+    """格式化一个进度事件：SSE（event + data）或 NDJSON（每行一个 JSON，event 字段为事件名）"""
+    if ndjson:
+        return json.dumps({"event": event, **data}, ensure_ascii=False) + "\n"
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def mobile_process_events(audio_file_obj: Optional[UploadFile], receive_error: Optional[str],
+                                started: float, received_at: float):
+    """
+    /api/mobile/process/stream 的事件序列（事件名, 数据）：
+    received -> transcript -> block（每个时间块）-> done；任一步骤失败时发送 error 后结束
+    """
+    def elapsed_ms(since: float) -> int:
+        return round((time.monotonic() - since) * 1000)
+
+    timings = {"receive_ms": round((received_at - started) * 1000)}
+    if receive_error is not None:
+        yield "error", {"success": False, "step": "接收音频", "error": receive_error, "timings": timings}
+        return
+    yield "received", {"filename": audio_file_obj.filename, "bytes": audio_file_obj.size,
+                       "receive_ms": timings["receive_ms"]}
+
+    # 1) 转写
+    stage_started = time.monotonic()
+    transcript_result = await transcribe_audio(audio_file=audio_file_obj, language="zh-CN", use_local=None)
+    timings["transcribe_ms"] = elapsed_ms(stage_started)
+    if not transcript_result.get("success"):
+        yield "error", {**build_step_error(transcript_result, "语音转文本", "转写失败"), "timings": timings}
+        return
+    transcript = normalize_transcript_text(transcript_result.get("transcript", ""))
+    yield "transcript", {
+        "text": transcript,
+        "stt_method": transcript_result.get("method", "unknown"),
+        "stt_cache": transcript_result.get("cache", "bypass"),
+        "transcribe_ms": timings["transcribe_ms"],
+    }
+
+    # 2) 分析：LLM 流式输出中每个时间块通过验证后立即发送
+    stage_started = time.monotonic()
+    blocks = asyncio.Queue()
+    analysis = asyncio.create_task(run_time_analysis(TimeAnalysisRequest(transcript=transcript), on_block=blocks.put_nowait))
+    analysis.add_done_callback(lambda _: blocks.put_nowait(None))
+    sent = 0
+    try:
+        while (block := await blocks.get()) is not None:
+            if sent == 0:
+                timings["first_block_ms"] = elapsed_ms(stage_started)
+            yield "block", {"index": sent, "block": block}
+            sent += 1
+        analysis_result = analysis.result()
+    finally:
+        analysis.cancel()
+    timings["analyze_ms"] = elapsed_ms(stage_started)
+    if not analysis_result.get("success"):
+        yield "error", {**build_step_error(analysis_result, "时间提取", "分析失败"), "transcript": transcript,
+                        "timings": timings}
+        return
+
+    events = analysis_result.get("data", [])
+    if sent == 0:
+        # 快速路径、缓存命中和竞速模式一次性得到全部时间块
+        if events:
+            timings["first_block_ms"] = timings["analyze_ms"]
+        for index, block in enumerate(events):
+            yield "block", {"index": index, "block": block}
+    timings["total_ms"] = elapsed_ms(started)
+    yield "done", {
+        "success": True,
+        "transcript": transcript,
+        "events": events,  # 最终结果（以此为准）
+        "stt_method": transcript_result.get("method", "unknown"),
+        "stt_cache": transcript_result.get("cache", "bypass"),
+        "llm_method": analysis_result.get("method", "unknown"),
+        "llm_model": analysis_result.get("model", "unknown"),
+        "path": analysis_result.get("path"),
+        "timings": timings,
+    }
+
+
+@app.post("/api/mobile/process/stream")
+async def mobile_process_stream(
+    request: Request,
+    output_format: str = Query("sse", alias="format", pattern="^(sse|ndjson)$"),
+    audio_file: Optional[UploadFile] = File(None),
+    file: Optional[UploadFile] = File(None),
+    audio: Optional[UploadFile] = File(None),
+    recording: Optional[UploadFile] = File(None),
+):
+    """
+    移动端聚合接口（流式）：与 /api/mobile/process 相同的处理流程，但边处理边返回进度事件，
+    客户端可以在 LLM 分析期间先显示转录文本。
+
+    事件：received（收到音频）、transcript（转录文本）、block（每个提取出的时间块）、
+    done（最终 events 和各阶段耗时 timings）、error（失败的步骤和原因）
+
+    Args:
+        format: sse（text/event-stream，默认）或 ndjson（application/x-ndjson，每行一个事件）
+    """
+    logger.info("收到移动端处理请求 /api/mobile/process/stream")
+    started = time.monotonic()
+    audio_file_obj = None
+    receive_error = None
+    try:
+        upload = await receive_mobile_audio(request, audio_file, file, audio, recording)
+        # 响应开始发送后上传的文件会被关闭，先分块复制到临时文件（超过 1MB 自动落盘），避免长录音占满内存
+        spooled = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        size = 0
+        while True:
+            chunk = await upload.read(STT_UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            spooled.write(chunk)
+            size += len(chunk)
+        spooled.seek(0)
+        audio_file_obj = UploadFile(file=spooled, size=size, filename=upload.filename, headers=upload.headers)
+    except HTTPException as e:
+        logger.error(f"移动端处理失败: {e.detail}")
+        receive_error = e.detail
+    received_at = time.monotonic()
+    ndjson = output_format == "ndjson"
+
+    async def event_stream():
+        try:
+            async for event, data in mobile_process_events(audio_file_obj, receive_error, started, received_at):
+                yield format_stream_event(event, data, ndjson)
+        except Exception as e:
+            logger.error(f"移动端处理失败: {e}")
+            import traceback
+            logger.error(traceback.format_exc())
+            yield format_stream_event("error", {"success": False, "error": str(e)}, ndjson)
+        finally:
+            if audio_file_obj is not None:
+                audio_file_obj.file.close()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="application/x-ndjson" if ndjson else "text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.post("/api/calendar/add")
-async def add_to_calendar_api(request: CalendarEventRequest):
+async def add_to_calendar_api(request: CalendarEventRequest, http_request: Request):
     """
     添加到苹果日历（单个事件）
     
     Args:
-        request: 日历事件数据
+        request: 日历事件数据（background=true 时放入后台队列）
+        Idempotency-Key 请求头: 可选，相同的 key 只会创建一个任务
     
     Returns:
-        添加结果（包含事件ID）
+        添加结果（包含事件ID；后台模式返回 job_id，可通过 /api/jobs/{job_id} 查询）
     """
     try:
         # 如果请求中没有指定 calendar_name，尝试从事件数据中获取 tag
@@ -1761,17 +5822,29 @@ async def add_to_calendar_api(request: CalendarEventRequest):
             "tag_color": tag_color,  # 标签颜色（用于设置日历颜色）
             "recurrence": request.recurrence  # 支持重复规则
         }
+        note_name = request.note_name or "时间"
+        
+        background = CALENDAR_BACKGROUND_DEFAULT if request.background is None else request.background
+        if background:
+            # 日历写入和备忘录追加都在后台执行，立即返回任务ID
+            job = job_queue.enqueue(
+                "add_event",
+                {"event": event_data, "note_name": note_name},
+                idempotency_key=http_request.headers.get("Idempotency-Key")
+            )
+            return {
+                "success": True,
+                "job_id": job["id"],
+                "status": job["status"],
+                "message": "事件已加入后台队列"
+            }
         
-        result = add_to_calendar_via_applescript(event_data)
+        result = await asyncio.to_thread(add_to_calendar_via_applescript, event_data)
         
         if result.get("success"):
-            # 同时写入备忘录：追加到指定备忘录（默认“时间”）
+            # 同时写入备忘录：追加到指定备忘录（默认“时间”），放入后台队列不阻塞响应
             try:
-                note_name = request.note_name or "时间"
-                note_text = format_note_entry(event_data)
-                notes_result = append_to_notes_via_applescript(note_name, note_text)
-                if not notes_result.get("success"):
-                    logger.warning(f"写入备忘录失败: {notes_result.get('error')}")
+                job_queue.enqueue("append_note", {"note_name": note_name, "text": format_note_entry(event_data)})
             except Exception as e:
                 logger.warning(f"写入备忘录异常: {e}")
 
@@ -1811,6 +5884,8 @@ async def add_multiple_to_calendar_api(events: List[CalendarEventRequest]):
         event_ids = []
         events_data = []
         errors = []
+        requested_events = []
+        script_events = []  # 附带标签颜色，仅用于生成脚本
         
         for event_request in events:
             # 如果请求中没有指定 calendar_name，使用默认值
@@ -1819,6 +5894,9 @@ async def add_multiple_to_calendar_api(events: List[CalendarEventRequest]):
             # 从请求中获取 tag，如果没有则从 calendar_name 推断
             tag = getattr(event_request, 'tag', None) or calendar_name
             
+            # 根据 tag 获取标签颜色（批量脚本中每个日历只设置一次）
+            tag_color = get_tag_by_name(tag).get("color", "#95E1D3")
+            
             event_data = {
                 "activity": event_request.activity,
                 "start_time": event_request.start_time,
@@ -1829,9 +5907,13 @@ async def add_multiple_to_calendar_api(events: List[CalendarEventRequest]):
                 "tag": tag,  # 保存 tag 字段用于前端显示
                 "recurrence": event_request.recurrence  # 支持重复规则
             }
-            
-            result = add_to_calendar_via_applescript(event_data)
-            
+            requested_events.append(event_data)
+            script_events.append({**event_data, "tag_color": tag_color})
+        
+        # 一次 AppleScript 调用创建所有事件
+        results = await asyncio.to_thread(add_events_to_calendar_via_applescript, script_events)
+        
+        for event_data, result in zip(requested_events, results):
             if result.get("success"):
                 event_id = result.get("event_id")
                 event_ids.append(event_id)
@@ -1846,15 +5928,13 @@ async def add_multiple_to_calendar_api(events: List[CalendarEventRequest]):
             # 保存所有事件信息（用于撤回）
             save_recent_events(event_ids, events_data)
 
-            # 同时写入备忘录：把本次事件按两行格式追加（一次性追加，避免多次 AppleScript）
+            # 同时写入备忘录：把本次事件按两行格式追加（一次性追加，放入后台队列不阻塞响应）
             try:
                 note_name = (events[0].note_name if events and getattr(events[0], "note_name", None) else None) or "时间"
                 blocks = [format_note_entry(e) for e in events_data if isinstance(e, dict)]
                 note_text = "\n\n".join([b for b in blocks if b.strip()])
                 if note_text.strip():
-                    notes_result = append_to_notes_via_applescript(note_name, note_text)
-                    if not notes_result.get("success"):
-                        logger.warning(f"批量写入备忘录失败: {notes_result.get('error')}")
+                    job_queue.enqueue("append_note", {"note_name": note_name, "text": note_text})
             except Exception as e:
                 logger.warning(f"批量写入备忘录异常: {e}")
             
@@ -1892,13 +5972,9 @@ async def get_recent_events():
     """
     try:
         # 优先从历史记录读取
-        if os.path.exists(EVENT_HISTORY_FILE):
-            with open(EVENT_HISTORY_FILE, 'r', encoding='utf-8') as f:
-                history = json.load(f)
-            
-            operations = history.get("operations", [])
-            if operations:
-                last_operation = operations[0]
+        if storage.has_history():
+            last_operation = storage.latest_operation()
+            if last_operation:
                 events = last_operation.get("events", [])
                 # 确保每个事件都有 tag 字段（从 calendar_name 推断）
                 for event in events:
@@ -1911,8 +5987,8 @@ async def get_recent_events():
                     "created_at": last_operation.get("created_at")
                 }
         
-        # Fallback：从最近事件文件读取
-        if os.path.exists(RECENT_EVENT_FILE):
+        # Fallback：还没有操作历史时从旧的最近事件文件读取（有历史时该文件可能已过期）
+        elif os.path.exists(RECENT_EVENT_FILE):
             with open(RECENT_EVENT_FILE, 'r', encoding='utf-8') as f:
                 events_info = json.load(f)
             
@@ -1949,15 +6025,23 @@ async def get_recent_events():
 
 
 @app.post("/api/calendar/undo")
-async def undo_last_calendar_events():
+async def undo_last_calendar_events(steps: int = 1):
     """
-    撤回最近写入的日历事件（一次操作的所有事件）
+    撤回最近写入的日历事件（每次操作的所有事件）
+    
+    Args:
+        steps: 可选，连续撤回的操作次数（1-50，默认 1）
     
     Returns:
         撤回结果（包含撤回的事件数量）
     """
     try:
-        result = undo_last_events_via_applescript()
+        if not 1 <= steps <= 50:
+            return {"success": False, "error": "steps 必须在 1-50 之间"}
+        if steps == 1:
+            result = await asyncio.to_thread(undo_last_events_via_applescript)
+        else:
+            result = await asyncio.to_thread(undo_events_via_applescript, steps)
         return result
     except Exception as e:
         logger.error(f"撤回事件异常: {str(e)}")
@@ -1969,6 +6053,59 @@ async def undo_last_calendar_events():
         }
 
 
+@app.post("/api/calendar/redo")
+async def redo_calendar_events():
+    """
+    重做最近一次撤回的操作（重新创建该操作的所有日历事件）
+    
+    Returns:
+        重做结果（包含新的事件ID）
+    """
+    try:
+        return await asyncio.to_thread(redo_last_events_via_applescript)
+    except Exception as e:
+        logger.error(f"重做事件异常: {str(e)}")
+        return {
+            "success": False,
+            "error": str(e)
+        }
+
+
+@app.get("/api/calendar/operations")
+async def get_calendar_operations(cursor: Optional[str] = None, limit: int = 20):
+    """
+    分页获取日历操作历史（最新的在前面）
+    
+    Args:
+        cursor: 可选，上一页返回的 next_cursor
+        limit: 可选，每页条数（1-200，默认 20）
+    
+    Returns:
+        操作列表、下一页游标（没有更多结果时为 null）和可重做的操作数
+    """
+    try:
+        if not 1 <= limit <= 200:
+            return {"success": False, "error": "limit 必须在 1-200 之间"}
+        operations, next_cursor = await asyncio.to_thread(storage.page_operations, cursor, limit)
+        return {
+            "success": True,
+            "operations": operations,
+            "next_cursor": next_cursor,
+            "redo_count": storage.redo_count()
+        }
+    except ValueError as e:
+        return {
+            "success": False,
+            "error": str(e)
+        }
+    except Exception as e:
+        logger.error(f"获取操作历史异常: {str(e)}")
+        return {
+            "success": False,
+            "error": str(e)
+        }
+
+
 @app.post("/api/time-entry")
 async def save_time_entry(entry: TimeEntry):
     """
@@ -1981,20 +6118,9 @@ async def save_time_entry(entry: TimeEntry):
         保存结果
     """
     try:
-        # 读取现有日志
-        if os.path.exists(TIME_LOG_FILE):
-            with open(TIME_LOG_FILE, 'r', encoding='utf-8') as f:
-                time_log = json.load(f)
-        else:
-            time_log = {"entries": []}
-        
-        # 添加新条目
+        # 添加新条目（单条写入，不重写整个日志）
         entry_dict = entry.dict()
-        time_log["entries"].append(entry_dict)
-        
-        # 保存到文件
-        with open(TIME_LOG_FILE, 'w', encoding='utf-8') as f:
-            json.dump(time_log, f, ensure_ascii=False, indent=2)
+        storage.add_time_entry(entry_dict)
         
         logger.info(f"保存时间记录: {entry.activity}")
         
@@ -2029,12 +6155,7 @@ async def get_calendar_tags():
         end tell
         '''
         
-        calendars_result = subprocess.run(
-            ["osascript", "-e", calendars_script],
-            capture_output=True,
-            text=True,
-            timeout=10
-        )
+        calendars_result = run_applescript(calendars_script, timeout=10)
         
         calendars = []
         if calendars_result.returncode == 0:
@@ -2067,12 +6188,7 @@ async def get_calendar_tags():
         end tell
         '''
         
-        summaries_result = subprocess.run(
-            ["osascript", "-e", summaries_script],
-            capture_output=True,
-            text=True,
-            timeout=30
-        )
+        summaries_result = run_applescript(summaries_script, timeout=30)
         
         summaries = []
         if summaries_result.returncode == 0:
@@ -2192,11 +6308,7 @@ async def create_tag(tag: dict):
             "is_default": False
         }
         
-        tags.append(new_tag)
-        tags_config["tags"] = tags
-        
-        with open(TAGS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(tags_config, f, ensure_ascii=False, indent=2)
+        tag_registry.insert_tag(new_tag)
         
         logger.info(f"创建标签: {new_tag['name']}")
         return {
@@ -2241,7 +6353,7 @@ async def update_tag(tag_id: str, tag: dict):
             }
         
         # 允许修改所有标签（包括默认标签）
-        old_tag = tags[tag_index]
+        old_tag = dict(tags[tag_index])  # 复制一份，更新后仍能比较旧颜色
         
         # 检查名称是否与其他标签重复
         if tag.get("name") and tag.get("name") != old_tag.get("name"):
@@ -2258,10 +6370,7 @@ async def update_tag(tag_id: str, tag: dict):
             "color": tag.get("color", old_tag.get("color"))
         })
         
-        tags_config["tags"] = tags
-        
-        with open(TAGS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(tags_config, f, ensure_ascii=False, indent=2)
+        tag_registry.update_tag(tag_id, tags[tag_index])
         
         logger.info(f"更新标签: {tag_id}")
         
@@ -2269,37 +6378,11 @@ async def update_tag(tag_id: str, tag: dict):
         updated_tag = tags[tag_index]
         if tag.get("color") and tag.get("color") != old_tag.get("color"):
             try:
-                calendar_name = updated_tag.get("name")
-                tag_color = tag.get("color")
-                r, g, b = hex_to_rgb(tag_color)
-                
-                # 使用 AppleScript 更新日历颜色
-                commands = [
-                    'tell application "Calendar"',
-                    'activate',
-                    f'set calendarName to "{escape_apple_script(calendar_name)}"',
-                    'try',
-                    f'set targetCalendar to calendar calendarName',
-                    f'set color of targetCalendar to {{{r}, {g}, {b}}}',
-                    'end try',
-                    'end tell'
-                ]
-                
-                escaped_commands = [c.replace("'", "'\\''") for c in commands]
-                cmd = "osascript " + " ".join([f"-e '{c}'" for c in escaped_commands])
-                
-                result = subprocess.run(
-                    cmd,
-                    shell=True,
-                    capture_output=True,
-                    text=True,
-                    timeout=5
-                )
-                
-                if result.returncode == 0:
-                    logger.info(f"已同步更新日历颜色: {calendar_name} -> {tag_color}")
-                else:
-                    logger.warning(f"同步日历颜色失败: {result.stderr.strip()}")
+                # 使用 AppleScript 更新日历颜色（后台任务）
+                job_queue.enqueue("recolor_calendar", {
+                    "calendar_name": updated_tag.get("name"),
+                    "color": tag.get("color")
+                })
             except Exception as e:
                 logger.warning(f"同步日历颜色异常: {e}")
         
@@ -2347,10 +6430,7 @@ async def delete_tag(tag_id: str):
         # 注意：删除默认标签后，用户需要手动重新创建
         
         deleted_tag = tags.pop(tag_index)
-        tags_config["tags"] = tags
-        
-        with open(TAGS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(tags_config, f, ensure_ascii=False, indent=2)
+        tag_registry.delete_tag(tag_id)
         
         logger.info(f"删除标签: {deleted_tag.get('name')}")
         return {
@@ -2366,45 +6446,62 @@ async def delete_tag(tag_id: str):
 
 
 @app.get("/api/time-entries")
-async def get_time_entries(date: Optional[str] = None):
+async def get_time_entries(
+    date: Optional[str] = None,
+    date_from: Optional[str] = Query(None, alias="from"),
+    date_to: Optional[str] = Query(None, alias="to"),
+    tag: Optional[str] = None,
+    activity: Optional[str] = None,
+    order: str = "asc",
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None
+):
     """
-    获取时间记录列表
+    查询时间记录（按开始时间排序）
     
     Args:
-        date: 可选，过滤日期（YYYY-MM-DD格式）
+        date: 可选，过滤日期（YYYY-MM-DD格式，也支持 YYYY-MM 等前缀）
+        from / to: 可选，日期范围（YYYY-MM-DD，闭区间；开始或结束日期落在范围内即匹配）
+        tag: 可选，标签名称
+        activity: 可选，活动名称包含的文字（不区分大小写）
+        order: asc（默认）或 desc
+        limit: 可选，每页条数（1-1000）；不传则返回全部
+        cursor: 可选，上一页返回的 next_cursor
     
     Returns:
-        时间记录列表
+        时间记录列表和下一页游标（没有更多结果时为 null）
     """
     try:
-        if not os.path.exists(TIME_LOG_FILE):
-            return {
-                "success": True,
-                "entries": []
-            }
-        
-        with open(TIME_LOG_FILE, 'r', encoding='utf-8') as f:
-            time_log = json.load(f)
-        
-        entries = time_log.get("entries", [])
-        
-        # 如果指定了日期，过滤记录
+        if order not in ("asc", "desc"):
+            return {"success": False, "error": "order 只能是 asc 或 desc"}
+        if limit is not None and not 1 <= limit <= 1000:
+            return {"success": False, "error": "limit 必须在 1-1000 之间"}
         if date:
-            filtered_entries = [
-                entry for entry in entries
-                if entry.get("start_time", "").startswith(date) or
-                   entry.get("end_time", "").startswith(date)
-            ]
-            return {
-                "success": True,
-                "entries": filtered_entries
-            }
+            # 按前缀匹配（兼容 YYYY-MM 等格式）
+            date_from, date_to = date, date + "\uffff"
+        
+        entries, next_cursor = await asyncio.to_thread(
+            storage.query_time_entries,
+            date_from=date_from,
+            date_to=date_to,
+            tag=tag,
+            activity=activity,
+            descending=order == "desc",
+            limit=limit,
+            cursor=cursor
+        )
         
         return {
             "success": True,
-            "entries": entries
+            "entries": entries,
+            "next_cursor": next_cursor
         }
         
+    except ValueError as e:
+        return {
+            "success": False,
+            "error": str(e)
+        }
     except Exception as e:
         logger.error(f"获取时间记录异常: {str(e)}")
         return {
@@ -2413,6 +6510,78 @@ async def get_time_entries(date: Optional[str] = None):
         }
 
 
+@app.post("/api/jobs")
+async def create_job(job_request: JobRequest, http_request: Request):
+    """
+    创建后台任务
+    
+    Args:
+        job_request: {type, payload, idempotency_key}
+        Idempotency-Key 请求头: 可选（与 idempotency_key 字段等价）
+    
+    Returns:
+        任务信息（包含 job_id）
+    """
+    try:
+        job = job_queue.enqueue(
+            job_request.type,
+            job_request.payload,
+            idempotency_key=job_request.idempotency_key or http_request.headers.get("Idempotency-Key")
+        )
+        return {
+            "success": True,
+            "job_id": job["id"],
+            "job": job
+        }
+    except ValueError as e:
+        return {
+            "success": False,
+            "error": str(e)
+        }
+
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """
+    查询后台任务状态（queued / running / succeeded / failed）
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        return {
+            "success": False,
+            "error": f"任务 '{job_id}' 不存在"
+        }
+    return {
+        "success": True,
+        "job": job
+    }
+
+
+@app.post("/api/storage/export")
+async def export_storage():
+    """
+    导出存储数据为原有的 JSON 文件格式
+    （time_log.json / event_history.json / recent_event.json / tags.json）
+    
+    Returns:
+        导出的文件列表
+    """
+    try:
+        files = await asyncio.to_thread(storage.export_json)
+        logger.info(f"已导出存储数据（{storage.name}）")
+        return {
+            "success": True,
+            "backend": storage.name,
+            "files": files
+        }
+    except Exception as e:
+        logger.error(f"导出存储数据失败: {e}")
+        return {
+            "success": False,
+            "error": str(e)
+        }
+
+
 # 在所有 API 路由注册后，挂载静态文件（避免覆盖 API 路由）
 # 注意：静态文件路由必须放在最后，否则会覆盖 /api/* 路由
 if os.path.exists(mac_app_static_dir):
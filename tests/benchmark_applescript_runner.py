@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+基准测试：每次调用启动 osascript vs 常驻 osascript 进程池
+测量单个事件（一次脚本调用）的平均延迟。
+
+- macOS：对比原来的 shell + osascript 方式、SubprocessScriptRunner 和 WorkerPoolScriptRunner
+  （使用不访问日历的脚本，只测量进程启动、编译和桥接开销）
+- 其他系统：没有 osascript，只对比 shell 启动进程的开销和 NullScriptRunner 的分发开销
+"""
+
+import os
+import sys
+import tempfile
+import time
+import shutil
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("AI_BUILDER_TOKEN", "test")
+os.environ["APPLESCRIPT_RUNNER"] = "null"
+# 数据库放到临时目录：导入 app 时不在仓库的 data/ 下创建数据库文件
+TEST_DATA_DIR = tempfile.mkdtemp(prefix="timeflow-test-")
+os.environ["DATABASE_FILE"] = os.path.join(TEST_DATA_DIR, "timeflow.db")
+os.environ["JOBS_DATABASE_FILE"] = os.path.join(TEST_DATA_DIR, "jobs.db")
+
+import app  # noqa: E402
+
+ITERATIONS = int(os.getenv("BENCHMARK_ITERATIONS", "20"))
+
+# 与日历脚本结构相同，但不访问 Calendar
+TEMPLATE = 'return (item 1 of argv) & " " & (item 2 of argv)'
+
+
+def legacy_call(i):
+    """原来的方式：拼接脚本文本，shell=True 启动 osascript"""
+    commands = [f'return "事件 {i}" & " " & "{i * 60}"']
+    cmd = "osascript " + " ".join([f"-e '{c}'" for c in commands])
+    subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=10)
+
+
+def measure(name, func):
+    func(0)  # 预热（常驻进程在第一次调用时启动）
+    start = time.perf_counter()
+    for i in range(ITERATIONS):
+        func(i)
+    per_call = (time.perf_counter() - start) / ITERATIONS * 1000
+    print(f"   {name:<40} {per_call:8.2f} ms / 事件")
+    return per_call
+
+
+def main():
+    print("=" * 60)
+    print(f"⏱️  AppleScript 执行器基准测试（{ITERATIONS} 次调用）")
+    print("=" * 60)
+
+    if shutil.which("osascript"):
+        subprocess_runner = app.SubprocessScriptRunner()
+        worker_runner = app.WorkerPoolScriptRunner(size=1)
+        try:
+            legacy = measure("shell + osascript（原方式）", legacy_call)
+            measure("SubprocessScriptRunner", lambda i: subprocess_runner.run(TEMPLATE, [f"事件 {i}", i * 60]))
+            worker = measure("WorkerPoolScriptRunner（常驻进程）", lambda i: worker_runner.run(TEMPLATE, [f"事件 {i}", i * 60]))
+        finally:
+            worker_runner.close()
+        print()
+        print(f"📊 常驻进程加速: {legacy / worker:.1f}x")
+    else:
+        print("⚠️  未找到 osascript（非 macOS），只测量进程启动开销和替身执行器")
+        null_runner = app.NullScriptRunner()
+        spawn = measure("shell 启动进程（原方式的下限）", lambda i: subprocess.run("true", shell=True))
+        null = measure("NullScriptRunner", lambda i: null_runner.run(TEMPLATE, [f"事件 {i}", i * 60]))
+        print()
+        print(f"📊 每次调用节省的进程启动开销约 {spawn - null:.2f} ms（不含 osascript 启动和脚本编译）")
+
+
+if __name__ == "__main__":
+    main()
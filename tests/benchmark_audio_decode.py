@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+基准测试：本地转录前的音频准备（临时文件 vs 内存解码）
+- 临时文件（旧实现）：上传内容写入 NamedTemporaryFile，解码器再从磁盘读回，最后删除
+- 内存解码：decode_audio_bytes 直接解码上传内容
+两者使用同一个解码器，差值即每个请求节省的磁盘 I/O。
+默认只测 16kHz WAV；安装了 ffmpeg 时同时测 m4a / mp3 / opus（用 ffmpeg 生成测试文件）
+"""
+
+import io
+import os
+import sys
+import time
+import wave
+import shutil
+import tempfile
+import subprocess
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("AI_BUILDER_TOKEN", "test")
+# 数据库放到临时目录：导入 app 时不在仓库的 data/ 下创建数据库文件
+TEST_DATA_DIR = tempfile.mkdtemp(prefix="timeflow-test-")
+os.environ["DATABASE_FILE"] = os.path.join(TEST_DATA_DIR, "timeflow.db")
+os.environ["JOBS_DATABASE_FILE"] = os.path.join(TEST_DATA_DIR, "jobs.db")
+
+import app  # noqa: E402
+
+ITERATIONS = int(os.getenv("BENCHMARK_ITERATIONS", "50"))
+SECONDS = float(os.getenv("BENCHMARK_AUDIO_SECONDS", "10"))
+
+
+def make_wav(seconds):
+    t = np.arange(int(16000 * seconds)) / 16000
+    samples = (np.sin(2 * np.pi * 220 * t) * 8000).astype("<i2")
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(16000)
+        wav.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+
+def encode(wav_bytes, suffix):
+    """用 ffmpeg 把 WAV 转成其他格式"""
+    result = subprocess.run(["ffmpeg", "-nostdin", "-loglevel", "error", "-i", "pipe:0", "-f", suffix, "pipe:1"],
+                            input=wav_bytes, capture_output=True)
+    return result.stdout if result.returncode == 0 else None
+
+
+def via_temp_file(content, suffix):
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp_file:
+        tmp_file.write(content)
+        tmp_file_path = tmp_file.name
+    try:
+        with open(tmp_file_path, "rb") as f:
+            return app.decode_audio_bytes(f.read())
+    finally:
+        os.unlink(tmp_file_path)
+
+
+def measure(func, *args):
+    func(*args)  # 预热
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        func(*args)
+    return (time.perf_counter() - start) / ITERATIONS * 1000
+
+
+def main():
+    print("=" * 60)
+    print(f"⏱️  音频准备基准测试（{SECONDS:g} 秒录音 × {ITERATIONS} 次）")
+    print("=" * 60)
+    wav_bytes = make_wav(SECONDS)
+    samples = {"wav": wav_bytes}
+    if shutil.which("ffmpeg"):
+        for name, fmt in (("m4a", "ipod"), ("mp3", "mp3"), ("opus", "ogg")):
+            encoded = encode(wav_bytes, fmt)
+            if encoded:
+                samples[name] = encoded
+    else:
+        print("   未安装 ffmpeg，只测试 WAV")
+
+    for name, content in samples.items():
+        try:
+            app.decode_audio_bytes(content)
+        except Exception as e:
+            print(f"   {name:5s} 跳过（{e}）")
+            continue
+        temp_ms = measure(via_temp_file, content, f".{name}")
+        memory_ms = measure(app.decode_audio_bytes, content)
+        print(f"   {name:5s} {len(content) / 1024:7.0f} KB  临时文件 {temp_ms:7.2f} ms  内存 {memory_ms:7.2f} ms  "
+              f"每个请求节省 {temp_ms - memory_ms:6.2f} ms（写入并读回 {len(content) / 1024:.0f} KB）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+基准测试：规则解析（快速路径） vs LLM
+- 规则解析：测量每条句子的平均解析耗时，以及能被快速路径处理的比例
+- LLM：配置了 DOUBAO_API_KEY / AI_BUILDER_TOKEN 时，对相同句子关闭快速路径调用 /api/analyze 的处理函数，
+  测量端到端延迟（未配置时跳过）
+"""
+
+import os
+import sys
+import tempfile
+import time
+import asyncio
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("AI_BUILDER_TOKEN", "test")
+# 数据库放到临时目录：导入 app 时不在仓库的 data/ 下创建数据库文件
+TEST_DATA_DIR = tempfile.mkdtemp(prefix="timeflow-test-")
+os.environ["DATABASE_FILE"] = os.path.join(TEST_DATA_DIR, "timeflow.db")
+os.environ["JOBS_DATABASE_FILE"] = os.path.join(TEST_DATA_DIR, "jobs.db")
+
+import app  # noqa: E402
+
+ITERATIONS = int(os.getenv("BENCHMARK_ITERATIONS", "200"))
+LLM_SAMPLES = int(os.getenv("BENCHMARK_LLM_SAMPLES", "3"))
+
+UTTERANCES = [
+    "刚刚半小时在学习",
+    "9点到10点开会",
+    "晚上八点到九点在练歌房练歌",
+    "昨天晚上十点到十一点半看电影",
+    "过去两个小时一直在写报告",
+    "早上8点跑步半小时",
+    "9am-10am meeting",
+    "just spent 30 minutes studying",
+    "今天早上八点出门然后九点到了咖啡厅九点到九点半呢我开始学习",
+    "下午和朋友聊了很久关于工作的事情",
+]
+
+
+def benchmark_rules():
+    now = datetime.now()
+    handled = 0
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        for text in UTTERANCES:
+            blocks, confidence = app.parse_time_blocks_fast(text, now)
+            if blocks and confidence >= app.FAST_PATH_MIN_CONFIDENCE:
+                handled += 1
+    per_call = (time.perf_counter() - start) / (ITERATIONS * len(UTTERANCES)) * 1000
+    ratio = handled / (ITERATIONS * len(UTTERANCES))
+    print(f"   规则解析: {per_call:8.3f} ms / 条，快速路径命中 {ratio:.0%}")
+    return per_call
+
+
+async def benchmark_llm():
+    latencies = []
+    for text in UTTERANCES[:LLM_SAMPLES]:
+        request = app.TimeAnalysisRequest(transcript=text, use_cache=False, fast_path=False)
+        start = time.perf_counter()
+        result = await app.analyze_time_entry(request)
+        elapsed = (time.perf_counter() - start) * 1000
+        if not result.get("success"):
+            print(f"   ⚠️  LLM 调用失败: {result.get('error')}")
+            continue
+        latencies.append(elapsed)
+        print(f"   LLM ({result.get('model')}): {elapsed:8.0f} ms  {text}")
+    return sum(latencies) / len(latencies) if latencies else None
+
+
+def main():
+    print("=" * 60)
+    print(f"⏱️  快速路径基准测试（{len(UTTERANCES)} 条句子 × {ITERATIONS} 次）")
+    print("=" * 60)
+    rule_ms = benchmark_rules()
+
+    if not (app.DOUBAO_API_KEY or os.getenv("AI_BUILDER_TOKEN", "test") != "test"):
+        print("   未配置 DOUBAO_API_KEY / AI_BUILDER_TOKEN，跳过 LLM 对比")
+        return
+    llm_ms = asyncio.run(benchmark_llm())
+    if llm_ms:
+        print()
+        print(f"   LLM 平均 {llm_ms:.0f} ms，规则解析约快 {llm_ms / rule_ms:.0f} 倍")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+测试 AppleScript 执行器（可在 Linux 上运行）
+- NullScriptRunner：验证日历 / 备忘录函数传给脚本的参数和结果解析
+- WorkerPoolScriptRunner：用一个实现相同管道协议的 Python 进程代替 osascript，
+  验证常驻进程复用、超时和崩溃后重启
+- OperationLog：撤回 / 重做栈在压缩和重新打开后保持不变
+"""
+
+import os
+import sys
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("AI_BUILDER_TOKEN", "test")
+os.environ["APPLESCRIPT_RUNNER"] = "null"
+# 数据库放到临时目录：导入 app 时不在仓库的 data/ 下创建数据库文件
+TEST_DATA_DIR = tempfile.mkdtemp(prefix="timeflow-test-")
+os.environ["DATABASE_FILE"] = os.path.join(TEST_DATA_DIR, "timeflow.db")
+os.environ["JOBS_DATABASE_FILE"] = os.path.join(TEST_DATA_DIR, "jobs.db")
+
+import app  # noqa: E402
+
+# 模拟 worker：按行读取 JSON 请求，脚本中包含 sleep / crash 时分别模拟卡住和崩溃
+FAKE_WORKER_SOURCE = r'''
+import json, os, sys, time
+for line in sys.stdin:
+    request = json.loads(line)
+    if "crash" in request["source"]:
+        sys.exit(1)
+    if "sleep" in request["source"]:
+        time.sleep(10)
+    print(json.dumps({"id": request["id"], "code": 0, "stdout": str(os.getpid()) + ":" + ",".join(request["args"]), "stderr": ""}), flush=True)
+'''
+
+
+def test_null_runner():
+    """日历 / 备忘录函数通过执行器调用，参数不再拼接进脚本"""
+    print("🧪 NullScriptRunner")
+
+    def responder(script, args):
+        if "OK" in script:  # 批量脚本
+            return "OK\t0\tE-1\nERR\t1\texecution error: 日历不可用 (-1728)\n"
+        return "EVENT-ID"
+
+    runner = app.NullScriptRunner(responder)
+    app.applescript_runner = runner
+    app.notes_id_cache.clear()
+
+    result = app.add_to_calendar_via_applescript({
+        "activity": '开会 "周会"',
+        "start_time": "2026-10-17T09:00:00",
+        "end_time": "2026-10-17T10:00:00",
+        "calendar_name": "工作",
+        "tag_color": "#FF6B6B",
+        "recurrence": "weekly",
+    })
+    script, args = runner.calls[-1]
+    assert result == {"success": True, "event_id": "EVENT-ID", "message": "事件已添加到日历"}, result
+    assert args[0] == "工作" and args[2] == '开会 "周会"' and args[6] == "FREQ=WEEKLY;INTERVAL=1", args
+    assert '周会' not in script  # 同一个模板，参数通过 argv 传入
+    print("   ✅ 单个事件")
+
+    results = app.add_events_to_calendar_via_applescript([
+        {"activity": "a", "start_time": "2026-10-17T09:00:00", "end_time": "2026-10-17T10:00:00"},
+        {"activity": "b", "start_time": "2026-10-17T11:00:00", "end_time": "2026-10-17T12:00:00"},
+    ])
+    assert results[0]["success"] and results[0]["event_id"] == "E-1", results
+    assert not results[1]["success"] and "-1728" in results[1]["error"], results
+    print("   ✅ 批量事件（逐个事件返回成功 / 失败）")
+
+    result = app.append_to_notes_via_applescript("时间", "09:00-10:00\n开会")
+    script, args = runner.calls[-1]
+    assert result["success"] and args == ["时间", "09:00-10:00<br>开会"], args
+    print("   ✅ 追加备忘录")
+
+
+def test_notes_id_cache():
+    """备忘录第一次按名称查询后缓存ID，ID 失效时重新查询"""
+    print("🧪 备忘录ID缓存")
+    state = {"deleted": False}
+
+    def responder(script, args):
+        if "note id" in script:
+            if state["deleted"]:
+                return app.ScriptResult(1, "", "execution error: Notes got an error: Can't get note id. (-1728)")
+            return args[0]
+        return "x-coredata://note/p1" if not state["deleted"] else "x-coredata://note/p2"
+
+    runner = app.NullScriptRunner(responder)
+    app.applescript_runner = runner
+    app.notes_id_cache.clear()
+
+    assert app.append_to_notes_via_applescript("时间", "第一条")["success"]
+    assert "whose name is" in runner.calls[-1][0]
+    assert app.append_to_notes_via_applescript("时间", "第二条")["success"]
+    assert "note id" in runner.calls[-1][0] and runner.calls[-1][1][0] == "x-coredata://note/p1"
+    print("   ✅ 第二次追加直接按ID写入")
+
+    state["deleted"] = True
+    assert app.append_to_notes_via_applescript("时间", "第三条")["success"]
+    assert "whose name is" in runner.calls[-1][0]
+    assert app.notes_id_cache["时间"] == "x-coredata://note/p2"
+    print("   ✅ ID 失效后重新查询并更新缓存")
+
+
+def test_batch_undo():
+    """撤回：一次脚本调用删除整个操作的所有事件，分别报告成功 / 不存在 / 失败"""
+    print("🧪 批量撤回")
+    runner = app.NullScriptRunner(lambda script, args: "OK\t0\nMISSING\t1\tCan't get event.\nERR\t2\t权限不足\n")
+    app.applescript_runner = runner
+
+    results = app.delete_calendar_events_via_applescript([("E1", "工作"), ("E2", None), ("E3", "生活")])
+    assert [r["status"] for r in results] == ["deleted", "missing", "failed"], results
+    assert len(runner.calls) == 1 and runner.calls[0][1] == ["工作", "E1", "TimeFlow", "E2", "生活", "E3"]
+    print("   ✅ 三个事件只调用一次脚本（deleted / missing / failed）")
+
+    operation = {"event_ids": ["E1", "E2", "E3"],
+                 "events": [{"activity": "a", "calendar_name": "工作"}, {"activity": "b"},
+                            {"activity": "c", "calendar_name": "生活"}]}
+    original = app.load_undo_operation
+    app.load_undo_operation = lambda: (operation, lambda removed=None: None)
+    try:
+        result = app.undo_last_events_via_applescript()
+    finally:
+        app.load_undo_operation = original
+    assert (result["deleted_count"], result["missing_count"], result["failed_count"]) == (1, 1, 1), result
+    assert result["message"] == "成功撤回 1 个事件，失败 1 个", result
+    print("   ✅ 撤回结果中不存在的事件不计入失败数")
+
+
+def test_undo_redo_stack():
+    """操作日志的撤回 / 重做栈：压缩、重新打开后保持不变，新操作清空重做栈"""
+    print("🧪 撤回 / 重做栈（OperationLog）")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "event_history.jsonl")
+        log = app.OperationLog(path, background=False)
+        for i in range(5):
+            log.append({"id": f"op{i}", "event_ids": [f"E{i}"]})
+        assert log.undo()["id"] == "op4" and log.undo()["id"] == "op3"
+        log.redo({"id": "op3", "event_ids": ["E3-new"]})
+        assert log.latest()["event_ids"] == ["E3-new"] and log.latest_undone()["id"] == "op4"
+        operations, before = log.page(limit=3)
+        assert [o["id"] for o in operations] == ["op3", "op2", "op1"] and before == 1
+        assert [o["id"] for o in log.page(before, limit=3)[0]] == ["op0"]
+        print("   ✅ 撤回两次、重做一次，分页从栈顶开始")
+
+        log.compact()
+        assert len(log) == 4 and log.redo_count == 1 and log.latest_undone()["id"] == "op4"
+        log.close()
+        log = app.OperationLog(path, background=False)
+        assert len(log) == 4 and log.redo_count == 1 and log.latest()["event_ids"] == ["E3-new"]
+        print("   ✅ 压缩并重新打开后撤回 / 重做栈不变")
+
+        log.append({"id": "op5", "event_ids": ["E5"]})
+        assert log.redo_count == 0 and log.latest_undone() is None
+        log.close()
+        print("   ✅ 新操作清空重做栈")
+
+
+def test_worker_pool():
+    """常驻进程复用、超时后重启、崩溃后重启"""
+    print("🧪 WorkerPoolScriptRunner（模拟 worker）")
+    runner = app.WorkerPoolScriptRunner(size=1, command=[sys.executable, "-c", FAKE_WORKER_SOURCE])
+    try:
+        first = runner.run("return argv", ["a", "b"], timeout=5)
+        second = runner.run("return argv", ["c"], timeout=5)
+        pid = first.stdout.split(":")[0]
+        assert first.returncode == 0 and first.stdout.endswith("a,b"), first.stdout
+        assert second.stdout.split(":")[0] == pid, "应复用同一个进程"
+        print(f"   ✅ 两次调用复用同一进程 (pid={pid})")
+
+        try:
+            runner.run("sleep", timeout=0.5)
+            raise AssertionError("应当超时")
+        except subprocess.TimeoutExpired:
+            pass
+        after_timeout = runner.run("return argv", ["x"], timeout=5)
+        assert after_timeout.returncode == 0 and after_timeout.stdout.split(":")[0] != pid
+        print("   ✅ 超时后结束进程，下一次调用自动重启")
+
+        crashed = runner.run("crash", timeout=5)
+        assert crashed.returncode != 0, crashed.stdout
+        recovered = runner.run("return argv", ["y"], timeout=5)
+        assert recovered.returncode == 0 and recovered.stdout.endswith("y")
+        print(f"   ✅ 崩溃后返回错误并重启（重启次数: {runner.stats()['workers'][0]['restarts']}）")
+    finally:
+        runner.close()
+
+
+if __name__ == "__main__":
+    test_null_runner()
+    test_notes_id_cache()
+    test_batch_undo()
+    test_undo_redo_stack()
+    test_worker_pool()
+    print()
+    print("✅ 全部通过")
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+测试本地转录的内存解码（可在 Linux 上运行，不需要 Faster Whisper；需要 numpy）
+- 16kHz PCM WAV 直接转换为 float32（多声道取平均）
+- 其他格式交给 PyAV / ffmpeg，都不可用时返回明确的错误
+- /api/transcribe 本地路径把解码后的数组交给模型，不写临时文件
+"""
+
+import io
+import os
+import sys
+import wave
+import tempfile
+from types import SimpleNamespace
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("AI_BUILDER_TOKEN", "test")
+os.environ["APPLESCRIPT_RUNNER"] = "null"
+# 数据库放到临时目录：导入 app 时不在仓库的 data/ 下创建数据库文件
+TEST_DATA_DIR = tempfile.mkdtemp(prefix="timeflow-test-")
+os.environ["DATABASE_FILE"] = os.path.join(TEST_DATA_DIR, "timeflow.db")
+os.environ["JOBS_DATABASE_FILE"] = os.path.join(TEST_DATA_DIR, "jobs.db")
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import app  # noqa: E402
+
+
+def make_wav(samples, channels=1, rate=16000):
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(np.asarray(samples, dtype="<i2").tobytes())
+    return buffer.getvalue()
+
+
+def test_decode_wav():
+    print("🧪 WAV 解码")
+    audio = app.decode_audio_bytes(make_wav([0, 16384, -32768, 32767]))
+    assert audio.dtype == np.float32 and np.allclose(audio, [0, 0.5, -1, 32767 / 32768]), audio
+    audio = app.decode_audio_bytes(make_wav([16384, 0, -16384, 16384], channels=2))
+    assert np.allclose(audio, [0.25, 0]), audio
+    print("   ✅ 16kHz PCM 直接转换，多声道取平均")
+
+    assert app._decode_wav_pcm(make_wav([0, 1], rate=44100)) is None
+    assert app._decode_wav_pcm(b"\x00\x00\x00\x18ftypM4A ") is None
+    if not app.FASTER_WHISPER_AVAILABLE:
+        original = app.subprocess.run
+
+        def missing_ffmpeg(*args, **kwargs):
+            raise FileNotFoundError("ffmpeg")
+
+        app.subprocess.run = missing_ffmpeg
+        try:
+            app.decode_audio_bytes(b"\x00\x00\x00\x18ftypM4A ")
+            raise AssertionError("应当抛出异常")
+        except Exception as e:
+            assert "ffmpeg" in str(e), e
+        finally:
+            app.subprocess.run = original
+    print("   ✅ 其他采样率和格式交给 PyAV / ffmpeg")
+
+
+def test_transcribe_in_memory():
+    print("🧪 /api/transcribe 本地路径")
+    received = []
+
+    class FakeWhisperModel:
+        def transcribe(self, audio, **kwargs):
+            received.append(audio)
+            return iter([SimpleNamespace(text="你好")]), SimpleNamespace(language="zh", language_probability=0.9)
+
+    def no_temp_file(*args, **kwargs):
+        raise AssertionError("不应写临时文件")
+
+    app.FASTER_WHISPER_AVAILABLE = True
+    app.STT_CACHE_ENABLED = False
+    app.whisper_models = app.WhisperModelManager("fake", factory=FakeWhisperModel)
+    original = tempfile.NamedTemporaryFile
+    tempfile.NamedTemporaryFile = no_temp_file
+    try:
+        response = TestClient(app.app).post(
+            "/api/transcribe", data={"use_local": "true"},
+            files={"audio_file": ("recording.wav", make_wav(np.zeros(8000)), "audio/wav")})
+    finally:
+        tempfile.NamedTemporaryFile = original
+    assert response.json()["transcript"] == "你好", response.text
+    assert isinstance(received[-1], np.ndarray) and len(received[-1]) == 8000, received
+    print("   ✅ 解码后的数组直接交给模型，没有临时文件")
+
+
+if __name__ == "__main__":
+    test_decode_wav()
+    test_transcribe_in_memory()
+    print()
+    print("✅ 全部通过")
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+并发压测 /api/analyze
+验证：多个分析请求同时进行时不会被串行执行，且其他接口（/api/tags）不会被阻塞
+"""
+
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+API_BASE_URL = "http://127.0.0.1:8000"
+CONCURRENCY = 5
+
+TRANSCRIPTS = [
+    "今天早上八点到九点在通勤",
+    "刚刚半小时我在吃饭",
+    "下午两点到三点开会",
+    "晚上八点到九点跑步",
+    "九点到九点半学习",
+]
+
+
+def analyze_once(transcript):
+    """发送一次分析请求，返回 (耗时, 是否成功)"""
+    start = time.time()
+    try:
+        response = requests.post(
+            f"{API_BASE_URL}/api/analyze",
+            json={"transcript": transcript},
+            timeout=120
+        )
+        ok = response.status_code == 200 and response.json().get("success", False)
+    except Exception as e:
+        print(f"   ❌ 请求失败: {e}")
+        ok = False
+    return time.time() - start, ok
+
+
+def ping_tags():
+    """在分析请求进行期间访问 /api/tags，测量响应时间"""
+    start = time.time()
+    try:
+        requests.get(f"{API_BASE_URL}/api/tags", timeout=120)
+    except Exception as e:
+        print(f"   ❌ /api/tags 请求失败: {e}")
+    return time.time() - start
+
+
+def test_concurrent_analyze():
+    """并发发送分析请求，比较总耗时与单请求耗时之和"""
+    print("=" * 60)
+    print(f"🚀 并发压测 /api/analyze（并发数: {CONCURRENCY}）")
+    print("=" * 60)
+    print()
+
+    transcripts = [TRANSCRIPTS[i % len(TRANSCRIPTS)] for i in range(CONCURRENCY)]
+
+    wall_start = time.time()
+    with ThreadPoolExecutor(max_workers=CONCURRENCY + 1) as executor:
+        futures = [executor.submit(analyze_once, t) for t in transcripts]
+        # 等分析请求发出后再访问 /api/tags
+        time.sleep(0.2)
+        tags_latency = executor.submit(ping_tags).result()
+        results = [f.result() for f in futures]
+    wall_time = time.time() - wall_start
+
+    latencies = [r[0] for r in results]
+    success_count = sum(1 for r in results if r[1])
+    serial_time = sum(latencies)
+    overlap = serial_time / wall_time if wall_time > 0 else 0
+
+    for i, (latency, ok) in enumerate(results, 1):
+        status = "✅" if ok else "❌"
+        print(f"   {status} 请求 {i}: {latency:.2f} 秒")
+    print()
+    print(f"📊 成功: {success_count}/{CONCURRENCY}")
+    print(f"📊 总耗时（墙钟）: {wall_time:.2f} 秒")
+    print(f"📊 单请求耗时之和: {serial_time:.2f} 秒")
+    print(f"📊 并发度（之和 / 墙钟）: {overlap:.2f}x")
+    print(f"📊 分析进行期间 /api/tags 响应: {tags_latency * 1000:.0f} ms")
+    print()
+
+    if overlap > 1.5:
+        print("✅ 分析请求并发执行（没有被串行化）")
+    else:
+        print("⚠️  分析请求看起来是串行执行的（并发度接近 1）")
+
+    if tags_latency < 1.0:
+        print("✅ /api/tags 未被 LLM 调用阻塞")
+    else:
+        print("⚠️  /api/tags 响应缓慢，事件循环可能被阻塞")
+
+
+if __name__ == "__main__":
+    test_concurrent_analyze()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+测试规则解析（快速路径，可在 Linux 上运行，不调用 LLM）
+- 常见的简单句子解析出正确的时间块和标签
+- 无法确定的句子返回空结果或较低的置信度（回退到 LLM）
+- /api/analyze 在置信度足够时不调用 LLM
+- 分析结果缓存：相对当前时间的文本命中时平移到当前时间，缓存键区分 provider
+"""
+
+import os
+import sys
+import tempfile
+import asyncio
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("AI_BUILDER_TOKEN", "test")
+os.environ["APPLESCRIPT_RUNNER"] = "null"
+# 数据库放到临时目录：导入 app 时不在仓库的 data/ 下创建数据库文件
+TEST_DATA_DIR = tempfile.mkdtemp(prefix="timeflow-test-")
+os.environ["DATABASE_FILE"] = os.path.join(TEST_DATA_DIR, "timeflow.db")
+os.environ["JOBS_DATABASE_FILE"] = os.path.join(TEST_DATA_DIR, "jobs.db")
+
+import app  # noqa: E402
+
+# 使用默认标签，避免受本地标签配置影响
+app.tag_registry.tags = lambda: [dict(tag) for tag in app.DEFAULT_TAGS]
+
+NOW = datetime(2026, 10, 17, 22, 33, 10)
+
+# (文本, [(活动, 开始, 结束, 标签)])
+CASES = [
+    ("刚刚半小时在学习", [("学习", "2026-10-17T22:03:10", "2026-10-17T22:33:10", "生活")]),
+    ("早上9点到10点开会", [("开会", "2026-10-17T09:00:00", "2026-10-17T10:00:00", "工作")]),
+    ("晚上八点到九点在练歌房练歌", [("练歌", "2026-10-17T20:00:00", "2026-10-17T21:00:00", "娱乐")]),
+    ("昨天晚上十点到十一点半看电影", [("看电影", "2026-10-16T22:00:00", "2026-10-16T23:30:00", "娱乐")]),
+    ("晚上十点到一点打游戏", [("打游戏", "2026-10-17T22:00:00", "2026-10-18T01:00:00", "娱乐")]),
+    ("早上8点跑步半小时", [("跑步", "2026-10-17T08:00:00", "2026-10-17T08:30:00", "运动")]),
+    ("过去两个小时一直在写报告", [("写报告", "2026-10-17T20:33:10", "2026-10-17T22:33:10", "工作")]),
+    ("看了两小时书", [("看书", "2026-10-17T20:33:10", "2026-10-17T22:33:10", "生活")]),
+    ("从九点到十点，开会", [("开会", "2026-10-17T21:00:00", "2026-10-17T22:00:00", "工作")]),
+    ("9点到10点开会，10点到11点写代码", [
+        ("开会", "2026-10-17T21:00:00", "2026-10-17T22:00:00", "工作"),
+        ("写代码", "2026-10-17T22:00:00", "2026-10-17T23:00:00", "工作"),
+    ]),
+    ("9am-10am meeting", [("meeting", "2026-10-17T09:00:00", "2026-10-17T10:00:00", "工作")]),
+    ("from 2pm to 3:30pm gym", [("gym", "2026-10-17T14:00:00", "2026-10-17T15:30:00", "运动")]),
+    ("yesterday 8pm to 9pm movie", [("movie", "2026-10-16T20:00:00", "2026-10-16T21:00:00", "娱乐")]),
+]
+
+# 规则无法处理的句子（交给 LLM）
+UNSUPPORTED = [
+    "今天很开心",
+    "刚刚吃饭",
+    "下午三点开会",
+    "今天早上八点出门然后九点到了咖啡厅九点到九点半呢我开始学习",
+    "上午学习，下午打球两小时",  # "上午学习"没有具体时间，不能并入下一个事件
+    "晚上看电影，九点到十点写作业",
+]
+
+
+def test_parse_cases():
+    print("🧪 规则解析")
+    for transcript, expected in CASES:
+        blocks, confidence = app.parse_time_blocks_fast(transcript, NOW)
+        actual = [(b["activity"], b["start_time"], b["end_time"], b["tag"]) for b in blocks]
+        assert actual == expected, f"{transcript}: {actual}"
+        assert confidence >= app.FAST_PATH_MIN_CONFIDENCE, f"{transcript}: {confidence}"
+        print(f"   ✅ {transcript}（置信度 {confidence}）")
+
+    for transcript in UNSUPPORTED:
+        blocks, confidence = app.parse_time_blocks_fast(transcript, NOW)
+        assert not blocks or confidence < app.FAST_PATH_MIN_CONFIDENCE, f"{transcript}: {blocks}"
+        print(f"   ✅ {transcript} -> 回退到 LLM")
+
+    # 下午三点时原先会把两个子句合并为"学习打球 13:00-15:00"
+    assert app.parse_time_blocks_fast("上午学习，下午打球两小时", datetime(2026, 10, 17, 15, 0)) == ([], 0.0)
+
+
+def test_ambiguity():
+    """没有时段的时刻取最近一次已经开始的时间，并降低置信度"""
+    print("🧪 上午 / 下午歧义")
+    blocks, confidence = app.parse_time_blocks_fast("9点到10点开会", datetime(2026, 10, 17, 9, 40))
+    assert blocks[0]["start_time"] == "2026-10-17T09:00:00" and confidence < 0.95, (blocks, confidence)
+    blocks, _ = app.parse_time_blocks_fast("9点到10点开会", datetime(2026, 10, 17, 22, 33))
+    assert blocks[0]["start_time"] == "2026-10-17T21:00:00", blocks
+    blocks, _ = app.parse_time_blocks_fast("待会儿六点到六点半吃晚饭", datetime(2026, 10, 17, 15, 0))
+    assert blocks[0]["start_time"] == "2026-10-17T18:00:00", blocks
+    print("   ✅ 上午 / 晚上 / 待会儿")
+
+
+def test_analyze_skips_llm():
+    """置信度足够时 /api/analyze 不调用 LLM"""
+    print("🧪 /api/analyze 快速路径")
+    original = app.call_llm_provider
+
+    async def fail(*args, **kwargs):
+        raise AssertionError("不应调用 LLM")
+
+    app.call_llm_provider = fail
+    try:
+        request = app.TimeAnalysisRequest(transcript="刚刚半小时在跑步", use_cache=False)
+        result = asyncio.run(app.analyze_time_entry(request))
+        assert result["success"] and result["path"] == "fast_path" and result["model"] == app.FAST_PATH_MODEL, result
+        assert result["data"][0]["activity"] == "跑步" and result["data"][0]["tag"] == "运动", result
+        print(f"   ✅ 未调用 LLM（置信度 {result['confidence']}）")
+    finally:
+        app.call_llm_provider = original
+
+
+def test_cache_time_anchor():
+    """缓存命中时只平移相对当前时间的结果；钟点和当前时间混合的文本不缓存"""
+    print("🧪 分析结果缓存的时间基准")
+    anchors = {
+        "刚刚吃饭": "now",
+        "看了两小时书": "now",
+        "跑步半小时": "now",
+        "学习两小时到现在": "now",
+        "9点到10点开会": "clock",
+        "早上8点跑步半小时": "clock",
+        "今天很开心": "clock",
+        "从九点到现在一直在写代码": None,
+        "九点到十点开会，刚才又跑步半小时": None,
+    }
+    for transcript, expected in anchors.items():
+        assert app.get_time_anchor(transcript) == expected, (transcript, app.get_time_anchor(transcript))
+    print(f"   ✅ {len(anchors)} 个句子的时间基准")
+
+    later = NOW + timedelta(minutes=5)
+    for transcript, shifted in (("看了两小时书", True), ("9点到10点开会", False)):
+        blocks, _ = app.parse_time_blocks_fast(transcript, NOW)
+        key = app.build_analysis_cache_key(transcript, NOW, ["doubao"], False)
+        app.store_analysis_result(key, {"success": True, "data": blocks}, NOW)
+        cached = app.get_cached_analysis(key, transcript, later)
+        expected = app.shift_iso_time(blocks[0]["end_time"], timedelta(minutes=5)) if shifted else blocks[0]["end_time"]
+        assert cached["cache"] == "hit" and cached["data"][0]["end_time"] == expected, cached
+    print("   ✅ \"看了两小时书\" 命中时平移到当前时间，\"9点到10点开会\" 不平移")
+
+    keys = {app.build_analysis_cache_key("看书", NOW, providers, race) for providers, race in (
+        (["doubao", "supermind"], False), (["supermind", "ollama"], False), (["doubao", "supermind"], True))}
+    assert len(keys) == 3
+    print("   ✅ 缓存键区分使用的 provider 和竞速模式")
+
+
+if __name__ == "__main__":
+    test_parse_cases()
+    test_ambiguity()
+    test_analyze_skips_llm()
+    test_cache_time_anchor()
+    print()
+    print("✅ 全部通过")
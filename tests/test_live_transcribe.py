@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+测试 /ws/transcribe 实时转录（可在 Linux 上运行，不需要 Faster Whisper；需要 numpy）
+用替身模型记录每次解码的音频长度，验证：
+- 开头的静音被丢弃，停顿前的音频解码一次后确定下来
+- 没有停顿的长录音按滑动窗口确定
+- stop 后只解码最后一次停顿之后的音频
+- 解码经过模型池的排队上限：排队已满时发送 error 帧（stage 区分临时结果和最终结果）
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import tempfile
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("AI_BUILDER_TOKEN", "test")
+os.environ["APPLESCRIPT_RUNNER"] = "null"
+# 数据库放到临时目录：导入 app 时不在仓库的 data/ 下创建数据库文件
+TEST_DATA_DIR = tempfile.mkdtemp(prefix="timeflow-test-")
+os.environ["DATABASE_FILE"] = os.path.join(TEST_DATA_DIR, "timeflow.db")
+os.environ["JOBS_DATABASE_FILE"] = os.path.join(TEST_DATA_DIR, "jobs.db")
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import app  # noqa: E402
+
+RATE = 16000
+
+
+class FakeWhisperModel:
+    """每秒音频返回一个片段，记录每次解码的音频长度（秒）"""
+
+    def __init__(self):
+        self.decoded = []
+
+    def transcribe(self, audio, **kwargs):
+        seconds = len(audio) / RATE
+        self.decoded.append(round(seconds, 1))
+        return iter([SimpleNamespace(start=float(i), end=float(i + 1), text=f"[{i}]")
+                     for i in range(max(1, int(seconds)))]), None
+
+
+def tone(seconds):
+    t = np.arange(int(seconds * RATE)) / RATE
+    return (np.sin(2 * np.pi * 220 * t) * 8000).astype("<i2").tobytes()
+
+
+def silence(seconds):
+    return np.zeros(int(seconds * RATE), dtype="<i2").tobytes()
+
+
+def send_audio(ws, audio, chunk_ms=100, delay=0.002):
+    step = RATE * 2 * chunk_ms // 1000
+    for i in range(0, len(audio), step):
+        ws.send_bytes(audio[i:i + step])
+        time.sleep(delay)
+
+
+def stop(ws):
+    ws.send_text(json.dumps({"type": "stop"}))
+    partials = []
+    while True:
+        message = ws.receive_json()
+        if message["type"] == "final":
+            return message, partials
+        partials.append(message)
+
+
+def test_live_transcribe():
+    print("🧪 /ws/transcribe")
+    model = FakeWhisperModel()
+    app.whisper_models = app.WhisperModelManager("fake", factory=lambda: model)
+    assert app.whisper_models.load()
+    model.decoded.clear()  # 去掉预热的解码
+    client = TestClient(app.app)
+
+    with client.websocket_connect("/ws/transcribe?language=zh-CN") as ws:
+        assert ws.receive_json()["type"] == "ready"
+        send_audio(ws, silence(2) + tone(2.5) + silence(0.8) + tone(1.5))
+        time.sleep(0.2)
+        final, partials = stop(ws)
+        assert partials and partials[-1]["committed"], partials
+        assert max(model.decoded) < 3.5, model.decoded  # 开头的 2 秒静音没有参与解码
+        assert model.decoded[-1] < 2.5, model.decoded  # 结束时只解码停顿之后的 1.5 秒
+        assert final["text"].startswith(partials[-1]["committed"]), final
+        print(f"   ✅ 停顿时确定文本，结束时只解码最后一段（解码长度: {model.decoded}，结束耗时 {final['finalize_ms']}ms）")
+
+        # 同一连接继续录第二段：没有停顿的长录音
+        model.decoded.clear()
+        send_audio(ws, tone(16), delay=0.001)
+        time.sleep(0.3)
+        final, _ = stop(ws)
+        assert final["text"].count("[") >= 15 and final["audio_seconds"] == 16.0, final
+        print(f"   ✅ 长录音按滑动窗口确定（解码长度: {model.decoded}）")
+
+    app.FASTER_WHISPER_AVAILABLE = False
+    app.whisper_models = app.WhisperModelManager("fake")
+    with client.websocket_connect("/ws/transcribe") as ws:
+        assert ws.receive_json()["type"] == "error"
+    print("   ✅ 没有本地模型时返回 error")
+
+
+def test_live_backpressure():
+    print("🧪 /ws/transcribe 排队已满")
+    model = FakeWhisperModel()
+    app.FASTER_WHISPER_AVAILABLE = True
+    app.whisper_models = app.WhisperModelManager("fake", factory=lambda: model, queue_size=0)
+    assert app.whisper_models.load()
+    client = TestClient(app.app)
+
+    # 另一个请求占用唯一的解码线程
+    release = threading.Event()
+    started = threading.Event()
+    original = model.transcribe
+
+    def blocking(audio, **kwargs):
+        started.set()
+        release.wait(5)
+        return original(audio, **kwargs)
+
+    model.transcribe = blocking
+    busy = threading.Thread(target=lambda: asyncio.run(app.whisper_models.submit(np.zeros(RATE, dtype=np.float32))))
+    busy.start()
+    assert started.wait(2)
+    model.transcribe = original
+    try:
+        with client.websocket_connect("/ws/transcribe") as ws:
+            assert ws.receive_json()["type"] == "ready"
+            send_audio(ws, tone(1.5) + silence(0.8))
+            time.sleep(0.2)
+            ws.send_text(json.dumps({"type": "stop"}))
+            messages = []
+            while not messages or messages[-1].get("stage") != "final":
+                messages.append(ws.receive_json())
+            assert all(m["type"] == "error" for m in messages), messages
+            assert messages[-1]["retry_after"] >= 1, messages
+            assert app.whisper_models.status()["rejected"] >= 1
+            print(f"   ✅ 临时结果和最终结果都被拒绝，发送 error 帧（{len(messages)} 个，stage: final）")
+    finally:
+        release.set()
+        busy.join()
+
+
+if __name__ == "__main__":
+    test_live_transcribe()
+    test_live_backpressure()
+    print()
+    print("✅ 全部通过")
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+测试 LLM 流式响应的增量 JSON 解析（可在 Linux 上运行，不访问网络）
+- TimeBlockStreamParser：逐字符输入时正确处理代码块标记、字符串中的括号、嵌套数组和不完整的 JSON
+- 豆包 / Supermind SSE、Ollama NDJSON：用 httpx.MockTransport 模拟流式响应，每个时间块对象结束时立即回调
+"""
+
+import os
+import sys
+import tempfile
+import json
+import asyncio
+from datetime import datetime, timedelta
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("AI_BUILDER_TOKEN", "test")
+os.environ["APPLESCRIPT_RUNNER"] = "null"
+# 数据库放到临时目录：导入 app 时不在仓库的 data/ 下创建数据库文件
+TEST_DATA_DIR = tempfile.mkdtemp(prefix="timeflow-test-")
+os.environ["DATABASE_FILE"] = os.path.join(TEST_DATA_DIR, "timeflow.db")
+os.environ["JOBS_DATABASE_FILE"] = os.path.join(TEST_DATA_DIR, "jobs.db")
+
+import app  # noqa: E402
+
+NOW = datetime.now().replace(microsecond=0)
+START = (NOW - timedelta(hours=1)).isoformat()
+END = NOW.isoformat()
+BLOCKS = [
+    {"activity": "开会 [周会]", "start_time": START, "end_time": END, "tag": "工作", "description": '讨论 "Q4 {计划}"'},
+    {"activity": "无效", "start_time": END, "end_time": END},
+    {"activity": "写代码", "start_time": START, "end_time": END, "tag": "工作", "notes": [["嵌套"], {"a": "]"}]},
+]
+PAYLOAD = "好的，结果如下：\n```json\n" + json.dumps(BLOCKS, ensure_ascii=False) + "\n```\n以上 [完]"
+
+
+def test_parser():
+    print("🧪 TimeBlockStreamParser")
+    parser = app.TimeBlockStreamParser()
+    items = []
+    for ch in PAYLOAD:
+        items += parser.feed(ch)
+    assert [item["activity"] for item in items] == ["开会 [周会]", "无效", "写代码"], items
+    assert items[2]["notes"] == [["嵌套"], {"a": "]"}] and parser.closed
+    assert json.loads(parser.finish()) == BLOCKS
+    print("   ✅ 逐字符输入：跳过说明文字和代码块，字符串中的括号和嵌套数组不影响解析")
+
+    parser = app.TimeBlockStreamParser()
+    parser.feed('[{"activity": "a"}, {"activity": "b", "start_')
+    assert [item["activity"] for item in parser.items] == ["a"] and not parser.closed
+    parser.finish()
+    print("   ✅ 响应被截断时保留已完成的时间块")
+
+    parser = app.TimeBlockStreamParser()
+    assert parser.feed('{"activity": "单个对象"}') == [{"activity": "单个对象"}]
+    parser = app.TimeBlockStreamParser()
+    parser.feed("没有检测到时间信息")
+    try:
+        parser.finish()
+        raise AssertionError("应当抛出 ValueError")
+    except ValueError:
+        pass
+    print("   ✅ 单个对象视为一个时间块；没有 JSON 时抛出 ValueError")
+
+
+def chunks(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def test_streaming_providers():
+    print("🧪 流式 provider（模拟 SSE / NDJSON）")
+
+    def sse_handler(cached_tokens):
+        def handler(request):
+            assert json.loads(request.content)["stream"] is True
+            events = [{"choices": [{"delta": {"content": part}}]} for part in chunks(PAYLOAD, 7)]
+            events.append({"choices": [], "usage": {"prompt_tokens": 100,
+                                                    "prompt_tokens_details": {"cached_tokens": cached_tokens}}})
+            body = "".join(f"data: {json.dumps(event, ensure_ascii=False)}\n\n" for event in events)
+            return httpx.Response(200, text=body + "data: [DONE]\n\n")
+        return handler
+
+    def ollama_handler(request):
+        lines = [json.dumps({"message": {"content": part}, "done": False}) for part in chunks(PAYLOAD, 5)]
+        lines.append(json.dumps({"message": {"content": ""}, "done": True, "prompt_eval_count": 50}))
+        return httpx.Response(200, text="\n".join(lines) + "\n")
+
+    app.LLM_STREAMING = True
+    app.doubao_http_client = httpx.AsyncClient(transport=httpx.MockTransport(sse_handler(64)))
+    app.supermind_http_client = httpx.AsyncClient(transport=httpx.MockTransport(sse_handler(32)))
+    app.ollama_http_client = httpx.AsyncClient(transport=httpx.MockTransport(ollama_handler))
+
+    async def run(provider):
+        seen = []
+        collector = app.TimeBlockCollector("开会", app.LLM_PROVIDERS[provider]["model"], NOW, END,
+                                           on_block=lambda block: seen.append(block["activity"]))
+        await app.call_llm_provider(provider, "system", "user", collector.feed)
+        collector.finish()
+        return collector, seen
+
+    for provider in ("doubao", "supermind", "ollama"):
+        collector, seen = asyncio.run(run(provider))
+        assert seen == ["开会 [周会]", "写代码"] and len(collector.raw_blocks) == 3, seen
+        assert collector.first_block_ms is not None
+        print(f"   ✅ {provider}: 2 个有效时间块逐个回调（首个时间块 {collector.first_block_ms}ms）")
+
+    assert app.prompt_usage_stats.snapshot()["doubao"]["cached_tokens"] == 64
+    assert app.prompt_usage_stats.snapshot()["supermind"]["cached_tokens"] == 32
+    print("   ✅ 流式响应的 usage 计入前缀缓存统计")
+
+
+if __name__ == "__main__":
+    test_parser()
+    test_streaming_providers()
+    print()
+    print("✅ 全部通过")
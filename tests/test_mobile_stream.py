@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+测试 /api/mobile/process/stream（可在 Linux 上运行，不访问网络）
+转录和 LLM 都用替身代替，验证事件顺序：received -> transcript -> block... -> done，
+以及 SSE / NDJSON 两种格式和接收音频失败时的 error 事件；大文件上传写入临时文件而不是读入内存
+"""
+
+import os
+import sys
+import tempfile
+import json
+import asyncio
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("AI_BUILDER_TOKEN", "test")
+os.environ["APPLESCRIPT_RUNNER"] = "null"
+# 数据库放到临时目录：导入 app 时不在仓库的 data/ 下创建数据库文件
+TEST_DATA_DIR = tempfile.mkdtemp(prefix="timeflow-test-")
+os.environ["DATABASE_FILE"] = os.path.join(TEST_DATA_DIR, "timeflow.db")
+os.environ["JOBS_DATABASE_FILE"] = os.path.join(TEST_DATA_DIR, "jobs.db")
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import app  # noqa: E402
+
+NOW = datetime.now().replace(microsecond=0)
+BLOCKS = [
+    {"activity": "开会", "start_time": (NOW - timedelta(hours=2)).isoformat(), "end_time": (NOW - timedelta(hours=1)).isoformat(), "tag": "工作"},
+    {"activity": "写代码", "start_time": (NOW - timedelta(hours=1)).isoformat(), "end_time": NOW.isoformat(), "tag": "工作"},
+]
+TRANSCRIPT = "今天先开了个会然后一直在写代码"
+
+
+async def fake_transcribe(audio_file, language=None, use_local=None):
+    assert await audio_file.read() == b"fake-audio"
+    return {"success": True, "transcript": TRANSCRIPT, "method": "cloud", "cache": "miss"}
+
+
+async def fake_stream(system_prompt, user_prompt):
+    """模拟 LLM 流式输出：每次返回一小段文本"""
+    payload = json.dumps(BLOCKS, ensure_ascii=False)
+    for i in range(0, len(payload), 16):
+        await asyncio.sleep(0.01)
+        yield payload[i:i + 16]
+
+
+def parse_sse(text):
+    events = []
+    for chunk in text.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in chunk.split("\n"))
+        events.append({"event": lines["event"], **json.loads(lines["data"])})
+    return events
+
+
+def test_stream():
+    print("🧪 /api/mobile/process/stream")
+    app.transcribe_audio = fake_transcribe
+    app.LLM_STREAMING = True
+    app.LLM_PROVIDERS["doubao"]["stream"] = fake_stream
+    app.DOUBAO_API_KEY = app.DOUBAO_API_KEY or "test"
+    client = TestClient(app.app)
+
+    response = client.post("/api/mobile/process/stream", files={"audio_file": ("r.m4a", b"fake-audio", "audio/m4a")})
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = parse_sse(response.text)
+    assert [e["event"] for e in events] == ["received", "transcript", "block", "block", "done"], events
+    assert events[1]["text"] == TRANSCRIPT
+    done = events[-1]
+    assert done["success"] and [e["activity"] for e in done["events"]] == ["开会", "写代码"]
+    assert done["timings"]["first_block_ms"] <= done["timings"]["analyze_ms"] <= done["timings"]["total_ms"]
+    print(f"   ✅ SSE 事件顺序正确（timings: {done['timings']}）")
+
+    response = client.post("/api/mobile/process/stream?format=ndjson", content=b"fake-audio",
+                           headers={"content-type": "audio/mp4"})
+    events = [json.loads(line) for line in response.text.splitlines()]
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert events[0]["event"] == "received" and events[-1]["event"] == "done", events
+    print("   ✅ NDJSON（raw body 上传）")
+
+    response = client.post("/api/mobile/process/stream?format=ndjson", data={"note": "没有音频"})
+    events = [json.loads(line) for line in response.text.splitlines()]
+    assert len(events) == 1 and events[0]["event"] == "error" and events[0]["step"] == "接收音频", events
+    print("   ✅ 没有音频时返回 error 事件")
+
+
+def test_large_upload():
+    """超过 1MB 的上传复制到磁盘上的临时文件，响应结束后关闭"""
+    print("🧪 大文件上传")
+    content = os.urandom(3 * 1024 * 1024)
+    received = []
+
+    async def record_transcribe(audio_file, language=None, use_local=None):
+        received.append((audio_file.file, audio_file.file._rolled, await audio_file.read()))
+        return {"success": True, "transcript": TRANSCRIPT, "method": "cloud", "cache": "miss"}
+
+    original = app.transcribe_audio
+    app.transcribe_audio = record_transcribe
+    try:
+        response = TestClient(app.app).post("/api/mobile/process/stream?format=ndjson",
+                                            files={"audio_file": ("r.m4a", content, "audio/m4a")})
+    finally:
+        app.transcribe_audio = original
+    spooled, rolled, data = received[-1]
+    assert json.loads(response.text.splitlines()[-1])["event"] == "done", response.text
+    assert rolled and data == content and spooled.closed
+    print("   ✅ 3MB 录音写入临时文件，响应结束后关闭")
+
+
+if __name__ == "__main__":
+    test_stream()
+    test_large_upload()
+    print()
+    print("✅ 全部通过")
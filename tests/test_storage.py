@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+测试存储后端（可在 Linux 上运行，在临时数据目录中进行，不影响 data/）
+- SQLite：从 time_log.json / event_history.json / tags.json 一次性迁移，数量和顺序不变；重启后不会重复迁移
+- JSON：event_history.json 迁移为 JSONL 操作日志
+- 两个后端：压栈 / 撤回 / 重做往返、新操作清空重做栈、重启后栈状态不变
+- 两个后端：page_operations 游标分页（不重复、不遗漏、跳过已撤回的操作）
+- 有操作历史时撤回不再使用过期的 recent_event.json
+- 部分撤回后重做只重新创建实际删除的事件
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_DIR)
+os.environ.setdefault("AI_BUILDER_TOKEN", "test")
+os.environ["APPLESCRIPT_RUNNER"] = "null"
+
+# app 中的数据文件都是相对路径：导入后切换到临时目录，测试中新建的存储实例都在这里读写
+# 数据库路径在导入前指向临时目录，导入 app 时不在仓库的 data/ 下创建数据库文件
+WORK_DIR = tempfile.mkdtemp(prefix="timeflow-storage-")
+os.makedirs(os.path.join(WORK_DIR, "data"))
+os.environ["DATABASE_FILE"] = os.path.join(WORK_DIR, "data", "timeflow.db")
+os.environ["JOBS_DATABASE_FILE"] = os.path.join(WORK_DIR, "data", "jobs.db")
+
+os.chdir(REPO_DIR)  # 静态文件目录是相对路径
+
+import app  # noqa: E402
+
+os.chdir(WORK_DIR)
+
+BACKENDS = {
+    "json": app.JsonStorage,
+    "sqlite": lambda: app.SQLiteStorage(app.DATABASE_FILE),
+}
+
+
+def fresh_data_dir():
+    """清空临时数据目录"""
+    shutil.rmtree("data", ignore_errors=True)
+    os.makedirs("data")
+
+
+def write_json(path, data):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+
+
+def make_operation(index, event_count=2):
+    event_ids = [f"evt-{index}-{i}" for i in range(event_count)]
+    return {
+        "id": f"op_{index:03d}",
+        "event_ids": event_ids,
+        "events": [{"title": f"事件 {index}-{i}", "calendar_name": "工作"} for i in range(event_count)],
+        "created_at": f"2026-10-17T10:{index // 60:02d}:{index % 60:02d}",
+        "count": event_count,
+    }
+
+
+def operation_ids(operations):
+    return [operation["id"] for operation in operations]
+
+
+def test_migration():
+    print("🧪 JSON -> SQLite 迁移")
+    fresh_data_dir()
+    entries = [{"activity": f"活动 {i}", "start_time": f"2026-10-{17 - i % 3:02d}T0{i}:00:00",
+                "end_time": f"2026-10-{17 - i % 3:02d}T0{i}:30:00", "tag": "工作"} for i in range(5)]
+    operations = [make_operation(i, event_count=i % 3 + 1) for i in range(4)]
+    tags = [{"id": "work", "name": "工作", "description": "", "color": "#FF6B6B", "is_default": True},
+            {"id": "custom", "name": "自定义", "description": "用户添加", "color": "#123456", "is_default": False},
+            {"id": "life", "name": "生活", "description": "", "color": "#95E1D3", "is_default": True}]
+    write_json(app.TIME_LOG_FILE, {"entries": entries})
+    write_json(app.EVENT_HISTORY_FILE, {"operations": list(reversed(operations))})  # 最新的在前面
+    write_json(app.TAGS_FILE, {"tags": tags})
+
+    storage = BACKENDS["sqlite"]()
+    try:
+        assert storage.list_time_entries() == entries
+        migrated = storage.list_operations()
+        assert operation_ids(migrated) == operation_ids(reversed(operations)), operation_ids(migrated)
+        assert [op["event_ids"] for op in migrated] == [op["event_ids"] for op in reversed(operations)]
+        assert migrated[0]["events"] == operations[-1]["events"]
+        assert storage.load_tags() == tags
+    finally:
+        storage.close()
+    print(f"   ✅ {len(entries)} 条时间记录、{len(operations)} 次操作、{len(tags)} 个标签，顺序不变")
+
+    storage = BACKENDS["sqlite"]()
+    try:
+        assert len(storage.list_time_entries()) == len(entries)
+        assert len(storage.list_operations()) == len(operations)
+    finally:
+        storage.close()
+    print("   ✅ 重启后不会重复迁移")
+
+    os.remove(app.DATABASE_FILE)
+    storage = BACKENDS["json"]()
+    try:
+        assert operation_ids(storage.list_operations()) == operation_ids(reversed(operations))
+        assert os.path.exists(app.OPERATION_LOG_FILE)
+    finally:
+        storage.close()
+    print("   ✅ JSON 后端：event_history.json 迁移为 JSONL 操作日志")
+
+
+def test_undo_redo():
+    for name, factory in BACKENDS.items():
+        print(f"🧪 撤回 / 重做（{name}）")
+        fresh_data_dir()
+        storage = factory()
+        try:
+            for i in range(3):
+                storage.push_operation(make_operation(i))
+            assert storage.latest_operation()["id"] == "op_002"
+
+            storage.mark_operation_undone()
+            storage.mark_operation_undone()
+            assert storage.latest_operation()["id"] == "op_000"
+            assert storage.latest_undone_operation()["id"] == "op_001" and storage.redo_count() == 2
+
+            redone = {**storage.latest_undone_operation(), "event_ids": ["new-1", "new-2"]}
+            storage.mark_operation_redone(redone)
+            latest = storage.latest_operation()
+            assert latest["id"] == "op_001" and latest["event_ids"] == ["new-1", "new-2"], latest
+            assert storage.latest_undone_operation()["id"] == "op_002" and storage.redo_count() == 1
+            print("   ✅ 撤回两次后重做一次，重做的操作使用新的事件 ID")
+        finally:
+            storage.close()
+
+        # 重启后栈状态不变
+        storage = factory()
+        try:
+            assert operation_ids(storage.list_operations()) == ["op_001", "op_000"]
+            assert storage.latest_operation()["event_ids"] == ["new-1", "new-2"]
+            assert storage.latest_undone_operation()["id"] == "op_002"
+            storage.push_operation(make_operation(3))
+            assert storage.redo_count() == 0 and storage.latest_undone_operation() is None
+            assert operation_ids(storage.list_operations()) == ["op_003", "op_001", "op_000"]
+            for _ in range(3):
+                storage.mark_operation_undone()
+            assert storage.latest_operation() is None
+            storage.mark_operation_undone()  # 栈为空时不报错
+            print("   ✅ 重启后栈状态不变，新操作清空重做栈")
+        finally:
+            storage.close()
+
+
+def test_page_operations():
+    for name, factory in BACKENDS.items():
+        print(f"🧪 操作历史分页（{name}）")
+        fresh_data_dir()
+        storage = factory()
+        try:
+            for i in range(25):
+                storage.push_operation(make_operation(i, event_count=1))
+            storage.mark_operation_undone()  # op_024 移到重做栈，不出现在历史中
+
+            pages, cursor = [], None
+            while True:
+                operations, cursor = storage.page_operations(cursor, limit=10)
+                pages.append(operation_ids(operations))
+                if cursor is None:
+                    break
+            assert [len(page) for page in pages] == [10, 10, 4], pages
+            flat = [op_id for page in pages for op_id in page]
+            assert flat == [f"op_{i:03d}" for i in range(23, -1, -1)], flat
+
+            operations, cursor = storage.page_operations(None, limit=24)
+            assert len(operations) == 24 and cursor is None
+            print("   ✅ 10 + 10 + 4：按时间倒序，不重复、不遗漏，跳过已撤回的操作")
+        finally:
+            storage.close()
+
+
+def test_stale_recent_event():
+    print("🧪 过期的 recent_event.json")
+    fresh_data_dir()
+    app.storage = BACKENDS["sqlite"]()
+    try:
+        app.storage.push_operation(make_operation(0))
+        app.storage.export_json()  # 导出时写入 recent_event.json
+        app.storage.mark_operation_undone()
+        assert os.path.exists(app.RECENT_EVENT_FILE)
+        assert app.load_undo_operation() == (None, None)
+        print("   ✅ SQLite：撤回栈为空时不使用导出的 recent_event.json")
+    finally:
+        app.storage.close()
+
+    fresh_data_dir()
+    write_json(app.RECENT_EVENT_FILE, {"event_id": "legacy-1", "title": "旧格式事件"})
+    app.storage = BACKENDS["json"]()
+    try:
+        operation, cleanup = app.load_undo_operation()
+        assert operation["event_ids"] == ["legacy-1"], operation
+        cleanup()
+        assert app.load_undo_operation() == (None, None)
+        print("   ✅ JSON：还没有操作日志时仍可从旧的 recent_event.json 撤回")
+    finally:
+        app.storage.close()
+
+
+def test_partial_undo_redo():
+    for name, factory in BACKENDS.items():
+        print(f"🧪 部分撤回后重做（{name}）")
+        fresh_data_dir()
+
+        def responder(script, args):
+            if script == app.CALENDAR_DELETE_EVENTS_SCRIPT:
+                return "OK\t0\nMISSING\t1\tCan't get event.\nERR\t2\t权限不足\n"
+            return "OK\t0\tNEW-0\nOK\t1\tNEW-1\n"
+
+        app.applescript_runner = app.NullScriptRunner(responder)
+        app.storage = factory()
+        try:
+            app.storage.push_operation(make_operation(0, event_count=3))
+            result = app.undo_last_events_via_applescript()
+            assert (result["deleted_count"], result["missing_count"], result["failed_count"]) == (1, 1, 1), result
+            undone = app.storage.latest_undone_operation()
+            assert undone["event_ids"] == ["evt-0-0", "evt-0-1"] and undone["count"] == 2, undone
+            assert app.storage.latest_operation() is None
+            print("   ✅ 删除失败的事件不进入重做栈")
+        finally:
+            app.storage.close()
+
+        # 重启后重做栈仍只有实际删除的事件
+        app.storage = factory()
+        try:
+            assert app.storage.latest_undone_operation()["event_ids"] == ["evt-0-0", "evt-0-1"]
+            result = app.redo_last_events_via_applescript()
+            assert result["created_count"] == 2 and result["failed_count"] == 0, result
+            assert [event["title"] for event in app.storage.latest_operation()["events"]] == ["事件 0-0", "事件 0-1"]
+            if name == "json":
+                app.storage.operation_log.compact()
+                assert app.storage.latest_operation()["count"] == 2
+            print("   ✅ 重做只重新创建撤回时删除的 2 个事件")
+        finally:
+            app.storage.close()
+
+
+if __name__ == "__main__":
+    try:
+        test_migration()
+        test_undo_redo()
+        test_page_operations()
+        test_stale_recent_event()
+        test_partial_undo_redo()
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+    print()
+    print("✅ 全部通过")
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+测试 Faster Whisper 模型池（可在 Linux 上运行，不需要 Faster Whisper；需要 numpy）
+用替身模型验证：
+- 多个线程同时调用 load() 时只加载一次，每个实例用一段静音预热
+- 同时解码的请求数不超过 实例数 × num_workers
+- 加载失败时记录错误，下次调用重试
+- submit()：排队已满时拒绝（/api/transcribe 返回 429 + Retry-After），超过截止时间抛出 TimeoutError，
+  解码期间事件循环不被阻塞
+- /api/health/whisper 返回模型池状态
+"""
+
+import io
+import os
+import sys
+import wave
+import time
+import asyncio
+import tempfile
+import threading
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("AI_BUILDER_TOKEN", "test")
+os.environ["APPLESCRIPT_RUNNER"] = "null"
+# 数据库放到临时目录：导入 app 时不在仓库的 data/ 下创建数据库文件
+TEST_DATA_DIR = tempfile.mkdtemp(prefix="timeflow-test-")
+os.environ["DATABASE_FILE"] = os.path.join(TEST_DATA_DIR, "timeflow.db")
+os.environ["JOBS_DATABASE_FILE"] = os.path.join(TEST_DATA_DIR, "jobs.db")
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import app  # noqa: E402
+
+
+def make_wav(seconds=0.5):
+    """16kHz 单声道静音 WAV"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(16000)
+        wav.writeframes(b"\x00\x00" * int(16000 * seconds))
+    return buffer.getvalue()
+
+
+class FakeWhisperModel:
+    """记录解码次数和同时解码的最大请求数"""
+
+    lock = threading.Lock()
+    active = 0
+    max_active = 0
+
+    def __init__(self):
+        self.calls = []
+
+    def transcribe(self, audio, **kwargs):
+        cls = FakeWhisperModel
+        with cls.lock:
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+        time.sleep(0.05)
+        with cls.lock:
+            cls.active -= 1
+        self.calls.append(audio if isinstance(audio, str) else len(audio))
+        return iter([SimpleNamespace(start=0.0, end=1.0, text="你好")]), SimpleNamespace(language="zh")
+
+
+def test_load_once():
+    print("🧪 并发加载")
+    created = []
+
+    def factory():
+        time.sleep(0.1)
+        created.append(FakeWhisperModel())
+        return created[-1]
+
+    manager = app.WhisperModelManager("fake", pool_size=2, factory=factory)
+    threads = [threading.Thread(target=manager.load) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(created) == 2 and manager.ready, created
+    assert all(model.calls == [16000] for model in created), [model.calls for model in created]
+    status = manager.status()
+    assert status["load_seconds"] >= 0.2 and status["warmup_seconds"] is not None, status
+    print(f"   ✅ 8 个线程同时加载，只创建 2 个实例并各预热一次（加载 {status['load_seconds']}s）")
+
+
+def test_concurrency_limit():
+    print("🧪 并发解码")
+    FakeWhisperModel.max_active = 0
+    manager = app.WhisperModelManager("fake", pool_size=2, num_workers=1, factory=FakeWhisperModel)
+    manager.load()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(manager.transcribe("a.wav", language="zh")))
+               for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 6 and results[0][0][0].text == "你好", results
+    assert FakeWhisperModel.max_active == 2, FakeWhisperModel.max_active
+    assert manager.status()["busy"] == 0
+    print("   ✅ 6 个请求同时解码，最多 2 个在执行，其余等待空闲实例")
+
+
+def test_failed_load():
+    print("🧪 加载失败")
+    attempts = []
+
+    def factory():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("模型文件下载失败")
+        return FakeWhisperModel()
+
+    manager = app.WhisperModelManager("fake", factory=factory)
+    assert not manager.load()
+    assert manager.status()["status"] == "failed" and "下载失败" in manager.status()["error"]
+    segments, _ = manager.transcribe("a.wav")
+    assert segments[0].text == "你好" and manager.ready and manager.status()["error"] is None
+    print("   ✅ 失败时记录错误，下次调用重新加载")
+
+
+class BlockingWhisperModel:
+    """等待 release 后才返回（模拟长时间解码）"""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.warmed = False
+
+    def transcribe(self, audio, **kwargs):
+        if self.warmed:
+            self.release.wait(5)
+        self.warmed = True  # 预热不等待
+        return iter([SimpleNamespace(start=0.0, end=1.0, text="你好")]), SimpleNamespace(
+            language="zh", language_probability=0.9)
+
+
+def test_backpressure():
+    print("🧪 排队上限和截止时间")
+    model = BlockingWhisperModel()
+    manager = app.WhisperModelManager("fake", factory=lambda: model, queue_size=1, timeout=5)
+    manager.load()
+
+    async def run():
+        ticks = 0
+        first = asyncio.create_task(manager.submit("a.wav"))
+        second = asyncio.create_task(manager.submit("b.wav"))
+        await asyncio.sleep(0.1)
+        try:
+            await manager.submit("c.wav")
+            raise AssertionError("应当抛出 WhisperBusyError")
+        except app.WhisperBusyError as e:
+            assert e.retry_after >= 1
+        status = manager.status()
+        assert status["busy"] == 1 and status["queued"] == 1 and status["rejected"] == 1, status
+        # 解码在专用线程中执行，事件循环照常运行
+        while ticks < 5:
+            await asyncio.sleep(0.01)
+            ticks += 1
+        model.release.set()
+        return await first, await second
+
+    results = asyncio.run(run())
+    assert all(segments[0].text == "你好" for segments, _ in results), results
+    assert manager.status()["queued"] == 0 and manager.status()["avg_decode_seconds"] is not None
+    print("   ✅ 1 个解码 + 1 个排队时拒绝第 3 个请求，事件循环不被阻塞")
+
+    model = BlockingWhisperModel()
+    manager = app.WhisperModelManager("fake", factory=lambda: model, queue_size=1, timeout=0.2)
+    manager.load()
+
+    async def run_timeout():
+        tasks = [asyncio.create_task(manager.submit(name)) for name in ("a.wav", "b.wav")]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        assert all(isinstance(result, TimeoutError) for result in results), results
+        assert manager.status()["queued"] == 0, manager.status()  # 排队中的请求超时后移出队列
+        model.release.set()
+
+    asyncio.run(run_timeout())
+    assert manager.status()["timeouts"] == 2
+    print("   ✅ 超过截止时间抛出 TimeoutError，排队中的请求不再解码")
+
+
+def test_transcribe_429():
+    print("🧪 /api/transcribe 返回 429")
+    model = BlockingWhisperModel()
+    app.FASTER_WHISPER_AVAILABLE = True
+    app.STT_CACHE_ENABLED = False
+    app.whisper_models = app.WhisperModelManager("fake", factory=lambda: model, queue_size=0)
+    app.whisper_models.load()
+    client = TestClient(app.app)
+
+    def post():
+        return client.post("/api/transcribe", data={"use_local": "true"},
+                           files={"audio_file": ("a.wav", make_wav(), "audio/wav")})
+
+    busy = threading.Thread(target=post)
+    busy.start()
+    for _ in range(100):
+        if app.whisper_models.status()["busy"]:
+            break
+        time.sleep(0.01)
+    response = post()
+    assert response.status_code == 429 and int(response.headers["Retry-After"]) >= 1, response.text
+    assert app.provider_breakers["faster_whisper"].snapshot()["window_failures"] == 0
+    model.release.set()
+    busy.join()
+    assert post().json()["transcript"] == "你好"
+    print(f"   ✅ 队列已满时 429（Retry-After: {response.headers['Retry-After']}），不计入熔断")
+
+
+def test_health_endpoint():
+    print("🧪 /api/health/whisper")
+    app.whisper_models = app.WhisperModelManager("fake", factory=FakeWhisperModel)
+    client = TestClient(app.app)
+    status = client.get("/api/health/whisper").json()["whisper"]
+    assert status["status"] == "not_loaded", status
+    app.whisper_models.load()
+    status = client.get("/api/health/whisper").json()["whisper"]
+    assert status["status"] == "ready" and status["pool_size"] == 1 and status["loaded_at"], status
+    print("   ✅ 返回加载状态和耗时")
+
+
+if __name__ == "__main__":
+    test_load_once()
+    test_concurrency_limit()
+    test_failed_load()
+    test_backpressure()
+    test_transcribe_429()
+    test_health_endpoint()
+    print()
+    print("✅ 全部通过")